@@ -0,0 +1,359 @@
+"""Measures how signalblast copes with many subscribers, against a fake signal-cli-rest-api.
+
+For each number of subscribers it runs the subscribe, broadcast, edit, delete and unsubscribe flows and reports
+the throughput, the p50 and p99 latency of every request, the peak memory and the event loop lag:
+    python -m benchmarks.broadcast_benchmark --subscribers 100 1000 10000 --latency 0.02
+"""
+
+import argparse
+import asyncio
+import resource
+import tempfile
+import time
+import uuid
+from collections.abc import Callable, Coroutine
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any
+
+from signalbot import Context as ChatContext
+from signalbot import Message, MessageType
+
+from benchmarks.fake_signal_cli import FakeSignalCli
+from signalblast.admin import Admin
+from signalblast.broadcastbot import BroadcasBot
+from signalblast.commands import Broadcast, CommandDispatcher, Subscribe, Unsubscribe
+from signalblast.commands_strings import CommandRegex, PublicCommandStrings
+from signalblast.delivery_queue import DeliveryQueue
+from signalblast.delivery_worker import run_delivery_process
+from signalblast.outbound import Lane
+from signalblast.send_pacer import SendPacer, SharedSendPacer
+from signalblast.utils import create_or_set_logger
+
+BOT_PHONE_NUMBER = "+440000000000"
+
+
+@dataclass
+class FlowResult:
+    flow: str
+    num_subscribers: int
+    num_operations: int
+    duration: float
+    num_failed: int
+    peak_rss_mb: float
+    latencies: list[float] = field(default_factory=list)
+    loop_lags: list[float] = field(default_factory=list)
+
+    def row(self) -> list[str]:
+        latencies = sorted(self.latencies) if len(self.latencies) > 0 else [0.0]
+        loop_lags = sorted(self.loop_lags) if len(self.loop_lags) > 0 else [0.0]
+        return [
+            self.flow,
+            str(self.num_subscribers),
+            str(self.num_operations),
+            f"{self.duration:.2f}",
+            f"{self.num_operations / max(self.duration, 1e-6):.1f}",
+            f"{percentile(latencies, 0.5) * 1000:.1f}",
+            f"{percentile(latencies, 0.99) * 1000:.1f}",
+            str(self.num_failed),
+            f"{self.peak_rss_mb:.1f}",
+            f"{percentile(loop_lags, 0.99) * 1000:.1f}",
+            f"{loop_lags[-1] * 1000:.1f}",
+        ]
+
+
+HEADER = ["flow", "subs", "ops", "secs", "ops/s", "p50 ms", "p99 ms", "failed", "rss MB", "lag p99", "lag max"]
+
+
+def percentile(sorted_values: list[float], fraction: float) -> float:
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def peak_rss_mb() -> float:
+    # The peak of the whole process, run the sizes from small to large to attribute it to the largest one
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class LoopLagMonitor:
+    """Wakes up every interval and records how late it was, a busy event loop delays every message."""
+
+    def __init__(self, interval: float = 0.01) -> None:
+        self.interval = interval
+        self.lags: list[float] = []
+        self._task: asyncio.Task | None = None
+
+    async def _monitor(self) -> None:
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.lags.append(max(0.0, time.perf_counter() - start - self.interval))
+
+    def start(self) -> None:
+        self.lags = []
+        self._task = asyncio.create_task(self._monitor())
+
+    async def stop(self) -> list[float]:
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        return self.lags
+
+
+class RequestTimer:
+    """Wraps the bot methods that send messages through signal-cli to time every request.
+    The commands are timed as a whole instead, their requests go through signalbot's context."""
+
+    def __init__(self, bot: BroadcasBot) -> None:
+        self.latencies: list[float] = []
+        for method_name in ("send", "send_to_many", "remote_delete"):
+            setattr(bot, method_name, self.timed(getattr(bot, method_name)))
+
+        # The delivery worker processes time their own requests and report the latencies back
+        observe_send_latency = bot.metrics.send_latency.observe
+
+        def observe(value: float, *label_values: str) -> None:
+            observe_send_latency(value, *label_values)
+            if bot.delivery_tasks:
+                self.latencies.append(value)
+
+        bot.metrics.send_latency.observe = observe
+
+    def timed(self, method: Callable[..., Coroutine[Any, Any, int]]) -> Callable[..., Coroutine[Any, Any, int]]:
+        async def timed_method(*args: Any, **kwargs: Any) -> int:  # noqa: ANN401 Same arguments as the wrapped method
+            start = time.perf_counter()
+            try:
+                return await method(*args, **kwargs)
+            finally:
+                self.latencies.append(time.perf_counter() - start)
+
+        return timed_method
+
+    def reset(self) -> None:
+        self.latencies = []
+
+
+def make_context(bot: BroadcasBot, message: Message) -> ChatContext:
+    return ChatContext(bot._bot, message)  # noqa: SLF001
+
+
+def make_message(source_uuid: str, text: str | None, message_type: MessageType = MessageType.DATA_MESSAGE) -> Message:
+    return Message(
+        source=source_uuid,
+        source_number=None,
+        source_uuid=source_uuid,
+        timestamp=int(time.time() * 1000),
+        type=message_type,
+        text=text,
+    )
+
+
+class Benchmark:
+    def __init__(self, args: argparse.Namespace, fake_signal_cli: FakeSignalCli, signal_service: str) -> None:
+        self.args = args
+        self.fake_signal_cli = fake_signal_cli
+        self.signal_service = signal_service
+        self.loop_lag_monitor = LoopLagMonitor()
+
+    async def create_bot(self, data_path: Path) -> tuple[BroadcasBot, CommandDispatcher]:
+        config = {
+            "signal_service": self.signal_service,
+            "phone_number": BOT_PHONE_NUMBER,
+            "storage": {"type": "sqlite", "sqlite_db": data_path / "signalblast.db", "check_same_thread": False},
+        }
+        # Keep the benchmark away from the data of the real bot
+        Admin.save_path = data_path / "admin.txt"
+        bot = BroadcasBot(config)
+        bot.subscribers_data_path = data_path / "subscribers.csv"
+        bot.banned_users_data_path = data_path / "banned_users.csv"
+        bot.attachments_spool_path = data_path / "attachments"
+
+        send_rate = self.args.send_rate
+        signal_cli_jsonrpc = f"localhost:{self.fake_signal_cli.jsonrpc_port}" if self.args.jsonrpc else None
+        delivery_queue = None
+        if self.args.delivery_processes > 0:
+            delivery_queue = DeliveryQueue.load(data_path / "delivery_queue.db")
+
+        def create_send_pacer(phone_number: str) -> SendPacer:
+            if delivery_queue is None:
+                return SendPacer(rate=send_rate, min_rate=min(0.5, send_rate), max_rate=send_rate, burst=send_rate)
+            return SharedSendPacer(delivery_queue, phone_number, send_rate, min(0.5, send_rate), send_rate)
+
+        await bot.load_data(
+            logger=create_or_set_logger("signalblast-benchmark"),
+            admin_pass=None,
+            expiration_time=self.args.expiration_time,
+            send_pacer=create_send_pacer(BOT_PHONE_NUMBER),
+            users_backend=self.args.users_backend,
+            signal_cli_jsonrpc=signal_cli_jsonrpc,
+        )
+        for i in range(1, self.args.accounts):
+            phone_number = f"{BOT_PHONE_NUMBER[:-3]}{i:03d}"
+            bot.add_account(phone_number, self.signal_service, create_send_pacer(phone_number))
+        await bot.wait_for_signal_service()
+
+        # The same split of the outbound slots as in main.py, with its default number of slots
+        bulk_slots = bot.outbound.limit(Lane.BULK)
+        for i in range(self.args.delivery_processes):
+            delivery_task = run_delivery_process(
+                bot.logger,
+                data_path / "delivery_queue.db",
+                worker_id=str(i),
+                concurrency=min(self.args.broadcast_workers, bulk_slots // self.args.delivery_processes),
+                send_rate=send_rate,
+                min_send_rate=min(0.5, send_rate),
+                max_send_rate=send_rate,
+                signal_cli_jsonrpc=signal_cli_jsonrpc,
+                jsonrpc_signal_service=self.signal_service,
+            )
+            bot.delivery_tasks.append(asyncio.create_task(delivery_task))
+
+        broadcast = Broadcast(
+            bot=bot,
+            num_send_workers=self.args.broadcast_workers,
+            send_batch_size=self.args.send_batch_size,
+            num_modify_workers=self.args.modify_workers,
+            delivery_queue=delivery_queue,
+        )
+        dispatcher = CommandDispatcher(bot=bot, default_command=broadcast)
+        dispatcher.add(CommandRegex.subscribe, Subscribe(bot=bot))
+        dispatcher.add(CommandRegex.unsubscribe, Unsubscribe(bot=bot))
+        dispatcher.add(CommandRegex.broadcast, broadcast)
+        dispatcher.bot = bot._bot  # noqa: SLF001 Same as registering it in the bot, without starting it
+        dispatcher.setup()
+        return bot, dispatcher
+
+    async def run_flow(
+        self,
+        flow: str,
+        num_subscribers: int,
+        timer: RequestTimer,
+        flow_coroutine: Coroutine[Any, Any, None],
+    ) -> FlowResult:
+        timer.reset()
+        num_failed = self.fake_signal_cli.num_failed + self.fake_signal_cli.num_rate_limited
+        self.loop_lag_monitor.start()
+        start = time.perf_counter()
+        await flow_coroutine
+        duration = time.perf_counter() - start
+        loop_lags = await self.loop_lag_monitor.stop()
+        num_failed = self.fake_signal_cli.num_failed + self.fake_signal_cli.num_rate_limited - num_failed
+        return FlowResult(
+            flow=flow,
+            num_subscribers=num_subscribers,
+            num_operations=len(timer.latencies),
+            duration=duration,
+            num_failed=num_failed,
+            peak_rss_mb=peak_rss_mb(),
+            latencies=timer.latencies,
+            loop_lags=loop_lags,
+        )
+
+    async def handle_concurrently(
+        self,
+        dispatcher: CommandDispatcher,
+        timer: RequestTimer,
+        contexts: list[ChatContext],
+    ) -> None:
+        # Users send their commands at the same time, signalbot handles them concurrently
+        semaphore = asyncio.Semaphore(self.args.concurrency)
+
+        async def handle(ctx: ChatContext) -> None:
+            async with semaphore:
+                start = time.perf_counter()
+                await dispatcher.handle(ctx)
+                timer.latencies.append(time.perf_counter() - start)
+
+        await asyncio.gather(*(handle(ctx) for ctx in contexts))
+
+    async def run(self, num_subscribers: int) -> list[FlowResult]:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            bot, dispatcher = await self.create_bot(Path(tmp_dir))
+            timer = RequestTimer(bot)
+            subscriber_uuids = [str(uuid.UUID(int=i + 1)) for i in range(num_subscribers)]
+            author = subscriber_uuids[0]
+
+            subscribe = [
+                make_context(bot, make_message(subscriber_uuid, PublicCommandStrings.subscribe))
+                for subscriber_uuid in subscriber_uuids
+            ]
+            flow = self.handle_concurrently(dispatcher, timer, subscribe)
+            results = [await self.run_flow("subscribe", num_subscribers, timer, flow)]
+
+            broadcast_message = make_message(author, "Benchmark message " + "x" * self.args.message_size)
+            if self.args.attachment_size > 0:
+                broadcast_message.base64_attachments = ["A" * self.args.attachment_size]
+                broadcast_message.attachments_local_filenames = ["benchmark-attachment"]
+            flow = dispatcher.handle(make_context(bot, broadcast_message))
+            results.append(await self.run_flow("broadcast", num_subscribers, timer, flow))
+
+            edit_message = make_message(author, "Edited benchmark message", MessageType.EDIT_MESSAGE)
+            edit_message.target_sent_timestamp = broadcast_message.timestamp
+            flow = dispatcher.handle(make_context(bot, edit_message))
+            results.append(await self.run_flow("edit", num_subscribers, timer, flow))
+
+            delete_message = make_message(author, None, MessageType.DELETE_MESSAGE)
+            delete_message.remote_delete_timestamp = broadcast_message.timestamp
+            flow = dispatcher.handle(make_context(bot, delete_message))
+            results.append(await self.run_flow("delete", num_subscribers, timer, flow))
+
+            unsubscribe = [
+                make_context(bot, make_message(subscriber_uuid, PublicCommandStrings.unsubscribe))
+                for subscriber_uuid in subscriber_uuids
+            ]
+            flow = self.handle_concurrently(dispatcher, timer, unsubscribe)
+            results.append(await self.run_flow("unsubscribe", num_subscribers, timer, flow))
+
+            await bot.shutdown()
+            bot._bot.storage._sqlite.close()  # noqa: SLF001
+        return results
+
+
+def print_table(rows: list[list[str]]) -> None:
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    for row in rows:
+        print("  ".join(value.rjust(width) for value, width in zip(row, widths, strict=True)))  # noqa: T201
+
+
+async def main(args: argparse.Namespace) -> None:
+    fake_signal_cli = FakeSignalCli(
+        latency=args.latency,
+        failure_rate=args.failure_rate,
+        rate_limit=args.rate_limit,
+        seed=args.seed,
+    )
+    signal_service = fake_signal_cli.start_in_thread()
+    try:
+        benchmark = Benchmark(args, fake_signal_cli, signal_service)
+        rows = [HEADER]
+        for num_subscribers in sorted(args.subscribers):
+            rows.extend(result.row() for result in await benchmark.run(num_subscribers))
+    finally:
+        fake_signal_cli.stop_thread()
+
+    print_table(rows)
+    print(  # noqa: T201
+        f"signal-cli requests {fake_signal_cli.num_requests}, messages {fake_signal_cli.num_messages}, "
+        f"failed {fake_signal_cli.num_failed}, rate limited {fake_signal_cli.num_rate_limited}",
+    )
+
+
+if __name__ == "__main__":
+    args_parser = argparse.ArgumentParser()
+    args_parser.add_argument("--subscribers", type=int, nargs="+", default=[100, 1000, 10000])
+    args_parser.add_argument("--latency", type=float, default=0.01, help="average seconds signal-cli takes to answer")
+    args_parser.add_argument("--failure_rate", type=float, default=0.0, help="probability of a signal-cli failure")
+    args_parser.add_argument("--rate_limit", type=float, default=None, help="messages per second before a 429")
+    args_parser.add_argument("--seed", type=int, default=0, help="seed for the fake signal-cli random failures")
+    args_parser.add_argument("--send_rate", type=float, default=1000.0, help="initial and maximum send rate")
+    args_parser.add_argument("--broadcast_workers", type=int, default=4)
+    args_parser.add_argument("--send_batch_size", type=int, default=100, help="subscribers per send request")
+    args_parser.add_argument("--modify_workers", type=int, default=16)
+    args_parser.add_argument("--delivery_processes", type=int, default=0, help="processes sending the broadcasts")
+    args_parser.add_argument("--accounts", type=int, default=1, help="bot numbers the subscribers are shared between")
+    args_parser.add_argument("--jsonrpc", action="store_true", help="send to the fake signal-cli daemon directly")
+    args_parser.add_argument("--users_backend", type=str, choices=["csv", "sqlite"], default="csv")
+    args_parser.add_argument("--expiration_time", type=int, default=60 * 60 * 24 * 7 * 4)
+    args_parser.add_argument("--concurrency", type=int, default=50, help="subscribe commands handled at the same time")
+    args_parser.add_argument("--message_size", type=int, default=100, help="characters in the broadcasted message")
+    args_parser.add_argument("--attachment_size", type=int, default=0, help="base64 characters of the attachment")
+
+    asyncio.run(main(args_parser.parse_args()))
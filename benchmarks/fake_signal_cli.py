@@ -0,0 +1,234 @@
+"""Local stand-in for the signal-cli-rest-api and the JSON-RPC of the signal-cli daemon behind it,
+only implements what signalblast uses.
+
+Run it on its own to try the bot without a Signal account:
+    python -m benchmarks.fake_signal_cli --port 8080 --jsonrpc_port 7583 --latency 0.05 --failure_rate 0.01
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import threading
+import time
+
+from aiohttp import web
+
+
+class FakeSignalCli:
+    """Every request waits the given latency (with up to 50% jitter) and then fails with the given probability,
+    a message to several recipients fails for each recipient on its own like signal-cli reports it.
+    If rate_limit is set, messages above that many per second for the same bot number are rejected with a 429
+    like Signal does. The JSON-RPC requests are answered as soon as each one is done, not in order."""
+
+    def __init__(
+        self,
+        latency: float = 0.0,
+        failure_rate: float = 0.0,
+        rate_limit: float | None = None,
+        seed: int | None = None,
+    ) -> None:
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.rate_limit = rate_limit
+        self.random = random.Random(seed)  # noqa: S311 Not used for cryptography
+        self.num_requests = 0
+        self.num_messages = 0
+        self.num_failed = 0
+        self.num_rate_limited = 0
+        # Token bucket per bot number, with the tokens and the last refill time
+        self._buckets: dict[str, tuple[float, float]] = {}
+        self._last_timestamp = 0
+        self._runner: web.AppRunner | None = None
+        self._jsonrpc_server: asyncio.Server | None = None
+        self._jsonrpc_tasks: set[asyncio.Task] = set()
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._thread: threading.Thread | None = None
+        self.port: int | None = None
+        self.jsonrpc_port: int | None = None
+
+    def make_app(self) -> web.Application:
+        app = web.Application(client_max_size=1024**3)
+        app.router.add_get("/v1/health", self.health)
+        app.router.add_get("/v1/about", self.about)
+        app.router.add_post("/v2/send", self.send)
+        app.router.add_delete("/v1/remote-delete/{number}", self.remote_delete)
+        app.router.add_post("/v1/receipts/{number}", self.ok)
+        app.router.add_post("/v1/reactions/{number}", self.ok)
+        app.router.add_put("/v1/contacts/{number}", self.ok)
+        app.router.add_put("/v1/groups/{number}/{group_id}", self.ok)
+        app.router.add_get("/v1/attachments/{attachment_id}", self.get_attachment)
+        app.router.add_delete("/v1/attachments/{attachment_id}", self.ok)
+        return app
+
+    def next_timestamp(self) -> int:
+        # Signal timestamps are in milliseconds and unique per message
+        self._last_timestamp = max(self._last_timestamp + 1, int(time.time() * 1000))
+        return self._last_timestamp
+
+    def is_rate_limited(self, number: str, num_messages: int) -> bool:
+        if self.rate_limit is None:
+            return False
+        now = time.monotonic()
+        tokens, last_refill = self._buckets.get(number, (self.rate_limit, now))
+        tokens = min(self.rate_limit, tokens + (now - last_refill) * self.rate_limit)
+        is_rate_limited = tokens < num_messages
+        if not is_rate_limited:
+            tokens -= num_messages
+        self._buckets[number] = (tokens, now)
+        return is_rate_limited
+
+    async def respond(
+        self,
+        num_messages: int = 0,
+        number: str = "",
+        recipients: list | None = None,
+    ) -> tuple[int, dict]:
+        self.num_requests += 1
+        if self.latency > 0:
+            await asyncio.sleep(self.latency * self.random.uniform(0.5, 1.5))
+
+        if self.is_rate_limited(number, num_messages):
+            self.num_rate_limited += 1
+            return 429, {"error": "Rate limit exceeded"}
+
+        if recipients is None or len(recipients) <= 1:
+            if self.random.random() < self.failure_rate:
+                self.num_failed += 1
+                return 400, {"error": "Failed to send message"}
+            self.num_messages += num_messages
+            return 200, {"timestamp": str(self.next_timestamp())}
+
+        failed = [recipient for recipient in recipients if self.random.random() < self.failure_rate]
+        self.num_failed += len(failed)
+        self.num_messages += len(recipients) - len(failed)
+        payload = {"timestamp": str(self.next_timestamp()), "failed": failed}
+        if len(failed) > 0:
+            # signal-cli-rest-api reports the failed recipients in the error, one per line
+            lines = [f"Failed to send message to {recipient}: network failure" for recipient in failed]
+            payload["error"] = "Failed to send (some) messages:\n" + "\n".join(lines)
+            return 400, payload
+        return 200, payload
+
+    async def reply(self, num_messages: int = 0, number: str = "") -> web.Response:
+        status, payload = await self.respond(num_messages, number)
+        return web.json_response(payload, status=status)
+
+    async def reply_send(self, recipients: list, number: str) -> web.Response:
+        status, payload = await self.respond(len(recipients), number, recipients)
+        if status != 200:  # noqa: PLR2004 HTTP OK
+            return web.json_response({"error": payload["error"]}, status=status)
+        return web.json_response({"timestamp": payload["timestamp"]})
+
+    async def answer_jsonrpc(self, request: dict, writer: asyncio.StreamWriter) -> None:
+        params = request.get("params", {})
+        recipients = params.get("recipient", [])
+        if isinstance(recipients, str):
+            recipients = [recipients]
+        num_messages = len(recipients) if request["method"] in ("send", "remoteDelete") else 0
+        status, payload = await self.respond(num_messages, params.get("account", ""), recipients)
+        response = {"jsonrpc": "2.0", "id": request["id"]}
+        if "failed" in payload:
+            failed = payload["failed"]
+            results = [
+                {
+                    "recipientAddress": {"uuid": recipient},
+                    "type": "NETWORK_FAILURE" if recipient in failed else "SUCCESS",
+                }
+                for recipient in recipients
+            ]
+            response["result"] = {"timestamp": int(payload["timestamp"]), "results": results}
+        elif status == 200:  # noqa: PLR2004 HTTP OK
+            results = [{"recipientAddress": {"uuid": recipient}, "type": "SUCCESS"} for recipient in recipients]
+            response["result"] = {"timestamp": int(payload["timestamp"]), "results": results}
+        else:
+            response["error"] = {"code": -5 if status == 429 else -1, "message": payload["error"]}  # noqa: PLR2004
+        writer.write(json.dumps(response).encode() + b"\n")
+
+    async def handle_jsonrpc(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        # Keep reading while the earlier requests are being answered, like the daemon does
+        while line := await reader.readline():
+            task = asyncio.create_task(self.answer_jsonrpc(json.loads(line), writer))
+            self._jsonrpc_tasks.add(task)
+            task.add_done_callback(self._jsonrpc_tasks.discard)
+        writer.close()
+
+    async def health(self, _: web.Request) -> web.Response:
+        return web.Response(status=204)
+
+    async def about(self, _: web.Request) -> web.Response:
+        return web.json_response({"versions": ["v1", "v2"], "mode": "json-rpc", "version": "fake"})
+
+    async def send(self, request: web.Request) -> web.Response:
+        payload = await request.json()
+        return await self.reply_send(payload["recipients"], payload["number"])
+
+    async def remote_delete(self, request: web.Request) -> web.Response:
+        await request.json()
+        return await self.reply(1, request.match_info["number"])
+
+    async def ok(self, _: web.Request) -> web.Response:
+        return await self.reply()
+
+    async def get_attachment(self, _: web.Request) -> web.Response:
+        self.num_requests += 1
+        return web.Response(body=b"fake attachment")
+
+    async def start(self, host: str = "localhost", port: int = 0, jsonrpc_port: int = 0) -> str:
+        self._runner = web.AppRunner(self.make_app(), access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        self.port = self._runner.addresses[0][1]
+
+        self._jsonrpc_server = await asyncio.start_server(self.handle_jsonrpc, host, jsonrpc_port, limit=1024**3)
+        self.jsonrpc_port = self._jsonrpc_server.sockets[0].getsockname()[1]
+        return f"{host}:{self.port}"
+
+    async def stop(self) -> None:
+        if self._jsonrpc_server is not None:
+            self._jsonrpc_server.close()
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    def start_in_thread(self, host: str = "localhost", port: int = 0) -> str:
+        """Serve from another thread with its own event loop, so the server does not
+        add to the lag of the event loop being measured."""
+        self._loop = asyncio.new_event_loop()
+        started = threading.Event()
+
+        def run() -> None:
+            asyncio.set_event_loop(self._loop)
+            self._loop.run_until_complete(self.start(host, port))
+            started.set()
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+        started.wait()
+        return f"{host}:{self.port}"
+
+    def stop_thread(self) -> None:
+        asyncio.run_coroutine_threadsafe(self.stop(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+
+if __name__ == "__main__":
+    args_parser = argparse.ArgumentParser()
+    args_parser.add_argument("--host", type=str, default="localhost", help="the address to listen on")
+    args_parser.add_argument("--port", type=int, default=8080, help="the port to listen on")
+    args_parser.add_argument("--jsonrpc_port", type=int, default=7583, help="the port of the fake signal-cli daemon")
+    args_parser.add_argument("--latency", type=float, default=0.0, help="average seconds to answer a request")
+    args_parser.add_argument("--failure_rate", type=float, default=0.0, help="probability of a request failing")
+    args_parser.add_argument("--rate_limit", type=float, default=None, help="messages per second before a 429")
+    args = args_parser.parse_args()
+
+    fake_signal_cli = FakeSignalCli(latency=args.latency, failure_rate=args.failure_rate, rate_limit=args.rate_limit)
+
+    async def serve() -> None:
+        await fake_signal_cli.start(args.host, args.port, args.jsonrpc_port)
+        print(f"Listening on {args.host}:{args.port}, JSON-RPC on {args.host}:{args.jsonrpc_port}")  # noqa: T201
+        await asyncio.Event().wait()
+
+    asyncio.run(serve())
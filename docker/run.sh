@@ -17,4 +17,5 @@ docker run \
  --network host \
  -e SIGNALBLAST_PHONE_NUMBER='PHONE_NUMBER' \
  -e SIGNALBLAST_PASSWORD='PASSWORD' \
+ -e SIGNALBLAST_SIGNAL_ATTACHMENTS_DIR=/home/user/.local/share/signal-api/attachments \
   eradorta/signalblast:$DOCKER_TAG
@@ -0,0 +1,211 @@
+from __future__ import annotations
+
+import hashlib
+import json
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING
+
+import aiohttp
+from signalbot import SendMessageError
+
+from signalblast.attachments import json_with_attachments
+from signalblast.jsonrpc import JsonRpcSignalAPI, get_failed_recipients
+
+if TYPE_CHECKING:
+    from collections.abc import Sequence
+    from pathlib import Path
+
+    from signalbot.api import SignalAPI
+    from signalbot.link_previews import LinkPreview
+
+    from signalblast.send_pacer import SendPacer
+
+
+# How signal-cli-rest-api words the failures of each recipient, as the result types of signal-cli
+_REST_FAILURES = (
+    ("unregistered", "UNREGISTERED_FAILURE"),
+    ("untrusted", "IDENTITY_FAILURE"),
+    ("identity", "IDENTITY_FAILURE"),
+    ("rate limit", "RATE_LIMIT_FAILURE"),
+)
+
+
+def get_rest_failures(receivers: list[str], error: str) -> dict[str, str]:
+    # signal-cli-rest-api only reports the recipients that failed, one per line of the error. With a single
+    # recipient it may not be named, but the failure is still about them
+    failed = {}
+    for line in error.splitlines():
+        failure_type = next((rest_type for words, rest_type in _REST_FAILURES if words in line.lower()), None)
+        for receiver in receivers:
+            if receiver in line or (len(receivers) == 1 and failure_type is not None):
+                failed[receiver] = failure_type or "NETWORK_FAILURE"
+    return failed
+
+
+# The error class of the receivers that got a message whose timestamp signal-cli did not report, it cannot be
+# edited or deleted later
+SENT_WITHOUT_TIMESTAMP = "Sent without timestamp"
+
+
+class RecipientError(Exception):
+    def __init__(self, receiver: str, failure_type: str) -> None:
+        super().__init__(f"{failure_type.replace('_', ' ').lower()} for {receiver}")
+        self.code = failure_type
+
+
+@dataclass
+class SendResult:
+    # None if signal-cli sent the message but did not say with which timestamp
+    timestamp: int | None
+    # The receivers that did not get the message, by the type of failure
+    failed: dict[str, str] = field(default_factory=dict)
+
+    def get_rate_limit_error(self) -> RecipientError | None:
+        # Signal rate limited some of the receivers, the send pacer has to slow down all the same
+        for receiver, failure_type in self.failed.items():
+            if failure_type == "RATE_LIMIT_FAILURE":
+                return RecipientError(receiver, failure_type)
+        return None
+
+
+@dataclass
+class SenderAccount:
+    """A Signal number the broadcasts are sent from. Signal rate limits each number on its own,
+    so every account has its own send pacer."""
+
+    phone_number: str
+    signal_api: SignalAPI
+    send_pacer: SendPacer
+
+    async def send(  # noqa: PLR0913 Too many arguments in function definition
+        self,
+        receiver: str,
+        text: str,
+        *,
+        base64_attachments: list | None = None,
+        link_preview: LinkPreview | None = None,
+        edit_timestamp: int | None = None,
+        view_once: bool = False,
+        attachment_paths: list[Path] | None = None,
+    ) -> int:
+        if attachment_paths or not isinstance(self.signal_api, JsonRpcSignalAPI):
+            # signalbot posts the attachments from memory and does not say why signal-cli-rest-api could not send
+            result = await self.send_to_many(
+                [receiver],
+                text,
+                base64_attachments=base64_attachments,
+                link_preview=link_preview,
+                edit_timestamp=edit_timestamp,
+                view_once=view_once,
+                attachment_paths=attachment_paths,
+            )
+            return result.timestamp
+
+        resp = await self.signal_api.send(
+            receiver,
+            text,
+            base64_attachments=base64_attachments,
+            link_preview=None if link_preview is None else link_preview.model_dump(),
+            edit_timestamp=edit_timestamp,
+            view_once=view_once,
+        )
+        return int((await resp.json())["timestamp"])
+
+    async def send_to_many(  # noqa: PLR0913 Too many arguments in function definition
+        self,
+        receivers: list[str],
+        text: str,
+        *,
+        base64_attachments: list | None = None,
+        link_preview: LinkPreview | None = None,
+        edit_timestamp: int | None = None,
+        view_once: bool = False,
+        attachment_paths: list[Path] | None = None,
+    ) -> SendResult:
+        """Send the same message to several receivers in a single signal-cli request, so the text and attachments
+        are only posted once. Signal still delivers a separate message to each receiver, all with the same timestamp.
+        An edit can only go to receivers that got the original message with the same timestamp.
+        The request only fails when nobody got the message, the receivers that did not are in the result."""
+        if isinstance(self.signal_api, JsonRpcSignalAPI):
+            resp = await self.signal_api.send_to_many(
+                receivers,
+                text,
+                base64_attachments=base64_attachments,
+                link_preview=None if link_preview is None else link_preview.model_dump(),
+                edit_timestamp=edit_timestamp,
+                view_once=view_once,
+                attachment_paths=attachment_paths,
+            )
+            result = await resp.json()
+            return SendResult(int(result["timestamp"]), get_failed_recipients(receivers, result.get("results", [])))
+
+        payload = {
+            "base64_attachments": [] if base64_attachments is None else base64_attachments,
+            "message": text,
+            "number": self.phone_number,
+            "recipients": receivers,
+        }
+        if link_preview is not None:
+            payload["link_preview"] = link_preview.model_dump()
+        if edit_timestamp is not None:
+            payload["edit_timestamp"] = edit_timestamp
+        if view_once:
+            payload["view_once"] = True
+
+        uri = self.signal_api._signal_api_uris.send_rest_uri()  # noqa: SLF001
+        post_args = {"json": payload}
+        if attachment_paths:
+            # The attachment files go at the end of the json, a chunk at a time
+            del payload["base64_attachments"]
+            head = json.dumps(payload).encode().removesuffix(b"}") + b', "base64_attachments": ['
+            post_args = {
+                "data": json_with_attachments(head, attachment_paths, b"]}"),
+                "headers": {"Content-Type": "application/json"},
+            }
+        failed = {}
+        try:
+            async with aiohttp.ClientSession() as session:
+                resp = await session.post(uri, **post_args)
+                if resp.status == 400:  # noqa: PLR2004 signal-cli-rest-api's status when signal-cli could not send
+                    failed = get_rest_failures(receivers, await resp.text())
+                if len(failed) == 0:
+                    resp.raise_for_status()
+                    return SendResult(int((await resp.json())["timestamp"]))
+        except (aiohttp.ClientError, KeyError) as e:
+            raise SendMessageError from e
+
+        if len(receivers) == 1:
+            receiver, failure_type = next(iter(failed.items()))
+            raise SendMessageError from RecipientError(receiver, failure_type)
+        # The others got the message, but signal-cli-rest-api does not say with which timestamp
+        return SendResult(None, failed)
+
+    async def remote_delete(self, receiver: str, timestamp: int) -> int:
+        resp = await self.signal_api.remote_delete(receiver, timestamp=timestamp)
+        return int((await resp.json())["timestamp"])
+
+
+def parse_accounts(accounts: str | None, default_signal_service: str) -> list[tuple[str, str]]:
+    # Comma separated phone numbers, each one optionally followed by @ and its signal-cli-rest-api address
+    if accounts is None:
+        return []
+
+    parsed_accounts = []
+    for account in accounts.split(","):
+        phone_number, _, signal_service = account.strip().partition("@")
+        if phone_number == "":
+            continue
+        parsed_accounts.append((phone_number, signal_service or default_signal_service))
+    return parsed_accounts
+
+
+def assign_account(subscriber: str, accounts: Sequence[SenderAccount]) -> SenderAccount:
+    """Rendezvous hashing, a subscriber always gets the same account and adding or removing an
+    account only moves the subscribers of that account."""
+    if len(accounts) == 1:
+        return accounts[0]
+
+    def weight(account: SenderAccount) -> bytes:
+        return hashlib.blake2b(f"{account.phone_number}:{subscriber}".encode(), digest_size=8).digest()
+
+    return max(accounts, key=weight)
@@ -1,14 +1,28 @@
+import asyncio
+import os
+import time
+
 import bcrypt
 
-from signalblast.utils import get_code_data_path
+from signalblast.utils import fsync_directory, get_code_data_path
 
 
 class Admin:
+    """The password is hashed and checked in a worker thread, bcrypt is slow on purpose.
+    After MAX_FREE_ATTEMPTS wrong passwords a user has to wait before trying again, doubling the wait every time."""
+
     save_path = get_code_data_path() / "admin.txt"
+    MAX_FREE_ATTEMPTS = 3
+    THROTTLE_SECONDS = 60
+    MAX_THROTTLE_SECONDS = 60 * 60
 
     def __init__(self) -> None:
         self.admin_id: str = None
         self._hashed_password: str = None
+        self._write_lock = asyncio.Lock()
+        self._check_lock = asyncio.Lock()
+        self._num_failed_attempts: dict[str, int] = {}
+        self._next_attempt_time: dict[str, float] = {}
 
     @classmethod
     async def create(cls, admin_password: str | None) -> None:
@@ -24,36 +38,67 @@ class Admin:
         if password is None:
             self._hashed_password = b""
         else:
-            self._hashed_password = bcrypt.hashpw(password.encode(), bcrypt.gensalt())
+            self._hashed_password = await asyncio.to_thread(bcrypt.hashpw, password.encode(), bcrypt.gensalt())
         await self.save_to_file()
 
-    async def add(self, admin_id: str, admin_password: str | None) -> bool:
-        if admin_password is None:
+    async def is_password_correct(self, password: str) -> bool:
+        if len(self.get_hashed_password()) == 0:
+            return False
+        return await asyncio.to_thread(bcrypt.checkpw, password.encode(), self.get_hashed_password())
+
+    def seconds_until_next_attempt(self, user_id: str) -> float:
+        return max(0.0, self._next_attempt_time.get(user_id, 0.0) - time.monotonic())
+
+    async def check_password(self, user_id: str, password: str | None) -> bool:
+        # One check at a time, otherwise a burst of attempts would all get in before the throttling starts
+        async with self._check_lock:
+            return await self._check_password(user_id, password)
+
+    async def _check_password(self, user_id: str, password: str | None) -> bool:
+        if password is None or self.seconds_until_next_attempt(user_id) > 0:
             return False
 
-        if bcrypt.checkpw(admin_password.encode(), self.get_hashed_password()):
+        if await self.is_password_correct(password):
+            self._num_failed_attempts.pop(user_id, None)
+            self._next_attempt_time.pop(user_id, None)
+            return True
+
+        num_failed_attempts = self._num_failed_attempts.get(user_id, 0) + 1
+        self._num_failed_attempts[user_id] = num_failed_attempts
+        if num_failed_attempts >= self.MAX_FREE_ATTEMPTS:
+            throttle_seconds = self.THROTTLE_SECONDS * 2 ** (num_failed_attempts - self.MAX_FREE_ATTEMPTS)
+            self._next_attempt_time[user_id] = time.monotonic() + min(throttle_seconds, self.MAX_THROTTLE_SECONDS)
+        return False
+
+    async def add(self, admin_id: str, admin_password: str | None) -> bool:
+        if await self.check_password(admin_id, admin_password):
             self.admin_id = admin_id
             await self.save_to_file()
             return True
         return False
 
-    async def remove(self, admin_password: str | None) -> bool:
-        if admin_password is None:
-            return False
-
-        if bcrypt.checkpw(admin_password.encode(), self.get_hashed_password()):
+    async def remove(self, user_id: str, admin_password: str | None) -> bool:
+        if await self.check_password(user_id, admin_password):
             self.admin_id = None
             await self.save_to_file()
             return True
         return False
 
+    def _write_file(self, contents: str) -> None:
+        # Write to a temporary file first, a crash while writing must not lose the password
+        tmp_path = self.save_path.with_name(self.save_path.name + ".tmp")
+        with tmp_path.open("w") as f:
+            f.write(contents)
+            f.flush()
+            os.fsync(f.fileno())
+        tmp_path.replace(self.save_path)
+        fsync_directory(self.save_path.parent)
+
     async def save_to_file(self) -> None:
-        with self.save_path.open("w") as f:
-            if self.admin_id is None:
-                f.write("\n")
-            else:
-                f.write(self.admin_id + "\n")
-            f.write(self.get_hashed_password().decode())
+        admin_id = "" if self.admin_id is None else self.admin_id
+        contents = admin_id + "\n" + self.get_hashed_password().decode()
+        async with self._write_lock:
+            await asyncio.to_thread(self._write_file, contents)
 
     @staticmethod
     async def _load_from_file() -> "Admin":
@@ -74,6 +119,6 @@ class Admin:
 
         admin = await Admin._load_from_file()
         # Overwrite the password in the file, if no password was given assume we want to keep the one from the file
-        if admin_password is not None:
+        if admin_password is not None and not await admin.is_password_correct(admin_password):
             await admin.set_hashed_password(admin_password)
         return admin
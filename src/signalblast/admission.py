@@ -0,0 +1,151 @@
+from __future__ import annotations
+
+import asyncio
+import itertools
+import time
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from collections.abc import Callable
+
+
+@dataclass
+class SenderBucket:
+    tokens: float
+    last_refill: float
+    # Finish tag of the sender's latest broadcast, their next one is queued behind it
+    last_tag: float = 0.0
+
+
+@dataclass
+class Ticket:
+    job_id: int
+    author: str
+    timestamp: int
+    cost: int  # Number of recipients
+    start_tag: float
+    finish_tag: float  # The waiting broadcast with the lowest one goes first
+    ready_at: float  # When the sender's token bucket lets it start, in the admission's clock
+    order: int
+    admitted: asyncio.Future[bool] = field(repr=False)
+
+
+class BroadcastAdmission:
+    """Decides when each new broadcast starts, so a sender that keeps broadcasting cannot take all the capacity.
+    Every sender has a bucket of burst broadcasts that refills at broadcasts_per_hour, without tokens left the
+    broadcast is queued until the bucket refills. The queued broadcasts start by weighted fair queueing, each one
+    is tagged with the sender's previous tag, or the virtual time if later, plus its recipients over the weight.
+    At most max_running broadcasts are sent at the same time. Either limit is not applied if it is None."""
+
+    def __init__(
+        self,
+        max_running: int | None = 1,
+        broadcasts_per_hour: float | None = 6.0,
+        burst: float = 3.0,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        is_valid_max_running = max_running is None or max_running >= 1
+        is_valid_rate = broadcasts_per_hour is None or broadcasts_per_hour > 0
+        if not is_valid_max_running or not is_valid_rate or burst < 1:
+            value_error_msg = f"Invalid broadcast admission {max_running=} {broadcasts_per_hour=} {burst=}"
+            raise ValueError(value_error_msg)
+
+        self.max_running = max_running
+        self.rate = None if broadcasts_per_hour is None else broadcasts_per_hour / 3600
+        self.burst = burst
+        self.clock = clock
+        self.buckets: dict[str, SenderBucket] = {}
+        self.queued: list[Ticket] = []
+        self.running: list[Ticket] = []
+        self.virtual_time = 0.0
+        self._order = itertools.count()
+        self._wake_handle: asyncio.TimerHandle | None = None
+
+    def get_bucket(self, author: str, now: float) -> SenderBucket:
+        bucket = self.buckets.get(author)
+        if bucket is None:
+            bucket = self.buckets[author] = SenderBucket(self.burst, now)
+        if self.rate is not None:
+            bucket.tokens = min(self.burst, bucket.tokens + (now - bucket.last_refill) * self.rate)
+        bucket.last_refill = now
+        return bucket
+
+    def submit(  # noqa: PLR0913 Too many arguments in function definition
+        self,
+        job_id: int,
+        author: str,
+        timestamp: int,
+        cost: int,
+        weight: float = 1.0,
+        *,
+        limit_rate: bool = True,
+    ) -> Ticket:
+        now = self.clock()
+        bucket = self.get_bucket(author, now)
+        ready_at = now
+        if limit_rate and self.rate is not None:
+            # The token is taken even if there are none left, so the sender's next broadcasts wait even longer
+            bucket.tokens -= 1
+            if bucket.tokens < 0:
+                ready_at = now - bucket.tokens / self.rate
+
+        start_tag = max(self.virtual_time, bucket.last_tag)
+        bucket.last_tag = start_tag + max(cost, 1) / weight
+        ticket = Ticket(
+            job_id=job_id,
+            author=author,
+            timestamp=timestamp,
+            cost=cost,
+            start_tag=start_tag,
+            finish_tag=bucket.last_tag,
+            ready_at=ready_at,
+            order=next(self._order),
+            admitted=asyncio.get_running_loop().create_future(),
+        )
+        self.queued.append(ticket)
+        self.admit()
+        return ticket
+
+    def admit(self) -> None:
+        if self._wake_handle is not None:
+            self._wake_handle.cancel()
+            self._wake_handle = None
+
+        now = self.clock()
+        while (self.max_running is None or len(self.running) < self.max_running) and len(self.queued) > 0:
+            ready = [ticket for ticket in self.queued if ticket.ready_at <= now]
+            if len(ready) == 0:
+                # Try again once the first sender has a token back
+                delay = min(ticket.ready_at for ticket in self.queued) - now
+                self._wake_handle = asyncio.get_running_loop().call_later(delay, self.admit)
+                return
+
+            ticket = min(ready, key=lambda ticket: (ticket.finish_tag, ticket.order))
+            self.queued.remove(ticket)
+            self.running.append(ticket)
+            self.virtual_time = max(self.virtual_time, ticket.start_tag)
+            ticket.admitted.set_result(True)
+
+    def finish(self, ticket: Ticket) -> None:
+        if ticket in self.running:
+            self.running.remove(ticket)
+        elif ticket in self.queued:
+            self.queued.remove(ticket)
+        self.admit()
+
+    def cancel(self, author: str, timestamp: int) -> bool:
+        # The broadcast was deleted before it started, it is not sent at all
+        for ticket in self.queued:
+            if ticket.author == author and ticket.timestamp == timestamp:
+                self.queued.remove(ticket)
+                ticket.admitted.set_result(False)
+                self.admit()
+                return True
+        return False
+
+    def is_queued(self, author: str, timestamp: int) -> bool:
+        return any(ticket.author == author and ticket.timestamp == timestamp for ticket in self.queued)
+
+    def queued_ahead(self, ticket: Ticket) -> list[Ticket]:
+        return [other for other in self.queued if (other.finish_tag, other.order) < (ticket.finish_tag, ticket.order)]
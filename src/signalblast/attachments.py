@@ -0,0 +1,122 @@
+from __future__ import annotations
+
+import asyncio
+import base64
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+import aiohttp
+from signalbot.api import GetAttachmentError
+
+if TYPE_CHECKING:
+    from collections.abc import AsyncIterator, Iterator
+
+    from signalbot.api import SignalAPI
+
+# Multiples of 3 and 4, so every chunk is converted to or from base64 on its own
+ENCODE_CHUNK_SIZE = 3 * 64 * 1024
+DECODE_CHUNK_SIZE = 4 * 64 * 1024
+
+# The first bytes of the attachments Signal shows inline, the rest are sent as files
+_CONTENT_TYPES = (
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"GIF8", "image/gif"),
+    (b"RIFF", "image/webp"),
+    (b"%PDF", "application/pdf"),
+    (b"OggS", "audio/ogg"),
+    (b"ID3", "audio/mpeg"),
+)
+
+
+def get_content_type(header: bytes) -> str:
+    if header[4:8] == b"ftyp":
+        return "video/mp4"
+    for magic, content_type in _CONTENT_TYPES:
+        if header.startswith(magic):
+            return content_type
+    return "application/octet-stream"
+
+
+def read_content_type(path: Path) -> str:
+    with path.open("rb") as attachment_file:
+        return get_content_type(attachment_file.read(16))
+
+
+def base64_size(path: Path) -> int:
+    return (path.stat().st_size + 2) // 3 * 4
+
+
+def iter_base64(path: Path) -> Iterator[bytes]:
+    # The chunks are small and the file usually in the page cache, reading them does not stall the event loop
+    with path.open("rb") as attachment_file:
+        while chunk := attachment_file.read(ENCODE_CHUNK_SIZE):
+            yield base64.b64encode(chunk)
+
+
+async def json_with_attachments(head: bytes, attachments: list[Path], tail: bytes) -> AsyncIterator[bytes]:
+    """A json body with a list of base64 attachments between head and tail, encoded while it is being sent.
+    Only one chunk of each attachment is in memory at a time, no matter how big it is or how many are sent."""
+    yield head
+    for i, path in enumerate(attachments):
+        yield b'"' if i == 0 else b', "'
+        for chunk in iter_base64(path):
+            yield chunk
+        yield b'"'
+    yield tail
+
+
+class AttachmentFiles:
+    """The attachments of the broadcasts as files, so they are streamed to signal-cli instead of keeping their
+    base64 in memory for the whole broadcast and once more for each request in flight. They are read from
+    signal-cli's attachments folder when the bot can see it, otherwise they are written to spool_path and
+    deleted with the broadcast."""
+
+    def __init__(self, spool_path: Path, signal_attachments_path: Path | None = None) -> None:
+        self.spool_path = spool_path
+        self.signal_attachments_path = signal_attachments_path
+
+    def path(self, local_filename: str) -> Path:
+        # The ids come from signal-cli, but never read outside the attachment folders
+        filename = Path(local_filename).name
+        if self.signal_attachments_path is not None:
+            signal_path = self.signal_attachments_path / filename
+            if signal_path.is_file():
+                return signal_path
+        return self.spool_path / filename
+
+    @staticmethod
+    def write_base64(path: Path, base64_attachment: str) -> None:
+        with path.open("wb") as attachment_file:
+            for start in range(0, len(base64_attachment), DECODE_CHUNK_SIZE):
+                attachment_file.write(base64.b64decode(base64_attachment[start : start + DECODE_CHUNK_SIZE]))
+
+    async def save(self, local_filename: str, base64_attachment: str) -> Path:
+        path = self.path(local_filename)
+        if not path.is_file():
+            self.spool_path.mkdir(parents=True, exist_ok=True)
+            await asyncio.to_thread(self.write_base64, path, base64_attachment)
+        return path
+
+    async def download(self, signal_api: SignalAPI, local_filename: str) -> Path:
+        # Same as signalbot's get_attachment, but written to the file as it arrives
+        path = self.path(local_filename)
+        if path.is_file():
+            return path
+
+        self.spool_path.mkdir(parents=True, exist_ok=True)
+        uri = f"{signal_api._signal_api_uris.attachment_rest_uri()}/{local_filename}"  # noqa: SLF001
+        try:
+            async with aiohttp.ClientSession() as session, session.get(uri) as resp:
+                resp.raise_for_status()
+                with path.open("wb") as attachment_file:
+                    async for chunk in resp.content.iter_chunked(ENCODE_CHUNK_SIZE):
+                        attachment_file.write(chunk)
+        except aiohttp.ClientError as e:
+            path.unlink(missing_ok=True)
+            raise GetAttachmentError from e
+        return path
+
+    def delete(self, local_filename: str) -> None:
+        # signal-cli's own copy is deleted through signal-cli-rest-api
+        (self.spool_path / Path(local_filename).name).unlink(missing_ok=True)
@@ -0,0 +1,178 @@
+from __future__ import annotations
+
+import json
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING
+
+from signalbot import MessageType
+from signalbot.link_previews import LinkPreview
+
+from signalblast.utils import add_column_if_missing
+
+if TYPE_CHECKING:
+    import sqlite3
+    from collections.abc import Iterable, Iterator
+    from pathlib import Path
+    from threading import Lock
+
+
+@dataclass
+class BroadcastJob:
+    author: str
+    timestamp: int
+    message_type: MessageType
+    message: str
+    attachments_local_filenames: list[str] = field(default_factory=list)
+    link_preview: LinkPreview | None = None
+    view_once: bool = False
+    target_timestamp: int | None = None  # The timestamp of the message to edit or delete
+    job_id: int | None = None
+    # Not persisted, the files of attachments_local_filenames are found or downloaded again when resuming the job
+    attachment_paths: list[Path] | None = None
+
+
+class BroadcastJobStore:
+    """Broadcasts that have not finished yet, with the state of every recipient.
+    The results are checkpointed while broadcasting, so a restart resumes from the recipients still pending."""
+
+    PENDING = 0
+    SENT = 1
+    FAILED = 2
+    _page_size = 1000
+
+    def __init__(self, connection: sqlite3.Connection, lock: Lock) -> None:
+        self.connection = connection
+        self.lock = lock
+
+    def create(self, job: BroadcastJob, recipients: Iterable[tuple[str, str]]) -> None:
+        # The recipients are pairs of subscriber uuid and phone number of the account that sends them the message
+        # Read all the recipients before taking the lock, the sqlite users backend needs it to iterate
+        recipients = list(recipients)
+        with self.lock, self.connection:
+            cursor = self.connection.execute(
+                "INSERT INTO broadcast_jobs (author, timestamp, message_type, message, attachments_local_filenames, "
+                "link_preview, view_once, target_timestamp) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [
+                    job.author,
+                    job.timestamp,
+                    job.message_type.name,
+                    job.message,
+                    json.dumps(job.attachments_local_filenames),
+                    None if job.link_preview is None else job.link_preview.model_dump_json(),
+                    job.view_once,
+                    job.target_timestamp,
+                ],
+            )
+            job.job_id = cursor.lastrowid
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO broadcast_job_recipients (job_id, uuid, state, account) VALUES (?, ?, ?, ?)",
+                ((job.job_id, uuid, self.PENDING, account) for uuid, account in recipients),
+            )
+
+    def unfinished(self) -> list[BroadcastJob]:
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT id, author, timestamp, message_type, message, attachments_local_filenames, link_preview, "
+                "view_once, target_timestamp FROM broadcast_jobs ORDER BY id",
+            ).fetchall()
+        jobs = []
+        for row in rows:
+            job_id, author, timestamp, message_type, message, filenames, link_preview, view_once, target_timestamp = row
+            jobs.append(
+                BroadcastJob(
+                    job_id=job_id,
+                    author=author,
+                    timestamp=timestamp,
+                    message_type=MessageType[message_type],
+                    message=message,
+                    attachments_local_filenames=json.loads(filenames),
+                    link_preview=None if link_preview is None else LinkPreview.model_validate_json(link_preview),
+                    view_once=bool(view_once),
+                    target_timestamp=target_timestamp,
+                ),
+            )
+        return jobs
+
+    def pending_accounts(self, job_id: int) -> list[str | None]:
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT DISTINCT account FROM broadcast_job_recipients WHERE job_id = ? AND state = ?",
+                [job_id, self.PENDING],
+            ).fetchall()
+        return [account for (account,) in rows]
+
+    def pending_recipients(self, job_id: int, account: str | None) -> Iterator[str]:
+        # Jobs created before there were several accounts have no account, the bot's own number sends them
+        last_uuid = ""
+        while True:
+            with self.lock:
+                page = self.connection.execute(
+                    "SELECT uuid FROM broadcast_job_recipients WHERE job_id = ? AND state = ? AND account IS ? "
+                    "AND uuid > ? ORDER BY uuid LIMIT ?",
+                    [job_id, self.PENDING, account, last_uuid, self._page_size],
+                ).fetchall()
+            for (uuid,) in page:
+                yield uuid
+            if len(page) < self._page_size:
+                return
+            last_uuid = page[-1][0]
+
+    def checkpoint(self, job_id: int, results: list[tuple[str, int, int | None]]) -> None:
+        # Each result is the uuid, the new state and the timestamp, which can be missing for the sent ones too
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "UPDATE broadcast_job_recipients SET state = ?, timestamp = ? WHERE job_id = ? AND uuid = ?",
+                ((state, timestamp, job_id, uuid) for uuid, state, timestamp in results),
+            )
+
+    def count(self, job_id: int, state: int | None = None) -> int:
+        with self.lock:
+            if state is None:
+                row = self.connection.execute(
+                    "SELECT COUNT(*) FROM broadcast_job_recipients WHERE job_id = ?",
+                    [job_id],
+                ).fetchone()
+            else:
+                row = self.connection.execute(
+                    "SELECT COUNT(*) FROM broadcast_job_recipients WHERE job_id = ? AND state = ?",
+                    [job_id, state],
+                ).fetchone()
+        return row[0]
+
+    def sent_timestamps(self, job_id: int) -> dict[str, int]:
+        # Without a timestamp the message cannot be edited or deleted
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT uuid, timestamp FROM broadcast_job_recipients "
+                "WHERE job_id = ? AND state = ? AND timestamp IS NOT NULL",
+                [job_id, self.SENT],
+            ).fetchall()
+        return dict(rows)
+
+    def sent_accounts(self, job_id: int) -> dict[str, str | None]:
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT uuid, account FROM broadcast_job_recipients WHERE job_id = ? AND state = ?",
+                [job_id, self.SENT],
+            ).fetchall()
+        return dict(rows)
+
+    def finish(self, job_id: int) -> None:
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM broadcast_job_recipients WHERE job_id = ?", [job_id])
+            self.connection.execute("DELETE FROM broadcast_jobs WHERE id = ?", [job_id])
+
+    @staticmethod
+    def load(connection: sqlite3.Connection, lock: Lock) -> BroadcastJobStore:
+        with lock, connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS broadcast_jobs (id INTEGER PRIMARY KEY, author TEXT, timestamp INTEGER, "
+                "message_type TEXT, message TEXT, attachments_local_filenames TEXT, link_preview TEXT, "
+                "view_once INTEGER, target_timestamp INTEGER)",
+            )
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS broadcast_job_recipients (job_id INTEGER, uuid TEXT, state INTEGER, "
+                "timestamp INTEGER, PRIMARY KEY (job_id, uuid))",
+            )
+            add_column_if_missing(connection, "broadcast_job_recipients", "account", "TEXT")
+        return BroadcastJobStore(connection, lock)
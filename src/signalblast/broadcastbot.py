@@ -1,27 +1,44 @@
-from collections.abc import Callable
-from datetime import datetime, timedelta, timezone
+import asyncio
+from collections.abc import AsyncIterator, Callable, Coroutine
 from logging import Logger
+from pathlib import Path
 from threading import Lock
-from typing import TYPE_CHECKING
+from typing import TYPE_CHECKING, Any, TypeVar
 
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from signalbot import Command, Message, SignalBot
 from signalbot import Context as ChatContext
+from signalbot.api import SignalAPI
+from signalbot.link_previews import LinkPreview
 
+from signalblast.accounts import SenderAccount, SendResult, assign_account
 from signalblast.admin import Admin
+from signalblast.attachments import AttachmentFiles, base64_size
+from signalblast.broadcast_jobs import BroadcastJobStore
+from signalblast.delivery_health import DeliveryHealthStore
+from signalblast.jsonrpc import JsonRpcClient, JsonRpcSignalAPI
 from signalblast.message_handler import MessageHandler
+from signalblast.metrics import Metrics
+from signalblast.outbound import Lane, OutboundScheduler
+from signalblast.receipts import READ, ReceiptStore
+from signalblast.send_pacer import SendPacer
+from signalblast.sqlite_users import SqliteUsers
+from signalblast.timestamp_store import TimestampStore
 from signalblast.users import Users
-from signalblast.utils import TimestampData, get_code_data_path
+from signalblast.utils import get_code_data_path
 
 if TYPE_CHECKING:
     from asyncio import Task
 
     from apscheduler.job import Job
 
+T = TypeVar("T")
+
 
 class BroadcasBot:
     subscribers_data_path = get_code_data_path() / "subscribers.csv"
     banned_users_data_path = get_code_data_path() / "banned_users.csv"
+    attachments_spool_path = get_code_data_path() / "attachments"
 
     def __init__(self, config: dict) -> None:
         self._bot = SignalBot(config)
@@ -29,10 +46,18 @@ class BroadcasBot:
         self.last_msg_user_uuid: str | None = None
         self.health_check_task: Task | None = None
         self.log_rollover_task: Task | None = None
+        self.resume_broadcasts_task: Task | None = None
+        self.event_loop_lag_task: Task | None = None
+        self.delivery_tasks: list[Task] = []
+        self.receipt_tasks: list[Task] = []
+        self.jsonrpc_client: JsonRpcClient | None = None
+        self.metrics = Metrics()
+        self.attachment_bytes_sent = 0
+        self.attachment_bytes_saved = 0
 
         # Type hint the other attributes that will get defined in load_data
-        self.subscribers: Users
-        self.banned_users: Users
+        self.subscribers: Users | SqliteUsers
+        self.banned_users: Users | SqliteUsers
         self.admin: Admin
         self.message_handler: MessageHandler
         self.help_message: str
@@ -44,6 +69,14 @@ class BroadcasBot:
         self.expiration_time: int
         self.welcome_message: str
         self.storage_lock: Lock
+        self.send_pacer: SendPacer
+        self.accounts: list[SenderAccount]
+        self.timestamp_store: TimestampStore
+        self.broadcast_jobs: BroadcastJobStore
+        self.delivery_health: DeliveryHealthStore
+        self.receipts: ReceiptStore
+        self.outbound: OutboundScheduler
+        self.attachment_files: AttachmentFiles
 
     async def send(  # noqa: PLR0913 Too many arguments in function definition
         self,
@@ -51,7 +84,7 @@ class BroadcasBot:
         text: str,
         *,
         base64_attachments: list | None = None,
-        link_preview: dict | None = None,
+        link_preview: LinkPreview | None = None,
         quote_author: str | None = None,
         quote_mentions: list | None = None,
         quote_message: str | None = None,
@@ -60,22 +93,192 @@ class BroadcasBot:
         edit_timestamp: int | None = None,
         text_mode: str | None = None,
         view_once: bool = False,
-    ) -> str:
-        return await self._bot.send(
-            receiver=receiver,
-            text=text,
-            base64_attachments=base64_attachments,
-            link_preview=link_preview,
-            quote_author=quote_author,
-            quote_mentions=quote_mentions,
-            quote_message=quote_message,
-            quote_timestamp=quote_timestamp,
-            mentions=mentions,
-            edit_timestamp=edit_timestamp,
-            text_mode=text_mode,
-            view_once=view_once,
+        account: SenderAccount | None = None,
+        lane: Lane | None = None,
+        attachment_paths: list[Path] | None = None,
+    ) -> int:
+        self.count_attachment_bytes(base64_attachments, num_receivers=1, attachment_paths=attachment_paths)
+        if lane is None:
+            lane = self.get_lane(receiver)
+        is_other_account = account is not None and account is not self.accounts[0]
+        if is_other_account or lane == Lane.BULK or attachment_paths:
+            # The broadcasts never quote or mention, the accounts send them telling which failures are down to the
+            # receiver, and stream the attachments from their files
+            sender = self.accounts[0] if account is None else account
+            return await self.send_in_lane(
+                Lane.BULK if is_other_account else lane,
+                lambda: sender.send(
+                    receiver,
+                    text,
+                    base64_attachments=base64_attachments,
+                    link_preview=link_preview,
+                    edit_timestamp=edit_timestamp,
+                    view_once=view_once,
+                    attachment_paths=attachment_paths,
+                ),
+            )
+
+        return await self.send_in_lane(
+            lane,
+            lambda: self._bot.send(
+                receiver=receiver,
+                text=text,
+                base64_attachments=base64_attachments,
+                link_preview=link_preview,
+                quote_author=quote_author,
+                quote_mentions=quote_mentions,
+                quote_message=quote_message,
+                quote_timestamp=quote_timestamp,
+                mentions=mentions,
+                edit_timestamp=edit_timestamp,
+                text_mode=text_mode,
+                view_once=view_once,
+            ),
         )
 
+    def get_lane(self, receiver: str) -> Lane:
+        # Only the broadcasts are sent in the bulk lane, and they say so
+        if self.admin.admin_id is not None and receiver == self.admin.admin_id:
+            return Lane.ADMIN
+        return Lane.INTERACTIVE
+
+    async def send_in_lane(self, lane: Lane, send: Callable[[], Coroutine[Any, Any, T]]) -> T:
+        async with self.outbound.slot(lane):
+            if lane == Lane.BULK:
+                # The broadcasts wait for the send pacer of their account before getting here
+                return await send()
+
+            # Replies do not wait for the send pacer, the broadcasts of the bot's number make room for them instead
+            self.send_pacer.take()
+            try:
+                return await send()
+            except Exception as e:
+                self.send_pacer.on_failure(e)
+                raise
+
+    async def send_to_many(  # noqa: PLR0913 Too many arguments in function definition
+        self,
+        receivers: list[str],
+        text: str,
+        *,
+        base64_attachments: list | None = None,
+        link_preview: LinkPreview | None = None,
+        edit_timestamp: int | None = None,
+        view_once: bool = False,
+        account: SenderAccount | None = None,
+        attachment_paths: list[Path] | None = None,
+    ) -> SendResult:
+        if account is None:
+            account = self.accounts[0]
+        self.count_attachment_bytes(base64_attachments, len(receivers), attachment_paths)
+        return await self.send_in_lane(
+            Lane.BULK,
+            lambda: account.send_to_many(
+                receivers,
+                text,
+                base64_attachments=base64_attachments,
+                link_preview=link_preview,
+                edit_timestamp=edit_timestamp,
+                view_once=view_once,
+                attachment_paths=attachment_paths,
+            ),
+        )
+
+    def count_attachment_bytes(
+        self,
+        base64_attachments: list | None,
+        num_receivers: int,
+        attachment_paths: list[Path] | None = None,
+    ) -> None:
+        if not base64_attachments and not attachment_paths:
+            return
+        num_bytes = sum(len(attachment) for attachment in base64_attachments or [])
+        num_bytes += sum(base64_size(path) for path in attachment_paths or [])
+        self.attachment_bytes_sent += num_bytes
+        self.attachment_bytes_saved += num_bytes * (num_receivers - 1)
+
+    async def remote_delete(self, receiver: str, timestamp: int, account: SenderAccount | None = None) -> int:
+        if account is not None and account is not self.accounts[0]:
+            return await self.send_in_lane(Lane.BULK, lambda: account.remote_delete(receiver, timestamp))
+        return await self.send_in_lane(Lane.BULK, lambda: self._bot.remote_delete(receiver, timestamp))
+
+    def add_account(self, phone_number: str, signal_service: str, send_pacer: SendPacer) -> None:
+        # The bot's own number stays the first account, it is the only one receiving the commands
+        if self.jsonrpc_client is not None and signal_service == self._bot._signal_service:  # noqa: SLF001
+            signal_api = JsonRpcSignalAPI(signal_service, phone_number, self.jsonrpc_client, download_attachments=False)
+        else:
+            signal_api = SignalAPI(signal_service, phone_number, download_attachments=False)
+        self.accounts.append(SenderAccount(phone_number, signal_api, send_pacer))
+
+    def account_for(self, subscriber: str) -> SenderAccount:
+        return assign_account(subscriber, self.accounts)
+
+    def get_account(self, phone_number: str | None) -> SenderAccount:
+        # Messages sent before there were several accounts have no phone number, they came from the bot's own
+        for account in self.accounts:
+            if account.phone_number == phone_number:
+                return account
+        if phone_number is not None:
+            default_number = self.accounts[0].phone_number
+            self.logger.warning("Account %s is not configured anymore, using %s", phone_number, default_number)
+        return self.accounts[0]
+
+    def count_receipt(self, raw_message: str) -> None:
+        try:
+            receipt_type = self.receipts.ingest(raw_message)
+        except Exception:
+            self.logger.exception("Could not read the receipt in %s", raw_message)
+            return
+        if receipt_type != 0:
+            self.metrics.receipts.inc("read" if receipt_type == READ else "delivered")
+
+    def count_receipts_before_parsing(self) -> None:
+        # signalbot skips the receipts when it parses the messages, so they are taken from the raw messages before
+        receive = self._bot._signal.receive  # noqa: SLF001
+
+        async def receive_and_count_receipts() -> AsyncIterator[str]:
+            async for raw_message in receive():
+                self.count_receipt(raw_message)
+                yield raw_message
+
+        self._bot._signal.receive = receive_and_count_receipts  # noqa: SLF001
+
+    async def receive_receipts(self, account: SenderAccount) -> None:
+        # The other accounts only send, nothing else reads their messages but the receipts are still counted
+        while True:
+            try:
+                if await account.signal_api.check_signal_service():
+                    async for raw_message in account.signal_api.receive():
+                        self.count_receipt(raw_message)
+            except Exception:  # noqa: BLE001 Keep receiving after any error
+                self.logger.warning("Stopped receiving the receipts of %s, retrying", account.phone_number)
+            await asyncio.sleep(1)
+
+    async def save_attachment(self, attachment_id: str, base64_attachment: str | None = None) -> Path:
+        # Downloaded again from signal-cli if it was not received with the message
+        if base64_attachment is None:
+            return await self.attachment_files.download(self._bot._signal, attachment_id)  # noqa: SLF001
+        return await self.attachment_files.save(attachment_id, base64_attachment)
+
+    async def delete_attachment(self, attachment_filename: str) -> None:
+        self.attachment_files.delete(attachment_filename)
+        await self._bot.delete_attachment(attachment_filename)
+
+    async def wait_for_signal_service(self) -> None:
+        # Also sets whether signal-cli is reached over http or https, which the bot only does once started
+        for account in self.accounts:
+            while not await account.signal_api.check_signal_service():
+                self.logger.warning("Cannot connect to the signal-cli-rest-api of %s, retrying", account.phone_number)
+                await asyncio.sleep(1)
+
+    async def is_signal_service_reachable(self) -> bool:
+        try:
+            for account in self.accounts:
+                await account.signal_api.health_check()
+        except Exception:  # noqa: BLE001 Any error means it cannot be reached
+            return False
+        return True
+
     def register(
         self,
         command: Command,
@@ -93,16 +296,59 @@ class BroadcasBot:
     def scheduler(self) -> AsyncIOScheduler:
         return self._bot.scheduler
 
-    async def load_data(
+    async def load_data(  # noqa: PLR0913 Too many arguments in function definition
         self,
         logger: Logger,
         admin_pass: str | None,
         expiration_time: int | None,
         welcome_message: str | None = None,
         instructions_url: str | None = None,
+        send_pacer: SendPacer | None = None,
+        users_backend: str = "csv",
+        signal_cli_jsonrpc: str | None = None,
+        outbound_slots: int = 32,
+        reserved_slots: int = 4,
+        signal_attachments_dir: str | None = None,
     ) -> None:
-        self.subscribers = await Users.load_from_file(self.subscribers_data_path)
-        self.banned_users = await Users.load_from_file(self.banned_users_data_path)
+        self.attachment_files = AttachmentFiles(
+            self.attachments_spool_path,
+            None if signal_attachments_dir is None else Path(signal_attachments_dir),
+        )
+        self.outbound = OutboundScheduler(outbound_slots, reserved_slots, self.metrics.outbound_queue_wait)
+        if signal_cli_jsonrpc is not None:
+            # Send straight to the signal-cli daemon instead of through signal-cli-rest-api
+            self.jsonrpc_client = JsonRpcClient(signal_cli_jsonrpc)
+            self._bot._signal = JsonRpcSignalAPI(  # noqa: SLF001
+                self._bot._signal_service,  # noqa: SLF001
+                self._bot._phone_number,  # noqa: SLF001
+                self.jsonrpc_client,
+                self._bot._signal.download_attachments,  # noqa: SLF001
+            )
+
+        self.storage_lock = Lock()
+        self.timestamp_store = TimestampStore.load(self._bot.storage._sqlite, self.storage_lock)  # noqa: SLF001
+        self.broadcast_jobs = BroadcastJobStore.load(self._bot.storage._sqlite, self.storage_lock)  # noqa: SLF001
+        self.delivery_health = DeliveryHealthStore.load(self._bot.storage._sqlite, self.storage_lock)  # noqa: SLF001
+        self.receipts = ReceiptStore.load(self._bot.storage._sqlite, self.storage_lock, self.timestamp_store)  # noqa: SLF001
+        self.count_receipts_before_parsing()
+
+        if users_backend == "sqlite":
+            connection = self._bot.storage._sqlite  # noqa: SLF001
+            self.subscribers = await SqliteUsers.load_from_file(
+                connection,
+                "subscribers",
+                self.subscribers_data_path,
+                self.storage_lock,
+            )
+            self.banned_users = await SqliteUsers.load_from_file(
+                connection,
+                "banned_users",
+                self.banned_users_data_path,
+                self.storage_lock,
+            )
+        else:
+            self.subscribers = await Users.load_from_file(self.subscribers_data_path)
+            self.banned_users = await Users.load_from_file(self.banned_users_data_path)
 
         self.admin = await Admin.load_from_file(admin_pass)
         self.message_handler = MessageHandler()
@@ -129,13 +375,27 @@ class BroadcasBot:
 
         self.expiration_time = expiration_time
 
-        self.storage_lock = Lock()
+        self.send_pacer = SendPacer() if send_pacer is None else send_pacer
+        self.accounts = [SenderAccount(self._bot._phone_number, self._bot._signal, self.send_pacer)]  # noqa: SLF001
+
+        self.metrics.add_gauge("signalblast_subscribers", "Number of subscribers.", lambda: {(): len(self.subscribers)})
+        self.metrics.add_gauge(
+            "signalblast_banned_users",
+            "Number of banned users.",
+            lambda: {(): len(self.banned_users)},
+        )
+        self.metrics.add_gauge(
+            "signalblast_outbound_queued",
+            "Requests to signal-cli waiting for a free slot, by lane.",
+            self.outbound.num_queued,
+            ("lane",),
+        )
 
         self.logger = logger
         self.logger.debug("BotAnswers is initialised")
 
     async def reply_with_warn_on_failure(self, ctx: ChatContext, message: str) -> bool:
-        if await ctx.reply(message):
+        if await self.send_in_lane(self.get_lane(ctx.message.source_uuid), lambda: ctx.reply(message)):
             return True
         self.logger.warning("Could not send message to %s", ctx.message.source_uuid)
         return False
@@ -162,17 +422,28 @@ class BroadcasBot:
     async def set_group_expiration_time(self, group_id: str, expiration_in_seconds: int) -> None:
         await self._bot.update_group(group_id, expiration_in_seconds=expiration_in_seconds)
 
+    async def shutdown(self) -> None:
+        # Stop the delivery worker processes, the batches they were sending are queued again on the next start
+        for task in self.delivery_tasks + self.receipt_tasks:
+            task.cancel()
+        await asyncio.gather(*self.delivery_tasks, *self.receipt_tasks, return_exceptions=True)
+
+        # Write the snapshots and the changes that were waiting to be coalesced with others
+        await self.subscribers.flush()
+        await self.banned_users.flush()
+        self.delivery_health.flush()
+        self.receipts.flush()
+        self.logger.info("Pending changes written to disk")
+
+        if self.jsonrpc_client is not None:
+            await self.jsonrpc_client.close()
+
     async def delete_old_timestamps(self) -> None:
         """Signal only allows editing messges within 24 hours.
         No point in keeping the information for older messages"""
-        cursor = self._bot.storage._sqlite.execute("SELECT key FROM signalbot")  # noqa: SLF001
-        keys = [row[0] for row in cursor.fetchall()]
-        for key in keys:
-            value = TimestampData.model_validate(self._bot.storage.read(key))
-            if datetime.fromtimestamp(value.timestamp / 1000, tz=timezone.utc) < (
-                datetime.now(tz=timezone.utc) - timedelta(days=1)
-            ):
-                self.storage_lock.acquire()
-                self._bot.storage.delete(key)
-                self.storage_lock.release()
-                self.logger.info("Deleted expired key with timestamp: %s", value.timestamp)
+        num_deleted = self.timestamp_store.delete_expired()
+        if num_deleted > 0:
+            self.logger.info("Deleted %d expired broadcast timestamps", num_deleted)
+        num_deleted = self.receipts.delete_expired()
+        if num_deleted > 0:
+            self.logger.info("Deleted %d expired broadcast receipts", num_deleted)
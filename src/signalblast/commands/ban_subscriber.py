@@ -1,8 +1,8 @@
-from signalbot import Command, regex_triggered
+from signalbot import Command
 from signalbot import Context as ChatContext
 
 from signalblast.broadcastbot import BroadcasBot
-from signalblast.commands_strings import AdminCommandStrings, CommandRegex
+from signalblast.commands_strings import AdminCommandStrings
 
 
 class BanSubscriber(Command):
@@ -10,7 +10,6 @@ class BanSubscriber(Command):
         super().__init__()
         self.broadcastbot = bot
 
-    @regex_triggered(CommandRegex.ban_subscriber)
     async def handle(self, ctx: ChatContext) -> None:
         try:
             await ctx.receipt(receipt_type="read")
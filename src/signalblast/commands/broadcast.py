@@ -1,191 +1,825 @@
 import asyncio
 import contextlib
-import random
-from collections import defaultdict
-from re import Pattern
+import logging
+import time
+from collections import Counter
+from collections.abc import Callable, Coroutine, Iterator, Mapping
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, TypeVar
 
 from signalbot import Command, MessageType
 from signalbot import Context as ChatContext
 
+from signalblast.accounts import SENT_WITHOUT_TIMESTAMP, SenderAccount, SendResult
+from signalblast.admission import BroadcastAdmission, Ticket
+from signalblast.broadcast_jobs import BroadcastJob, BroadcastJobStore
 from signalblast.broadcastbot import BroadcasBot
-from signalblast.commands_strings import CommandRegex, PublicCommandStrings
-from signalblast.utils import TimestampData
+from signalblast.commands_strings import PublicCommandStrings
+from signalblast.delivery_health import (
+    RECIPIENT_FAILURES,
+    get_error_class,
+    is_recipient_failure,
+    is_retryable_error,
+)
+from signalblast.delivery_queue import DeliveryQueue
+from signalblast.outbound import Lane
+from signalblast.send_pacer import is_rate_limit_error
+from signalblast.utils import TimestampData, batched
+
+T = TypeVar("T")
+
+
+@dataclass
+class BroadcastProgress:
+    job: BroadcastJob
+    num_recipients: int
+    num_sent: int = 0
+    num_failed: int = 0
+    # Results not checkpointed yet, subscriber uuid and timestamp or None if it failed
+    pending_results: list[tuple[str, int, int | None]] = field(default_factory=list)
+    last_update: float = field(default_factory=time.monotonic)
+    # Number of failures by error class, logged once the broadcast finishes instead of one line each
+    errors: Counter[str] = field(default_factory=Counter)
+
+    @property
+    def num_done(self) -> int:
+        return self.num_sent + self.num_failed
 
 
 class Broadcast(Command):
     MAX_FAILED_MSGS = 10
-
-    def __init__(self, bot: BroadcasBot) -> None:
+    PROGRESS_LOG_INTERVAL = 100
+    MAX_LOGGED_TRACEBACKS = 3
+    CHECKPOINT_INTERVAL = 50
+    QUEUE_POLL_INTERVAL = 0.2
+    BATCH_ATTEMPTS = 3
+    # The admin's broadcasts count as half as many recipients when deciding which queued broadcast goes first
+    ADMIN_WEIGHT = 2.0
+
+    def __init__(  # noqa: PLR0913 Too many arguments in function definition
+        self,
+        bot: BroadcasBot,
+        num_send_workers: int = 4,
+        send_batch_size: int = 100,
+        num_modify_workers: int = 16,
+        delivery_queue: DeliveryQueue | None = None,
+        recipient_log_interval: int = 100,
+        admission: BroadcastAdmission | None = None,
+    ) -> None:
         super().__init__()
         self.broadcastbot = bot
-        self.subscribers_num_fails: dict[str, int] = defaultdict(lambda: 0)
-
-    def is_valid_command(self, message: str, invalid_command: Pattern) -> bool:
-        return any(regex != invalid_command and regex.search(message) is not None for regex in CommandRegex)
-
-    async def check_send_tasks_results(self, send_tasks: list[asyncio.Task | None], action_str: str) -> dict[str, int]:
-        timestamp_data = {}
-        for send_task, subscriber in zip(send_tasks, self.broadcastbot.subscribers, strict=False):
-            if send_task is not None:
-                try:
-                    timestamp_data[subscriber] = send_task.result()
-                    self.subscribers_num_fails.pop(subscriber, None)
-                    self.broadcastbot.logger.info("Message successfully %s %s", action_str, subscriber)
-                except Exception:
-                    self.subscribers_num_fails[subscriber] += 1
-                    self.broadcastbot.logger.exception("Message not %s %s", action_str, subscriber)
-
-        subscribers_to_remove = []
-        for subscriber, num_fails in self.subscribers_num_fails.items():
-            if num_fails >= Broadcast.MAX_FAILED_MSGS:
-                subscribers_to_remove.append(subscriber)
-                await self.broadcastbot.subscribers.remove(subscriber)
-
-                remove_message = "The bot is having problems sending you messages. "
-                remove_message += "You have been removed from the list. "
-                remove_message += "Please update signal, remove old linked devices and try subscribing again."
-                with contextlib.suppress(Exception):
-                    # Most likely will fail to send the message but try anyway
-                    await self.broadcastbot.send(subscriber, remove_message)
-
-        for subscriber in subscribers_to_remove:
-            del self.subscribers_num_fails[subscriber]
-
-        return timestamp_data
+        self.num_send_workers = num_send_workers
+        self.num_modify_workers = num_modify_workers
+        # Subscribers that get the same message in a single signal-cli request, 1 sends one request each
+        self.send_batch_size = send_batch_size
+        # When set, the messages are sent by the delivery worker processes instead of this one
+        self.delivery_queue = delivery_queue
+        # Only one in this many results is logged for each recipient, or all of them when debugging
+        self.recipient_log_interval = recipient_log_interval
+        self.in_progress: dict[int, BroadcastProgress] = {}
+        # When set, new broadcasts wait for their turn instead of all being sent at the same time
+        self.admission = admission
+        self.queued_tasks: set[asyncio.Task] = set()
+        bot.metrics.add_gauge(
+            "signalblast_failing_subscribers",
+            "Subscribers by number of consecutive messages that could not be sent to them.",
+            self.count_failing_subscribers,
+            ("failures",),
+        )
+        if admission is not None:
+            bot.metrics.add_gauge(
+                "signalblast_broadcasts_queued",
+                "New broadcasts waiting for their turn to be sent.",
+                lambda: {(): len(admission.queued)},
+            )
 
-    async def broadcast(self, ctx: ChatContext) -> None:  # noqa: C901, PLR0915, PLR0912 function is too complex
-        broadcast_timestamps: dict[str, int] = {}
-        num_subscribers = -1
-        attachments_deleted = False
-        send_tasks_checked = False
-        timestamp_data_saved = False
-        send_tasks: list[asyncio.Task | None] = []
-        action_str, acting_str = "sent to", "sending"
+    def count_failing_subscribers(self) -> dict[tuple[str, ...], float]:
+        failure_streaks = Counter(self.broadcastbot.delivery_health.failure_streaks())
+        return {(str(failure_streak),): count for failure_streak, count in failure_streaks.items()}
+
+    @staticmethod
+    def get_action(job: BroadcastJob) -> str:
+        if job.message_type == MessageType.DELETE_MESSAGE:
+            return "delete"
+        if job.message_type == MessageType.EDIT_MESSAGE:
+            return "edit"
+        return "send"
+
+    async def paced_send(self, send_coroutine: Coroutine[Any, Any, T], action: str, account: SenderAccount) -> T:
+        send_pacer = account.send_pacer
+        start = time.monotonic()
+        try:
+            result = await send_coroutine
+        except Exception as e:
+            send_pacer.on_failure(e)
+            raise
+        finally:
+            self.broadcastbot.metrics.send_latency.observe(time.monotonic() - start, action)
+        rate_limit_error = result.get_rate_limit_error() if isinstance(result, SendResult) else None
+        if rate_limit_error is None:
+            send_pacer.on_success()
+        else:
+            send_pacer.on_failure(rate_limit_error)
+        return result
+
+    async def remove_failing_subscriber(self, subscriber: str) -> None:
+        # Start from scratch if they subscribe again
+        self.broadcastbot.delivery_health.forget(subscriber)
+        if subscriber not in self.broadcastbot.subscribers:
+            return
+        await self.broadcastbot.subscribers.remove(subscriber)
+
+        remove_message = "The bot is having problems sending you messages. "
+        remove_message += "You have been removed from the list. "
+        remove_message += "Please update signal, remove old linked devices and try subscribing again."
+        with contextlib.suppress(Exception):
+            # Most likely will fail to send the message but try anyway
+            await self.broadcastbot.send(subscriber, remove_message)
+
+    async def record_send_result(  # noqa: PLR0913 Too many arguments in function definition
+        self,
+        progress: BroadcastProgress,
+        subscriber: str,
+        timestamp: int | None,
+        action_str: str,
+        error_class: str | None = None,
+        *,
+        is_rate_limited: bool = False,
+    ) -> None:
+        delivery_health = self.broadcastbot.delivery_health
+        failure_streak = 0
+        is_sent = timestamp is not None or error_class == SENT_WITHOUT_TIMESTAMP
+        if is_sent:
+            delivery_health.record_success(subscriber)
+        elif not is_rate_limited and is_recipient_failure(error_class):
+            # Being rate limited, timeouts or signal-cli being down say nothing about the subscriber
+            failure_streak = delivery_health.record_failure(subscriber, error_class or "Unknown")
+
+        state = BroadcastJobStore.SENT if is_sent else BroadcastJobStore.FAILED
+        progress.pending_results.append((subscriber, state, timestamp))
+        progress.last_update = time.monotonic()
+        if len(progress.pending_results) >= Broadcast.CHECKPOINT_INTERVAL:
+            self.checkpoint(progress)
+
+        result = "success" if is_sent else "failure"
+        self.broadcastbot.metrics.messages.inc(self.get_action(progress.job), result)
+
+        if is_sent:
+            progress.num_sent += 1
+        else:
+            progress.num_failed += 1
+            progress.errors[error_class or "Unknown"] += 1
+            if failure_streak >= Broadcast.MAX_FAILED_MSGS:
+                await self.remove_failing_subscriber(subscriber)
+
+        is_sampled = self.recipient_log_interval > 0 and progress.num_done % self.recipient_log_interval == 0
+        log_level = logging.INFO if is_sampled else logging.DEBUG
+        if is_sent:
+            self.broadcastbot.logger.log(log_level, "Message successfully %s %s", action_str, subscriber)
+        else:
+            self.broadcastbot.logger.log(log_level, "Message not %s %s: %s", action_str, subscriber, error_class)
+
+        if progress.num_done % Broadcast.PROGRESS_LOG_INTERVAL == 0:
+            self.broadcastbot.logger.info(
+                "Progress %s: %d out of %d done, %d failed",
+                action_str,
+                progress.num_done,
+                progress.num_recipients,
+                progress.num_failed,
+            )
 
+    async def send_one(
+        self,
+        subscriber: str,
+        account: SenderAccount,
+        send: Callable[[str, SenderAccount], Coroutine[Any, Any, int]],
+        progress: BroadcastProgress,
+        action_str: str,
+    ) -> None:
+        # Avoid rate limiting by pacing the messages, the pace adapts to signal-cli's responses
+        await account.send_pacer.acquire()
+        error_class, is_rate_limited = None, False
         try:
-            subscriber_uuid = ctx.message.source_uuid
-            if subscriber_uuid in self.broadcastbot.banned_users:
-                await self.broadcastbot.send(subscriber_uuid, "This number is not allowed to send messages")
-                self.broadcastbot.logger.info("%s tried to broadcast but they are banned", subscriber_uuid)
+            timestamp = await self.paced_send(send(subscriber, account), self.get_action(progress.job), account)
+        except Exception as e:
+            # The first tracebacks are usually enough to tell what is wrong, the rest are counted in the summary
+            if progress.num_failed < Broadcast.MAX_LOGGED_TRACEBACKS:
+                self.broadcastbot.logger.exception("Message not %s %s", action_str, subscriber)
+            else:
+                self.broadcastbot.logger.debug("Message not %s %s", action_str, subscriber, exc_info=True)
+            timestamp = None
+            error_class, is_rate_limited = get_error_class(e), is_rate_limit_error(e)
+        await self.record_send_result(
+            progress,
+            subscriber,
+            timestamp,
+            action_str,
+            error_class,
+            is_rate_limited=is_rate_limited,
+        )
+
+    async def send_worker(
+        self,
+        recipients: Iterator[str],
+        account: SenderAccount,
+        send: Callable[[str, SenderAccount], Coroutine[Any, Any, int]],
+        progress: BroadcastProgress,
+        action_str: str,
+    ) -> None:
+        # All the workers of an account share the same iterator, so every recipient is only handled by one worker
+        for subscriber in recipients:
+            await self.send_one(subscriber, account, send, progress, action_str)
+
+    async def send_batch_worker(  # noqa: PLR0913 Too many arguments in function definition
+        self,
+        recipient_batches: Iterator[list[str]],
+        account: SenderAccount,
+        send_many: Callable[[list[str], SenderAccount], Coroutine[Any, Any, SendResult]],
+        send: Callable[[str, SenderAccount], Coroutine[Any, Any, int]],
+        progress: BroadcastProgress,
+        action_str: str,
+    ) -> None:
+        for batch in recipient_batches:
+            if len(batch) == 1:
+                await self.send_one(batch[0], account, send, progress, action_str)
+            else:
+                await self.send_batch(batch, account, send_many, send, progress, action_str)
+
+    async def send_batch(  # noqa: PLR0913 Too many arguments in function definition
+        self,
+        batch: list[str],
+        account: SenderAccount,
+        send_many: Callable[[list[str], SenderAccount], Coroutine[Any, Any, SendResult]],
+        send: Callable[[str, SenderAccount], Coroutine[Any, Any, int]],
+        progress: BroadcastProgress,
+        action_str: str,
+    ) -> None:
+        for attempt in range(1, Broadcast.BATCH_ATTEMPTS + 1):
+            # Signal rate limits every delivered message, not every request
+            await account.send_pacer.acquire(len(batch))
+            try:
+                result = await self.paced_send(send_many(batch, account), self.get_action(progress.job), account)
+                break
+            except Exception as e:
+                # Nobody got it when signal-cli rejected or never got the request, the whole batch can go again
+                if attempt < Broadcast.BATCH_ATTEMPTS and is_retryable_error(e):
+                    self.broadcastbot.logger.warning("Batch of %d not %s, retrying: %s", len(batch), action_str, e)
+                    continue
+                # Otherwise some may have got it already, better to miss a message than to send it twice
+                self.broadcastbot.logger.exception("Batch of %d not %s", len(batch), action_str)
+                error_class, is_rate_limited = get_error_class(e), is_rate_limit_error(e)
+                for subscriber in batch:
+                    await self.record_send_result(
+                        progress,
+                        subscriber,
+                        None,
+                        action_str,
+                        error_class,
+                        is_rate_limited=is_rate_limited,
+                    )
                 return
 
-            if subscriber_uuid not in self.broadcastbot.subscribers:
-                await self.broadcastbot.send(subscriber_uuid, self.broadcastbot.must_subscribe_message)
-                self.broadcastbot.logger.info("%s tried to broadcast but they are not subscribed", subscriber_uuid)
-                return
+        for subscriber in batch:
+            if subscriber in result.failed:
+                continue
+            if result.timestamp is None:
+                await self.record_send_result(progress, subscriber, None, action_str, SENT_WITHOUT_TIMESTAMP)
+            else:
+                await self.record_send_result(progress, subscriber, result.timestamp, action_str)
 
-            num_subscribers = len(self.broadcastbot.subscribers)
+        # Only the recipients signal-cli could not send to are tried again, unless it would fail the same way
+        for subscriber, failure_type in result.failed.items():
+            if failure_type in RECIPIENT_FAILURES:
+                await self.record_send_result(progress, subscriber, None, action_str, failure_type)
+            else:
+                await self.send_one(subscriber, account, send, progress, action_str)
+
+    async def send_to_all(
+        self,
+        send: Callable[[str, SenderAccount], Coroutine[Any, Any, int]],
+        progress: BroadcastProgress,
+        action_str: str,
+        send_many: Callable[[list[str], SenderAccount], Coroutine[Any, Any, SendResult]] | None = None,
+        to_modify_timestamps: Mapping[str, int] | None = None,
+    ) -> None:
+        job_store = self.broadcastbot.broadcast_jobs
+        if self.delivery_queue is not None:
+            await self.send_through_queue(progress, action_str, use_send_many=send_many is not None)
+            return
 
-            message = self.broadcastbot.message_handler.remove_command_from_message(
-                ctx.message.text,
-                PublicCommandStrings.broadcast,
+        # Edits and deletes only go to the people that got the message, they can use more workers
+        is_modify = progress.job.target_timestamp is not None
+        num_workers = self.num_modify_workers if is_modify else self.num_send_workers
+
+        # Every account has its own rate limit, so each one sends to its share of the subscribers in parallel
+        workers = []
+        for phone_number in job_store.pending_accounts(progress.job.job_id):
+            account = self.broadcastbot.get_account(phone_number)
+            recipients = job_store.pending_recipients(progress.job.job_id, phone_number)
+            if send_many is None or self.send_batch_size <= 1:
+                workers.extend(
+                    self.send_worker(recipients, account, send, progress, action_str) for _ in range(num_workers)
+                )
+            else:
+                recipient_batches = self.batch_recipients(recipients, to_modify_timestamps or {})
+                workers.extend(
+                    self.send_batch_worker(recipient_batches, account, send_many, send, progress, action_str)
+                    for _ in range(num_workers)
+                )
+        await asyncio.gather(*workers)
+
+    def batch_recipients(
+        self,
+        recipients: Iterator[str],
+        to_modify_timestamps: Mapping[str, int],
+    ) -> Iterator[list[str]]:
+        """Batches of up to send_batch_size recipients. An edit is sent with the timestamp of the message it edits,
+        so only the subscribers that got the original message in the same request can share an edit request."""
+        if len(to_modify_timestamps) == 0:
+            yield from batched(recipients, self.send_batch_size)
+            return
+
+        batches: dict[int | None, list[str]] = {}
+        for subscriber in recipients:
+            target_timestamp = to_modify_timestamps.get(subscriber)
+            batch = batches.setdefault(target_timestamp, [])
+            batch.append(subscriber)
+            if len(batch) == self.send_batch_size:
+                del batches[target_timestamp]
+                yield batch
+        yield from batches.values()
+
+    async def record_queue_results(self, progress: BroadcastProgress, action_str: str) -> int:
+        results = await asyncio.to_thread(self.delivery_queue.take_results, progress.job.job_id)
+        action = self.get_action(progress.job)
+        for result in results:
+            self.broadcastbot.metrics.send_latency.observe(result.latency, action)
+            await self.record_send_result(
+                progress,
+                result.uuid,
+                result.timestamp,
+                action_str,
+                result.error_class,
+                is_rate_limited=result.is_rate_limited,
             )
-            attachments = self.broadcastbot.message_handler.empty_list_to_none(ctx.message.base64_attachments)
-            link_preview = ctx.message.link_previews[0] if len(ctx.message.link_previews) > 0 else None
+        return len(results)
+
+    async def send_through_queue(self, progress: BroadcastProgress, action_str: str, *, use_send_many: bool) -> None:
+        """Queue the pending recipients for the delivery worker processes and record the results they report.
+        Only the queue is touched from a thread, the commands keep being answered while the workers send."""
+        job = progress.job
+        job_store = self.broadcastbot.broadcast_jobs
+
+        # Results reported before a restart, their recipients stay pending until they are checkpointed
+        while await self.record_queue_results(progress, action_str) > 0:
+            pass
+        self.checkpoint(progress)
+
+        to_modify_timestamps = {}
+        if job.target_timestamp is not None:
+            to_modify_timestamps = self.read_broadcast_timestamps(job.author, job.target_timestamp)
+        payload = {
+            "message_type": job.message_type.name,
+            "message": job.message,
+            "attachment_paths": None if job.attachment_paths is None else [str(path) for path in job.attachment_paths],
+            "link_preview": None if job.link_preview is None else job.link_preview.model_dump(),
+            "view_once": job.view_once,
+            "send_many": use_send_many and self.send_batch_size > 1,
+        }
+
+        batches = []
+        num_queued = 0
+        for phone_number in job_store.pending_accounts(job.job_id):
+            account = self.broadcastbot.get_account(phone_number)
+            signal_service = account.signal_api._signal_api_uris.signal_service  # noqa: SLF001
+            recipients = job_store.pending_recipients(job.job_id, phone_number)
+            if payload["send_many"]:
+                recipient_batches = self.batch_recipients(recipients, to_modify_timestamps)
+            else:
+                recipient_batches = batched(recipients, Broadcast.CHECKPOINT_INTERVAL)
+            for batch in recipient_batches:
+                recipients = [(subscriber, to_modify_timestamps.get(subscriber)) for subscriber in batch]
+                batches.append((account.phone_number, signal_service, recipients))
+                num_queued += len(batch)
+        await asyncio.to_thread(self.delivery_queue.enqueue, job.job_id, payload, batches)
+
+        num_reported = 0
+        last_report = time.monotonic()
+        while num_reported < num_queued:
+            num_results = await self.record_queue_results(progress, action_str)
+            num_reported += num_results
+            if num_results > 0:
+                last_report = time.monotonic()
+                continue
+
+            # Give up if the workers keep crashing or are not running, the job fails with what was sent so far
+            is_stalled = time.monotonic() - last_report > DeliveryQueue.LEASE_SECONDS
+            if is_stalled and not await asyncio.to_thread(self.delivery_queue.is_being_sent, job.job_id):
+                error_msg = f"No delivery worker sent job {job.job_id} in {DeliveryQueue.LEASE_SECONDS} seconds, "
+                error_msg += f"{num_queued - num_reported} recipients left"
+                raise RuntimeError(error_msg)
+            await asyncio.sleep(Broadcast.QUEUE_POLL_INTERVAL)
+
+    def read_timestamp_data(self, author: str, timestamp: int) -> TimestampData:
+        timestamp_data = self.broadcastbot.timestamp_store.read(author, timestamp)
+        if timestamp_data is None:
+            error_msg = f"No broadcast timestamps for {timestamp} from {author}"
+            raise RuntimeError(error_msg)
+        return timestamp_data
 
-            if message is None and attachments is None and ctx.message.type != MessageType.DELETE_MESSAGE:
-                return
+    def read_broadcast_timestamps(self, author: str, timestamp: int) -> Mapping[str, int]:
+        return self.read_timestamp_data(author, timestamp).broadcast_timestamps
+
+    def save_timestamp_data(self, job: BroadcastJob) -> None:
+        # Edits and deletes have to come from the same account as the original message
+        default_number = self.broadcastbot.accounts[0].phone_number
+        sent_accounts = self.broadcastbot.broadcast_jobs.sent_accounts(job.job_id)
+        broadcastdata = TimestampData(
+            author=job.author,
+            timestamp=job.timestamp,
+            broadcast_timestamps=self.broadcastbot.broadcast_jobs.sent_timestamps(job.job_id),
+            broadcast_accounts={uuid: account or default_number for uuid, account in sent_accounts.items()},
+        )
+
+        self.broadcastbot.timestamp_store.save(broadcastdata)
+        self.broadcastbot.receipts.add_broadcast(
+            job.author,
+            job.timestamp,
+            broadcastdata.broadcast_timestamps,
+            job.target_timestamp,
+        )
+
+    def checkpoint(self, progress: BroadcastProgress) -> None:
+        self.broadcastbot.broadcast_jobs.checkpoint(progress.job.job_id, progress.pending_results)
+        progress.pending_results.clear()
+        self.broadcastbot.delivery_health.flush()
+
+    async def delete_attachments(self, job: BroadcastJob) -> None:
+        for attachment_filename in job.attachments_local_filenames:
+            await self.broadcastbot.delete_attachment(attachment_filename)
+
+        if job.link_preview is not None and job.link_preview.id is not None:
+            await self.broadcastbot.delete_attachment(job.link_preview.id)
+
+    async def finish_job(self, job: BroadcastJob) -> None:
+        self.broadcastbot.broadcast_jobs.finish(job.job_id)
+        if self.delivery_queue is not None:
+            await asyncio.to_thread(self.delivery_queue.finish, job.job_id)
+
+    async def reply(self, job: BroadcastJob, ctx: ChatContext | None, message: str) -> None:
+        if ctx is not None:
+            await self.broadcastbot.reply_with_warn_on_failure(ctx, message)
+            return
 
-            if message is None:
-                message = ""
+        # Resumed jobs don't have the original message to reply to
+        try:
+            await self.broadcastbot.send(job.author, message)
+        except Exception:
+            self.broadcastbot.logger.exception("Could not send message to %s", job.author)
 
-            # Broadcast message to all subscribers.
-            send_tasks: list[asyncio.Task | None] = [None] * num_subscribers
+    def create_job(self, ctx: ChatContext, message: str, attachment_paths: list[Path] | None) -> BroadcastJob:
+        if ctx.message.type == MessageType.DELETE_MESSAGE:
+            target_timestamp = ctx.message.remote_delete_timestamp
+        elif ctx.message.type == MessageType.EDIT_MESSAGE:
+            target_timestamp = ctx.message.target_sent_timestamp
+        else:
+            target_timestamp = None
+
+        job = BroadcastJob(
+            author=ctx.message.source_uuid,
+            timestamp=ctx.message.timestamp,
+            message_type=ctx.message.type,
+            message=message,
+            attachments_local_filenames=ctx.message.attachments_local_filenames,
+            link_preview=ctx.message.link_previews[0] if len(ctx.message.link_previews) > 0 else None,
+            view_once=ctx.message.view_once,
+            target_timestamp=target_timestamp,
+            attachment_paths=attachment_paths,
+        )
+        if target_timestamp is None:
+            recipients = self.broadcastbot.subscribers
+            broadcast_accounts = {}
+        else:
+            # Only the people that got the original message, and are still subscribed, can have it edited or deleted
+            timestamp_data = self.read_timestamp_data(job.author, target_timestamp)
+            broadcast_accounts = timestamp_data.broadcast_accounts
+            subscribers = self.broadcastbot.subscribers
+            recipients = [subscriber for subscriber in timestamp_data.broadcast_timestamps if subscriber in subscribers]
+
+        # Subscribers that keep failing are only tried again after a backoff, the author always gets their message
+        delivery_health = self.broadcastbot.delivery_health
+        default_number = self.broadcastbot.accounts[0].phone_number
+
+        def get_sender(subscriber: str) -> str:
+            if target_timestamp is None:
+                return self.broadcastbot.account_for(subscriber).phone_number
+            # Signal only lets the account that sent the original message edit or delete it
+            return broadcast_accounts.get(subscriber, default_number)
+
+        recipients = [
+            (subscriber, get_sender(subscriber))
+            for subscriber in recipients
+            if subscriber == job.author or not delivery_health.should_skip(subscriber)
+        ]
+        self.broadcastbot.broadcast_jobs.create(job, recipients)
+        return job
+
+    async def run_job(self, job: BroadcastJob, ctx: ChatContext | None = None) -> None:  # noqa: C901, PLR0915 function is too complex
+        job_store = self.broadcastbot.broadcast_jobs
+        progress = BroadcastProgress(
+            job=job,
+            num_recipients=job_store.count(job.job_id),
+            num_sent=job_store.count(job.job_id, BroadcastJobStore.SENT),
+            num_failed=job_store.count(job.job_id, BroadcastJobStore.FAILED),
+        )
+        self.in_progress[job.job_id] = progress
+        attachments_deleted = False
+        timestamp_data_saved = False
+        action_str, acting_str = "sent to", "sending"
 
-            if ctx.message.type in (MessageType.DELETE_MESSAGE, MessageType.EDIT_MESSAGE):
-                if ctx.message.type == MessageType.DELETE_MESSAGE:
+        try:
+            if job.message_type in (MessageType.DELETE_MESSAGE, MessageType.EDIT_MESSAGE):
+                if job.message_type == MessageType.DELETE_MESSAGE:
                     action_str, acting_str = "deleted for", "deleting"
-                    original_msg_timestamp = ctx.message.remote_delete_timestamp
                 else:
                     action_str, acting_str = "edited for", "editing"
-                    original_msg_timestamp = ctx.message.target_sent_timestamp
-
-                self.broadcastbot.storage_lock.acquire()
-                prev_timestamps = ctx.bot.storage.read(
-                    f"broadcast-uuid-{subscriber_uuid}-timestamp-{original_msg_timestamp}",
-                )
-                self.broadcastbot.storage_lock.release()
-                to_modify_timestamps = TimestampData.model_validate(prev_timestamps).broadcast_timestamps
 
+                to_modify_timestamps = self.read_broadcast_timestamps(job.author, job.target_timestamp)
             else:
                 to_modify_timestamps = {}
 
-            for i, subscriber in enumerate(self.broadcastbot.subscribers):
-                if ctx.message.type == MessageType.DELETE_MESSAGE:
-                    subscriber_task = ctx.bot.remote_delete(subscriber, to_modify_timestamps.get(subscriber))
-                else:
-                    subscriber_task = self.broadcastbot.send(
+            def send(subscriber: str, account: SenderAccount) -> Coroutine[Any, Any, int]:
+                if job.message_type == MessageType.DELETE_MESSAGE:
+                    return self.broadcastbot.remote_delete(
                         subscriber,
-                        message,
-                        base64_attachments=attachments,
-                        link_preview=link_preview,
-                        edit_timestamp=to_modify_timestamps.get(subscriber),
-                        view_once=ctx.message.view_once,
+                        to_modify_timestamps.get(subscriber),
+                        account=account,
                     )
-                send_tasks[i] = asyncio.create_task(subscriber_task)
-
-                # Avoid rate limiting by waiting a random time between messages
-                await asyncio.sleep(random.uniform(0.5, 1))  # noqa: S311
+                return self.broadcastbot.send(
+                    subscriber,
+                    job.message,
+                    attachment_paths=job.attachment_paths,
+                    link_preview=job.link_preview,
+                    edit_timestamp=to_modify_timestamps.get(subscriber),
+                    view_once=job.view_once,
+                    account=account,
+                    lane=Lane.BULK,
+                )
 
-            await asyncio.wait(send_tasks)
+            def send_many(subscribers: list[str], account: SenderAccount) -> Coroutine[Any, Any, SendResult]:
+                # The batches of an edit only have subscribers that got the original message with the same timestamp
+                return self.broadcastbot.send_to_many(
+                    subscribers,
+                    job.message,
+                    attachment_paths=job.attachment_paths,
+                    link_preview=job.link_preview,
+                    edit_timestamp=to_modify_timestamps.get(subscribers[0]),
+                    view_once=job.view_once,
+                    account=account,
+                )
 
-            broadcast_timestamps = await self.check_send_tasks_results(send_tasks, action_str)
-            send_tasks_checked = True
+            # signal-cli only deletes a message for one recipient per request
+            can_batch = job.message_type != MessageType.DELETE_MESSAGE
 
-            if ctx.message.type != MessageType.DELETE_MESSAGE:
-                broadcastdata = TimestampData(
-                    author=subscriber_uuid,
-                    timestamp=ctx.message.timestamp,
-                    broadcast_timestamps=broadcast_timestamps,
+            # Broadcast message to all subscribers.
+            send_start = time.monotonic()
+            attachment_bytes_sent = self.broadcastbot.attachment_bytes_sent
+            attachment_bytes_saved = self.broadcastbot.attachment_bytes_saved
+            await self.send_to_all(
+                send,
+                progress,
+                action_str,
+                send_many=send_many if can_batch else None,
+                to_modify_timestamps=to_modify_timestamps,
+            )
+            self.checkpoint(progress)
+
+            send_duration = time.monotonic() - send_start
+            self.broadcastbot.metrics.broadcast_duration.observe(send_duration, self.get_action(job))
+            self.broadcastbot.logger.info(
+                "Finished %s %d messages in %.1f seconds, %.2f messages per second, current send rate %.2f",
+                acting_str,
+                progress.num_done,
+                send_duration,
+                progress.num_done / max(send_duration, 1e-6),
+                sum(account.send_pacer.rate for account in self.broadcastbot.accounts),
+            )
+            if job.attachment_paths is not None:
+                self.broadcastbot.logger.info(
+                    "Posted %d attachment bytes to signal-cli, batching saved %d bytes",
+                    self.broadcastbot.attachment_bytes_sent - attachment_bytes_sent,
+                    self.broadcastbot.attachment_bytes_saved - attachment_bytes_saved,
                 )
-
-                self.broadcastbot.storage_lock.acquire()
-                ctx.bot.storage.save(
-                    f"broadcast-uuid-{subscriber_uuid}-timestamp-{ctx.message.timestamp}",
-                    broadcastdata.model_dump(),
+            if progress.num_failed > 0:
+                self.broadcastbot.logger.warning(
+                    "Failed %s %d messages: %s",
+                    acting_str,
+                    progress.num_failed,
+                    ", ".join(f"{count} {error_class}" for error_class, count in progress.errors.most_common()),
                 )
-                self.broadcastbot.storage_lock.release()
+
+            if job.message_type != MessageType.DELETE_MESSAGE:
+                self.save_timestamp_data(job)
             timestamp_data_saved = True
 
-            await self.broadcastbot.message_handler.delete_attachments(ctx)
+            await self.delete_attachments(job)
             attachments_deleted = True
 
-            await self.broadcastbot.reply_with_warn_on_failure(
-                ctx,
-                f"Message {action_str} {len(broadcast_timestamps) - 1} people",
-            )
+            await self.finish_job(job)
+
+            await self.reply(job, ctx, f"Message {action_str} {progress.num_sent - 1} people")
 
-            self.broadcastbot.last_msg_user_uuid = subscriber_uuid
+            self.broadcastbot.last_msg_user_uuid = job.author
         except Exception:
             self.broadcastbot.logger.exception("")
             try:
-                if send_tasks_checked is False:
-                    broadcast_timestamps = await self.check_send_tasks_results(send_tasks, action_str)
+                self.checkpoint(progress)
 
                 error_str = f"Something went wrong when {acting_str} the message"
-                error_str += (
-                    f", it was only {action_str} {len(broadcast_timestamps) - 1} out of {num_subscribers - 1} people"
-                )
+                error_str += f", it was only {action_str} {progress.num_sent - 1} out of "
+                error_str += f"{progress.num_recipients - 1} people"
                 error_str += ", please contact the admin if the problem persists"
-                await self.broadcastbot.reply_with_warn_on_failure(ctx, error_str)
+                await self.reply(job, ctx, error_str)
 
                 if attachments_deleted is False:
-                    await self.broadcastbot.message_handler.delete_attachments(ctx)
+                    await self.delete_attachments(job)
 
-                if timestamp_data_saved is False and ctx.message.type != MessageType.DELETE_MESSAGE:
-                    broadcastdata = TimestampData(
-                        author=subscriber_uuid,
-                        timestamp=ctx.message.timestamp,
-                        broadcast_timestamps=broadcast_timestamps,
-                    )
-                    self.broadcastbot.storage_lock.acquire()
-                    ctx.bot.storage.save(
-                        f"broadcast-uuid-{subscriber_uuid}-timestamp-{ctx.message.timestamp}",
-                        broadcastdata.model_dump(),
-                    )
-                    self.broadcastbot.storage_lock.release()
+                if timestamp_data_saved is False and job.message_type != MessageType.DELETE_MESSAGE:
+                    self.save_timestamp_data(job)
+
+                await self.finish_job(job)
+            except Exception:
+                self.broadcastbot.logger.exception("")
+        finally:
+            del self.in_progress[job.job_id]
+
+    def submit(self, job: BroadcastJob, *, limit_rate: bool = True) -> Ticket:
+        weight = Broadcast.ADMIN_WEIGHT if job.author == self.broadcastbot.admin.admin_id else 1.0
+        num_recipients = self.broadcastbot.broadcast_jobs.count(job.job_id)
+        # The admin is never rate limited
+        limit_rate = limit_rate and weight == 1.0
+        return self.admission.submit(
+            job.job_id,
+            job.author,
+            job.timestamp,
+            num_recipients,
+            weight,
+            limit_rate=limit_rate,
+        )
+
+    def estimate_wait(self, ticket: Ticket) -> float:
+        # The messages left in the running broadcasts and in the ones going first, at the current send rate
+        num_messages = sum(progress.num_recipients - progress.num_done for progress in self.in_progress.values())
+        num_messages += sum(other.cost for other in self.admission.queued_ahead(ticket))
+        send_rate = sum(account.send_pacer.rate for account in self.broadcastbot.accounts)
+        return max(ticket.ready_at - self.admission.clock(), num_messages / max(send_rate, 1e-6))
+
+    async def run_when_admitted(self, job: BroadcastJob, ticket: Ticket, ctx: ChatContext | None = None) -> None:
+        try:
+            if await ticket.admitted:
+                await self.run_job(job, ctx)
+                return
+
+            self.broadcastbot.logger.info("Broadcast %s from %s deleted before it was sent", job.timestamp, job.author)
+            await self.delete_attachments(job)
+            await self.finish_job(job)
+        except Exception:
+            self.broadcastbot.logger.exception("")
+        finally:
+            self.admission.finish(ticket)
+
+    async def queue_job(self, job: BroadcastJob, ctx: ChatContext) -> None:
+        ticket = self.submit(job)
+        if ticket.admitted.done():
+            await self.run_when_admitted(job, ticket, ctx)
+            return
+
+        # Waiting here would hold one of signalbot's few message handlers, the broadcast waits in its own task
+        wait_minutes = max(1, round(self.estimate_wait(ticket) / 60))
+        self.broadcastbot.logger.info(
+            "Queued broadcast %s from %s, starts in about %d minutes",
+            job.timestamp,
+            job.author,
+            wait_minutes,
+        )
+        await self.reply(
+            job,
+            ctx,
+            f"Other messages are being sent, yours will start in about {wait_minutes} minute(s)",
+        )
+        task = asyncio.create_task(self.run_when_admitted(job, ticket, ctx))
+        self.queued_tasks.add(task)
+        task.add_done_callback(self.queued_tasks.discard)
+
+    async def modify_queued(self, ctx: ChatContext) -> bool:
+        """Deleting a broadcast that is still queued drops it, editing it is not possible until it is sent.
+        Returns whether the message was about a queued broadcast."""
+        if self.admission is None:
+            return False
+
+        subscriber_uuid = ctx.message.source_uuid
+        is_delete = ctx.message.type == MessageType.DELETE_MESSAGE
+        if is_delete and self.admission.cancel(subscriber_uuid, ctx.message.remote_delete_timestamp):
+            await self.broadcastbot.reply_with_warn_on_failure(ctx, "Message deleted before it was sent")
+            return True
+
+        is_edit = ctx.message.type == MessageType.EDIT_MESSAGE
+        if is_edit and self.admission.is_queued(subscriber_uuid, ctx.message.target_sent_timestamp):
+            message = "The message has not been sent yet, please delete it and send it again to change it"
+            await self.broadcastbot.reply_with_warn_on_failure(ctx, message)
+            return True
+        return False
+
+    async def save_attachments(self, ctx: ChatContext) -> list[Path]:
+        attachment_paths = []
+        for i, base64_attachment in enumerate(ctx.message.base64_attachments):
+            if i < len(ctx.message.attachments_local_filenames):
+                attachment_filename = ctx.message.attachments_local_filenames[i]
+            else:
+                attachment_filename = f"{ctx.message.timestamp}-{i}"
+            attachment_paths.append(await self.broadcastbot.save_attachment(attachment_filename, base64_attachment))
+
+        # The broadcast streams them from the files, so the copies received with the message can be freed already
+        ctx.message.base64_attachments.clear()
+        return attachment_paths
+
+    async def broadcast(self, ctx: ChatContext) -> None:
+        try:
+            subscriber_uuid = ctx.message.source_uuid
+            if subscriber_uuid in self.broadcastbot.banned_users:
+                await self.broadcastbot.send(subscriber_uuid, "This number is not allowed to send messages")
+                self.broadcastbot.logger.info("%s tried to broadcast but they are banned", subscriber_uuid)
+                return
+
+            if subscriber_uuid not in self.broadcastbot.subscribers:
+                await self.broadcastbot.send(subscriber_uuid, self.broadcastbot.must_subscribe_message)
+                self.broadcastbot.logger.info("%s tried to broadcast but they are not subscribed", subscriber_uuid)
+                return
+
+            message = self.broadcastbot.message_handler.remove_command_from_message(
+                ctx.message.text,
+                PublicCommandStrings.broadcast,
+            )
+            attachments = self.broadcastbot.message_handler.empty_list_to_none(ctx.message.base64_attachments)
+
+            if message is None and attachments is None and ctx.message.type != MessageType.DELETE_MESSAGE:
+                return
+
+            if message is None:
+                message = ""
+
+            if await self.modify_queued(ctx):
+                return
+
+            attachment_paths = None
+            if attachments is not None:
+                attachment_paths = await self.save_attachments(ctx)
+            job = self.create_job(ctx, message, attachment_paths)
+        except Exception:
+            self.broadcastbot.logger.exception("")
+            try:
+                await self.broadcastbot.reply_with_warn_on_failure(ctx, "Something went wrong, please try again")
             except Exception:
                 self.broadcastbot.logger.exception("")
+            return
+
+        # Edits and deletes are sent right away, they are quick and only make sense soon after the message
+        if self.admission is None or job.target_timestamp is not None:
+            await self.run_job(job, ctx)
+            return
+        await self.queue_job(job, ctx)
+
+    async def resume_jobs(self) -> None:
+        jobs = self.broadcastbot.broadcast_jobs.unfinished()
+        if len(jobs) == 0:
+            return
+
+        await self.broadcastbot.wait_for_signal_service()
+        resumed_jobs = []
+        for job in jobs:
+            self.broadcastbot.logger.info("Resuming broadcast %s from %s", job.timestamp, job.author)
+            try:
+                if len(job.attachments_local_filenames) > 0:
+                    job.attachment_paths = [
+                        await self.broadcastbot.save_attachment(attachment_filename)
+                        for attachment_filename in job.attachments_local_filenames
+                    ]
+            except Exception:
+                self.broadcastbot.logger.exception("Could not load the attachments, the job is dropped")
+                self.broadcastbot.broadcast_jobs.finish(job.job_id)
+                continue
+            resumed_jobs.append(job)
+
+        # The interrupted broadcasts were already admitted once, they only wait for their turn
+        await asyncio.gather(
+            *(
+                self.run_job(job)
+                if self.admission is None or job.target_timestamp is not None
+                else self.run_when_admitted(job, self.submit(job, limit_rate=False))
+                for job in resumed_jobs
+            ),
+        )
 
     async def handle(self, ctx: ChatContext) -> None:
         message = ctx.message.text
@@ -208,9 +842,7 @@ class Broadcast(Command):
             await self.broadcast(ctx)
             return
 
-        if self.is_valid_command(message, invalid_command=CommandRegex.broadcast):
-            return
-
+        # Messages with other commands never get here, the dispatcher routes them to their own command
         await ctx.receipt(receipt_type="read")
 
         # By default broadcast all the messages
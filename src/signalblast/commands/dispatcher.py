@@ -0,0 +1,61 @@
+import re
+import time
+from re import Pattern
+
+from signalbot import Command
+from signalbot import Context as ChatContext
+
+from signalblast.broadcastbot import BroadcasBot
+
+
+class CommandDispatcher(Command):
+    """Routes every message to exactly one command. All the command regexes are compiled into a single
+    alternation, so a message is matched once instead of once per command."""
+
+    def __init__(self, bot: BroadcasBot, default_command: Command) -> None:
+        super().__init__()
+        self.broadcastbot = bot
+        self.default_command = default_command
+        self.routes: list[tuple[Pattern, Command, bool, bool]] = []
+        self.regex: Pattern | None = None
+
+    def add(self, regex: Pattern, command: Command, *, contacts: bool = True, groups: bool = False) -> None:
+        self.routes.append((regex, command, contacts, groups))
+
+    def setup(self) -> None:
+        # Longest commands first, so a command that is a prefix of another one does not shadow it
+        alternatives = [
+            f"(?P<route{i}>{regex.pattern})"
+            for i, (regex, _, _, _) in sorted(enumerate(self.routes), key=lambda route: -len(route[1][0].pattern))
+        ]
+        self.regex = re.compile("|".join(alternatives))
+
+        for command in [self.default_command, *(command for _, command, _, _ in self.routes)]:
+            command.bot = self.bot
+            command.setup()
+
+    def route(self, ctx: ChatContext) -> Command | None:
+        is_group = ctx.message.is_group()
+        match = None if ctx.message.text is None else self.regex.match(ctx.message.text)
+        if match is None:
+            # Everything that is not a command is a broadcast, which is only for private chats
+            return None if is_group else self.default_command
+
+        _, command, contacts, groups = self.routes[int(match.lastgroup.removeprefix("route"))]
+        if (is_group and not groups) or (not is_group and not contacts):
+            return None
+        return command
+
+    async def handle(self, ctx: ChatContext) -> None:
+        command = self.route(ctx)
+        if command is None:
+            return
+
+        command_name = type(command).__name__
+        start = time.perf_counter()
+        try:
+            await command.handle(ctx)
+        finally:
+            elapsed = time.perf_counter() - start
+            self.broadcastbot.metrics.command_duration.observe(elapsed, command_name)
+            self.broadcastbot.logger.debug("%s handled the message in %.4f seconds", command_name, elapsed)
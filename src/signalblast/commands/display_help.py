@@ -1,8 +1,8 @@
-from signalbot import Command, regex_triggered
+from signalbot import Command
 from signalbot import Context as ChatContext
 
 from signalblast.broadcastbot import BroadcasBot
-from signalblast.commands_strings import CommandRegex, PublicCommandStrings
+from signalblast.commands_strings import PublicCommandStrings
 
 
 class DisplayHelp(Command):
@@ -21,7 +21,6 @@ class DisplayHelp(Command):
             return self.broadcastbot.admin_wrong_command_message
         return self.broadcastbot.admin_help_message
 
-    @regex_triggered(CommandRegex.help)
     async def handle(self, ctx: ChatContext) -> None:
         try:
             await ctx.receipt(receipt_type="read")
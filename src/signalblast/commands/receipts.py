@@ -0,0 +1,50 @@
+from datetime import datetime, timezone
+
+from signalbot import Command
+from signalbot import Context as ChatContext
+
+from signalblast.broadcastbot import BroadcasBot
+from signalblast.receipts import BroadcastReceipts
+
+
+class Receipts(Command):
+    NUM_BROADCASTS = 5
+    NUM_ADMIN_BROADCASTS = 10
+
+    def __init__(self, bot: BroadcasBot) -> None:
+        super().__init__()
+        self.broadcastbot = bot
+
+    @staticmethod
+    def format_receipts(receipts: BroadcastReceipts) -> str:
+        sent_time = datetime.fromtimestamp(receipts.timestamp / 1000, tz=timezone.utc).strftime("%Y-%m-%d %H:%M")
+        return (
+            f"\t{sent_time} UTC: sent to {receipts.num_sent}, delivered to {receipts.num_delivered}, "
+            f"read by {receipts.num_read}\n"
+        )
+
+    async def handle(self, ctx: ChatContext) -> None:
+        try:
+            await ctx.receipt(receipt_type="read")
+
+            subscriber_uuid = ctx.message.source_uuid
+            # The admin gets the latest broadcasts from everyone, without saying who sent them
+            if subscriber_uuid == self.broadcastbot.admin.admin_id:
+                latest = self.broadcastbot.receipts.latest(limit=Receipts.NUM_ADMIN_BROADCASTS)
+                header = "Latest broadcasts:\n"
+            else:
+                latest = self.broadcastbot.receipts.latest(subscriber_uuid, limit=Receipts.NUM_BROADCASTS)
+                header = "Your latest broadcasts:\n"
+
+            if len(latest) == 0:
+                message = "There are no recent broadcasts"
+            else:
+                message = header + "".join(self.format_receipts(receipts) for receipts in latest)
+            await self.broadcastbot.reply_with_warn_on_failure(ctx, message)
+            self.broadcastbot.logger.info("Sent the receipts of %d broadcasts to %s", len(latest), subscriber_uuid)
+        except Exception:
+            self.broadcastbot.logger.exception("")
+            try:
+                await self.broadcastbot.reply_with_warn_on_failure(ctx, "Could not get the receipts")
+            except Exception:
+                self.broadcastbot.logger.exception("")
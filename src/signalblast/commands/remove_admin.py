@@ -1,8 +1,8 @@
-from signalbot import Command, regex_triggered
+from signalbot import Command
 from signalbot import Context as ChatContext
 
 from signalblast.broadcastbot import BroadcasBot
-from signalblast.commands_strings import AdminCommandStrings, CommandRegex
+from signalblast.commands_strings import AdminCommandStrings
 
 
 class RemoveAdmin(Command):
@@ -10,7 +10,6 @@ class RemoveAdmin(Command):
         super().__init__()
         self.broadcastbot = bot
 
-    @regex_triggered(CommandRegex.remove_admin)
     async def handle(self, ctx: ChatContext) -> None:
         try:
             await ctx.receipt(receipt_type="read")
@@ -21,8 +20,17 @@ class RemoveAdmin(Command):
                 AdminCommandStrings.remove_admin,
             )
 
+            wait_seconds = self.broadcastbot.admin.seconds_until_next_attempt(subscriber_uuid)
+            if wait_seconds > 0:
+                await self.broadcastbot.reply_with_warn_on_failure(
+                    ctx,
+                    f"Too many wrong passwords, try again in {int(wait_seconds) + 1} seconds",
+                )
+                self.broadcastbot.logger.warning("%s is throttled for remove_admin", subscriber_uuid)
+                return
+
             previous_admin = self.broadcastbot.admin.admin_id
-            if await self.broadcastbot.admin.remove(password):
+            if await self.broadcastbot.admin.remove(subscriber_uuid, password):
                 await self.broadcastbot.reply_with_warn_on_failure(ctx, "Admin has been removed!")
                 if previous_admin is not None and subscriber_uuid != previous_admin:
                     msg_to_admin = self.broadcastbot.message_handler.compose_message_to_admin(
@@ -1,8 +1,7 @@
-from signalbot import Command, regex_triggered
+from signalbot import Command
 from signalbot import Context as ChatContext
 
 from signalblast.broadcastbot import BroadcasBot
-from signalblast.commands_strings import CommandRegex
 
 
 class Subscribe(Command):
@@ -42,6 +41,5 @@ class Subscribe(Command):
             except Exception:
                 self.broadcastbot.logger.exception("")
 
-    @regex_triggered(CommandRegex.subscribe)
     async def handle(self, ctx: ChatContext) -> None:
         await Subscribe.subscribe(self, ctx, verbose=True)
@@ -28,6 +28,7 @@ class _PublicCommandStrings(_IterableDataClass):
     broadcast = "!broadcast"
     msg_to_admin = "!admin"
     help = "!help"
+    receipts = "!receipts"
 
 
 PublicCommandStrings = _PublicCommandStrings()
@@ -81,6 +82,7 @@ class _CommandRegex(_IterableDataClass):
     set_ping = re.compile(_begings_with(AdminCommandStrings.set_ping))
     unset_ping = re.compile(_begings_with(AdminCommandStrings.unset_ping))
     help = re.compile(_begings_with(PublicCommandStrings.help))
+    receipts = re.compile(_begings_with(PublicCommandStrings.receipts))
     last_msg_user_uuid = re.compile(_begings_with(AdminCommandStrings.last_msg_user_uuid))
 
 
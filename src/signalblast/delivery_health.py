@@ -0,0 +1,156 @@
+from __future__ import annotations
+
+import time
+from dataclasses import dataclass
+from typing import TYPE_CHECKING
+
+from aiohttp import ClientConnectorError, ClientResponseError
+
+from signalblast.accounts import RecipientError
+from signalblast.jsonrpc import JsonRpcError
+from signalblast.send_pacer import is_rate_limit_error
+
+if TYPE_CHECKING:
+    import sqlite3
+    from threading import Lock
+
+
+def get_error_class(exception: BaseException) -> str:
+    # signalbot raises its own errors from inside the except block, the HTTP status is further down the chain
+    error_class = type(exception).__name__
+    cause = exception.__cause__ or exception.__context__
+    while cause is not None:
+        if isinstance(cause, ClientResponseError):
+            return f"{error_class} {cause.status}"
+        if isinstance(cause, (JsonRpcError, RecipientError)):
+            return f"{error_class} {cause.code}"
+        cause = cause.__cause__ or cause.__context__
+    return error_class
+
+
+# signal-cli's failures that are down to the recipient, sending again soon will fail the same way
+RECIPIENT_FAILURES = ("UNREGISTERED_FAILURE", "IDENTITY_FAILURE")
+
+
+def is_recipient_failure(error_class: str | None) -> bool:
+    # Either the failure type on its own or in the class of the exception it was raised with
+    return error_class is not None and any(failure in error_class for failure in RECIPIENT_FAILURES)
+
+
+def is_retryable_error(exception: BaseException | None) -> bool:
+    # Rate limited or signal-cli could not be reached, nothing was sent so the request can be sent again
+    if is_rate_limit_error(exception):
+        return True
+    while exception is not None:
+        if isinstance(exception, (ClientConnectorError, ConnectionRefusedError)):
+            return True
+        exception = exception.__cause__ or exception.__context__
+    return False
+
+
+@dataclass
+class DeliveryHealth:
+    failure_streak: int = 0
+    last_success: int | None = None  # Timestamps in milliseconds
+    last_failure: int | None = None
+    last_error: str | None = None
+    next_attempt: int | None = None
+
+
+class DeliveryHealthStore:
+    """Whether the messages to each subscriber are being delivered, kept across restarts.
+    After BACKOFF_AFTER_FAILURES failures in a row that are down to them, not to signal-cli or Signal, a subscriber
+    is left out of the broadcasts, and only tried again after a backoff that doubles with every failure.
+    The changes are written to the database on flush()."""
+
+    BACKOFF_AFTER_FAILURES = 2
+    BACKOFF_MS = 60 * 60 * 1000
+    MAX_BACKOFF_MS = 7 * 24 * 60 * 60 * 1000
+
+    def __init__(self, connection: sqlite3.Connection, lock: Lock) -> None:
+        self.connection = connection
+        self.lock = lock
+        self.health: dict[str, DeliveryHealth] = {}
+        self._changed: set[str] = set()
+        self._forgotten: set[str] = set()
+
+    def record_success(self, uuid: str, now_ms: int | None = None) -> None:
+        health = self.health.get(uuid)
+        if health is None:
+            health = self.health[uuid] = DeliveryHealth()
+        health.failure_streak = 0
+        health.last_success = int(time.time() * 1000) if now_ms is None else now_ms
+        health.next_attempt = None
+        self._changed.add(uuid)
+
+    def record_failure(self, uuid: str, error_class: str, now_ms: int | None = None) -> int:
+        if now_ms is None:
+            now_ms = int(time.time() * 1000)
+        health = self.health.get(uuid)
+        if health is None:
+            health = self.health[uuid] = DeliveryHealth()
+        health.failure_streak += 1
+        health.last_failure = now_ms
+        health.last_error = error_class
+        if health.failure_streak >= self.BACKOFF_AFTER_FAILURES:
+            num_backoffs = health.failure_streak - self.BACKOFF_AFTER_FAILURES
+            health.next_attempt = now_ms + min(self.BACKOFF_MS * 2**num_backoffs, self.MAX_BACKOFF_MS)
+        self._changed.add(uuid)
+        return health.failure_streak
+
+    def should_skip(self, uuid: str, now_ms: int | None = None) -> bool:
+        health = self.health.get(uuid)
+        if health is None or health.next_attempt is None:
+            return False
+        if now_ms is None:
+            now_ms = int(time.time() * 1000)
+        return now_ms < health.next_attempt
+
+    def forget(self, uuid: str) -> None:
+        if self.health.pop(uuid, None) is not None:
+            self._changed.discard(uuid)
+            self._forgotten.add(uuid)
+
+    def failure_streaks(self) -> list[int]:
+        return [health.failure_streak for health in self.health.values() if health.failure_streak > 0]
+
+    def flush(self) -> None:
+        changed = [
+            (
+                uuid,
+                self.health[uuid].failure_streak,
+                self.health[uuid].last_success,
+                self.health[uuid].last_failure,
+                self.health[uuid].last_error,
+                self.health[uuid].next_attempt,
+            )
+            for uuid in self._changed
+        ]
+        forgotten = [(uuid,) for uuid in self._forgotten]
+        self._changed, self._forgotten = set(), set()
+        if len(changed) == 0 and len(forgotten) == 0:
+            return
+
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO delivery_health (uuid, failure_streak, last_success, last_failure, last_error, "
+                "next_attempt) VALUES (?, ?, ?, ?, ?, ?)",
+                changed,
+            )
+            self.connection.executemany("DELETE FROM delivery_health WHERE uuid = ?", forgotten)
+
+    @staticmethod
+    def load(connection: sqlite3.Connection, lock: Lock) -> DeliveryHealthStore:
+        store = DeliveryHealthStore(connection, lock)
+        with lock, connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS delivery_health (uuid TEXT PRIMARY KEY, failure_streak INTEGER, "
+                "last_success INTEGER, last_failure INTEGER, last_error TEXT, next_attempt INTEGER)",
+            )
+            rows = connection.execute(
+                "SELECT uuid, failure_streak, last_success, last_failure, last_error, next_attempt "
+                "FROM delivery_health",
+            ).fetchall()
+        for uuid, failure_streak, last_success, last_failure, last_error, next_attempt in rows:
+            store.health[uuid] = DeliveryHealth(failure_streak, last_success, last_failure, last_error, next_attempt)
+        return store
@@ -0,0 +1,193 @@
+from __future__ import annotations
+
+import json
+import sqlite3
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from threading import Lock
+from typing import TYPE_CHECKING
+
+from signalblast.utils import add_column_if_missing
+
+if TYPE_CHECKING:
+    from collections.abc import Iterator
+    from pathlib import Path
+
+
+@dataclass
+class DeliveryBatch:
+    batch_id: int
+    job_id: int
+    phone_number: str
+    signal_service: str
+    recipients: list[tuple[str, int | None]]  # Subscriber uuid and the timestamp of the message to edit or delete
+    payload: dict
+
+
+@dataclass
+class DeliveryResult:
+    uuid: str
+    timestamp: int | None  # None if it failed
+    error_class: str | None = None
+    is_rate_limited: bool = False
+    latency: float = 0.0
+
+
+class DeliveryQueue:
+    """Broadcast recipients waiting to be sent by the delivery worker processes, and the results they report back.
+    It is a sqlite database of its own, shared by the bot and the workers. Each batch is claimed by one worker,
+    which renews the claim while it sends. The claims that are not renewed within LEASE_SECONDS go back to the
+    queue for the other workers, up to MAX_CLAIMS times in case it is the batch that stops the workers.
+    It also has the send pacers of the accounts, every process sending from an account shares its rate."""
+
+    LEASE_SECONDS = 5 * 60
+    MAX_CLAIMS = 3
+
+    def __init__(self, path: Path) -> None:
+        # Transactions are started explicitly, claiming a batch has to lock the database before reading it
+        self.connection = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.lock = Lock()
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.connection
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+            self.connection.execute("COMMIT")
+
+    def enqueue(self, job_id: int, payload: dict, batches: list[tuple[str, str, list[tuple[str, int | None]]]]) -> None:
+        # Each batch has the phone number and signal-cli address of the account sending it, and its recipients
+        with self.transaction() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO delivery_jobs (job_id, payload) VALUES (?, ?)",
+                [job_id, json.dumps(payload)],
+            )
+            connection.executemany(
+                "INSERT INTO delivery_batches (job_id, phone_number, signal_service, recipients) VALUES (?, ?, ?, ?)",
+                (
+                    (job_id, phone_number, signal_service, json.dumps(recipients))
+                    for phone_number, signal_service, recipients in batches
+                ),
+            )
+
+    def claim(self, worker_id: str, now: float | None = None) -> DeliveryBatch | None:
+        if now is None:
+            now = time.time()
+        with self.transaction() as connection:
+            row = connection.execute(
+                "SELECT delivery_batches.id, delivery_batches.job_id, phone_number, signal_service, recipients, "
+                "payload FROM delivery_batches JOIN delivery_jobs ON delivery_batches.job_id = delivery_jobs.job_id "
+                "WHERE (claimed_at IS NULL OR claimed_at < ?) AND claims < ? ORDER BY delivery_batches.id LIMIT 1",
+                [now - self.LEASE_SECONDS, self.MAX_CLAIMS],
+            ).fetchone()
+            if row is None:
+                return None
+            connection.execute(
+                "UPDATE delivery_batches SET claimed_by = ?, claimed_at = ?, claims = claims + 1 WHERE id = ?",
+                [worker_id, now, row[0]],
+            )
+        batch_id, job_id, phone_number, signal_service, recipients, payload = row
+        recipients = [(uuid, target_timestamp) for uuid, target_timestamp in json.loads(recipients)]
+        return DeliveryBatch(batch_id, job_id, phone_number, signal_service, recipients, json.loads(payload))
+
+    def renew(self, batch: DeliveryBatch, worker_id: str, now: float | None = None) -> bool:
+        # False if the lease expired and another worker claimed the batch
+        if now is None:
+            now = time.time()
+        with self.transaction() as connection:
+            cursor = connection.execute(
+                "UPDATE delivery_batches SET claimed_at = ? WHERE id = ? AND claimed_by = ?",
+                [now, batch.batch_id, worker_id],
+            )
+        return cursor.rowcount > 0
+
+    def is_being_sent(self, job_id: int, now: float | None = None) -> bool:
+        # A worker renewed the lease of one of the job's batches recently
+        if now is None:
+            now = time.time()
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT 1 FROM delivery_batches WHERE job_id = ? AND claimed_at >= ? LIMIT 1",
+                [job_id, now - self.LEASE_SECONDS],
+            ).fetchone()
+        return row is not None
+
+    def complete(self, batch: DeliveryBatch, results: list[DeliveryResult]) -> None:
+        with self.transaction() as connection:
+            # The batch is gone if its job finished or its lease expired and another worker completed it first
+            cursor = connection.execute("DELETE FROM delivery_batches WHERE id = ?", [batch.batch_id])
+            if cursor.rowcount == 0:
+                return
+            connection.executemany(
+                "INSERT INTO delivery_results (job_id, uuid, timestamp, error_class, is_rate_limited, latency) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    (
+                        batch.job_id,
+                        result.uuid,
+                        result.timestamp,
+                        result.error_class,
+                        result.is_rate_limited,
+                        result.latency,
+                    )
+                    for result in results
+                ),
+            )
+
+    def take_results(self, job_id: int, limit: int = 1000) -> list[DeliveryResult]:
+        with self.transaction() as connection:
+            rows = connection.execute(
+                "SELECT id, uuid, timestamp, error_class, is_rate_limited, latency FROM delivery_results "
+                "WHERE job_id = ? ORDER BY id LIMIT ?",
+                [job_id, limit],
+            ).fetchall()
+            connection.executemany("DELETE FROM delivery_results WHERE id = ?", ((row[0],) for row in rows))
+        return [
+            DeliveryResult(uuid, timestamp, error_class, bool(is_rate_limited), latency)
+            for _, uuid, timestamp, error_class, is_rate_limited, latency in rows
+        ]
+
+    def finish(self, job_id: int) -> None:
+        with self.transaction() as connection:
+            connection.execute("DELETE FROM delivery_batches WHERE job_id = ?", [job_id])
+            connection.execute("DELETE FROM delivery_jobs WHERE job_id = ?", [job_id])
+            connection.execute("DELETE FROM delivery_results WHERE job_id = ?", [job_id])
+
+    def clear_batches(self) -> None:
+        # The results are kept, they are taken when the interrupted job resumes and its pending recipients queued again
+        with self.transaction() as connection:
+            connection.execute("DELETE FROM delivery_batches")
+            connection.execute("DELETE FROM delivery_jobs")
+
+    def clear_send_pacers(self) -> None:
+        # The accounts start again from the configured send rates
+        with self.transaction() as connection:
+            connection.execute("DELETE FROM send_pacers")
+
+    @staticmethod
+    def load(path: Path) -> DeliveryQueue:
+        queue = DeliveryQueue(path)
+        with queue.transaction() as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS delivery_jobs (job_id INTEGER PRIMARY KEY, payload TEXT)")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS delivery_batches (id INTEGER PRIMARY KEY, job_id INTEGER, "
+                "phone_number TEXT, signal_service TEXT, recipients TEXT, claimed_by TEXT, claimed_at REAL, "
+                "claims INTEGER DEFAULT 0)",
+            )
+            add_column_if_missing(connection, "delivery_batches", "claims", "INTEGER DEFAULT 0")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS delivery_results (id INTEGER PRIMARY KEY, job_id INTEGER, uuid TEXT, "
+                "timestamp INTEGER, error_class TEXT, is_rate_limited INTEGER, latency REAL)",
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS delivery_results_job_id ON delivery_results (job_id)")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS send_pacers (phone_number TEXT PRIMARY KEY, rate REAL, tokens REAL, "
+                "last_refill REAL, last_decrease REAL)",
+            )
+        return queue
@@ -0,0 +1,316 @@
+"""Sends the broadcasts queued in the delivery queue, started by the bot when --delivery_processes is set.
+
+It can also be run by hand against the bot's queue:
+    python -m signalblast.delivery_worker --queue_path src/signalblast/data/delivery_queue.db
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import time
+from collections.abc import Callable, Coroutine
+from logging import Logger
+from pathlib import Path
+from typing import Any
+
+from signalbot import MessageType
+from signalbot.api import SignalAPI
+from signalbot.link_previews import LinkPreview
+
+from signalblast.accounts import SENT_WITHOUT_TIMESTAMP, SenderAccount, SendResult
+from signalblast.delivery_health import RECIPIENT_FAILURES, get_error_class, is_retryable_error
+from signalblast.delivery_queue import DeliveryBatch, DeliveryQueue, DeliveryResult
+from signalblast.jsonrpc import JsonRpcClient, JsonRpcSignalAPI
+from signalblast.send_pacer import SharedSendPacer, is_rate_limit_error
+from signalblast.utils import create_or_set_logger
+
+
+class DeliveryWorker:
+    """Claims batches of recipients from the queue, sends them through signal-cli and reports the results.
+    The bot keeps the broadcast state, the checkpoints and the metrics, the worker only sends."""
+
+    POLL_INTERVAL = 0.5
+    BATCH_ATTEMPTS = 3
+    TRACEBACK_LOG_INTERVAL = 60
+
+    def __init__(  # noqa: PLR0913 Too many arguments in function definition
+        self,
+        queue: DeliveryQueue,
+        worker_id: str,
+        logger: Logger,
+        concurrency: int = 4,
+        send_rate: float = 5.0,
+        min_send_rate: float = 0.5,
+        max_send_rate: float = 20.0,
+        signal_cli_jsonrpc: str | None = None,
+        jsonrpc_signal_service: str | None = None,
+    ) -> None:
+        self.queue = queue
+        self.worker_id = worker_id
+        self.logger = logger
+        self.concurrency = concurrency
+        self.send_rate = send_rate
+        self.min_send_rate = min_send_rate
+        self.max_send_rate = max_send_rate
+        # The accounts of the bot's signal-cli-rest-api send through its signal-cli daemon, the same as in the bot
+        self.jsonrpc_client = None if signal_cli_jsonrpc is None else JsonRpcClient(signal_cli_jsonrpc)
+        self.jsonrpc_signal_service = jsonrpc_signal_service
+        self.accounts: dict[str, SenderAccount] = {}
+        self._accounts_lock = asyncio.Lock()
+        self._parent_pid = os.getppid()
+        self._last_traceback_time: float | None = None
+
+    async def get_account(self, phone_number: str, signal_service: str) -> SenderAccount:
+        async with self._accounts_lock:
+            account = self.accounts.get(phone_number)
+            if account is None:
+                if self.jsonrpc_client is not None and signal_service == self.jsonrpc_signal_service:
+                    signal_api = JsonRpcSignalAPI(
+                        signal_service,
+                        phone_number,
+                        self.jsonrpc_client,
+                        download_attachments=False,
+                    )
+                else:
+                    signal_api = SignalAPI(signal_service, phone_number, download_attachments=False)
+                    # Also sets whether signal-cli is reached over http or https
+                    while not await signal_api.check_signal_service():
+                        self.logger.warning("Cannot connect to the signal-cli-rest-api of %s, retrying", phone_number)
+                        await asyncio.sleep(1)
+                # Signal rate limits the account, not the process, the bot and the other workers send from its budget
+                send_pacer = SharedSendPacer(
+                    self.queue,
+                    phone_number,
+                    rate=self.send_rate,
+                    min_rate=self.min_send_rate,
+                    max_rate=self.max_send_rate,
+                )
+                account = self.accounts[phone_number] = SenderAccount(phone_number, signal_api, send_pacer)
+        return account
+
+    async def send_one(
+        self,
+        account: SenderAccount,
+        subscriber: str,
+        send: Callable[[], Coroutine[Any, Any, int]],
+    ) -> DeliveryResult:
+        await account.send_pacer.acquire()
+        start = time.monotonic()
+        try:
+            timestamp = await send()
+        except Exception as e:
+            account.send_pacer.on_failure(e)
+            # The bot counts the failures by error class, a traceback now and then is enough here
+            now = time.monotonic()
+            if self._last_traceback_time is None or now - self._last_traceback_time >= self.TRACEBACK_LOG_INTERVAL:
+                self._last_traceback_time = now
+                self.logger.exception("Message not sent to %s", subscriber)
+            else:
+                self.logger.debug("Message not sent to %s", subscriber, exc_info=True)
+            error_class, is_rate_limited = get_error_class(e), is_rate_limit_error(e)
+            return DeliveryResult(subscriber, None, error_class, is_rate_limited, time.monotonic() - start)
+        account.send_pacer.on_success()
+        return DeliveryResult(subscriber, timestamp, latency=time.monotonic() - start)
+
+    async def deliver(self, batch: DeliveryBatch) -> list[DeliveryResult]:
+        account = await self.get_account(batch.phone_number, batch.signal_service)
+        payload = batch.payload
+        link_preview = None if payload["link_preview"] is None else LinkPreview.model_validate(payload["link_preview"])
+        # The bot saved the attachments as files on the same machine, they are streamed from there
+        attachment_paths = None
+        if payload["attachment_paths"] is not None:
+            attachment_paths = [Path(path) for path in payload["attachment_paths"]]
+
+        def send(subscriber: str, target_timestamp: int | None) -> Callable[[], Coroutine[Any, Any, int]]:
+            if payload["message_type"] == MessageType.DELETE_MESSAGE.name:
+                return lambda: account.remote_delete(subscriber, target_timestamp)
+            return lambda: account.send(
+                subscriber,
+                payload["message"],
+                attachment_paths=attachment_paths,
+                link_preview=link_preview,
+                edit_timestamp=target_timestamp,
+                view_once=payload["view_once"],
+            )
+
+        if payload["send_many"] and len(batch.recipients) > 1:
+            # The bot only batches the subscribers of an edit that share the timestamp to edit
+            edit_timestamp = batch.recipients[0][1]
+            subscribers = [subscriber for subscriber, _ in batch.recipients]
+            return await self.deliver_many(
+                account,
+                subscribers,
+                lambda: account.send_to_many(
+                    subscribers,
+                    payload["message"],
+                    attachment_paths=attachment_paths,
+                    link_preview=link_preview,
+                    edit_timestamp=edit_timestamp,
+                    view_once=payload["view_once"],
+                ),
+                lambda subscriber: send(subscriber, edit_timestamp),
+            )
+
+        return [
+            await self.send_one(account, subscriber, send(subscriber, target_timestamp))
+            for subscriber, target_timestamp in batch.recipients
+        ]
+
+    async def deliver_many(
+        self,
+        account: SenderAccount,
+        subscribers: list[str],
+        send_many: Callable[[], Coroutine[Any, Any, SendResult]],
+        send: Callable[[str], Callable[[], Coroutine[Any, Any, int]]],
+    ) -> list[DeliveryResult]:
+        for attempt in range(1, self.BATCH_ATTEMPTS + 1):
+            # Signal rate limits every delivered message, not every request
+            await account.send_pacer.acquire(len(subscribers))
+            start = time.monotonic()
+            try:
+                result = await send_many()
+                break
+            except Exception as e:
+                account.send_pacer.on_failure(e)
+                # Nobody got it when signal-cli rejected or never got the request, the whole batch can go again
+                if attempt < self.BATCH_ATTEMPTS and is_retryable_error(e):
+                    self.logger.warning("Batch of %d not sent, retrying: %s", len(subscribers), e)
+                    continue
+                # Otherwise some may have got it already, better to miss a message than to send it twice
+                self.logger.exception("Batch of %d not sent", len(subscribers))
+                error_class, is_rate_limited = get_error_class(e), is_rate_limit_error(e)
+                latency = time.monotonic() - start
+                return [
+                    DeliveryResult(subscriber, None, error_class, is_rate_limited, latency)
+                    for subscriber in subscribers
+                ]
+
+        rate_limit_error = result.get_rate_limit_error()
+        if rate_limit_error is None:
+            account.send_pacer.on_success()
+        else:
+            account.send_pacer.on_failure(rate_limit_error)
+        latency = time.monotonic() - start
+        results = []
+        for subscriber in subscribers:
+            failure_type = result.failed.get(subscriber)
+            if failure_type is None and result.timestamp is None:
+                results.append(DeliveryResult(subscriber, None, SENT_WITHOUT_TIMESTAMP, latency=latency))
+            elif failure_type is None:
+                results.append(DeliveryResult(subscriber, result.timestamp, latency=latency))
+            elif failure_type in RECIPIENT_FAILURES:
+                results.append(DeliveryResult(subscriber, None, failure_type, latency=latency))
+            else:
+                # Only the recipients signal-cli could not send to are tried again
+                results.append(await self.send_one(account, subscriber, send(subscriber)))
+        return results
+
+    async def work(self) -> None:
+        while True:
+            batch = await asyncio.to_thread(self.queue.claim, self.worker_id)
+            if batch is None:
+                if os.getppid() != self._parent_pid:
+                    # The bot is gone, nobody would read the results
+                    return
+                await asyncio.sleep(self.POLL_INTERVAL)
+                continue
+
+            # The pacer can make a batch wait longer than the lease, it is renewed until the batch is sent
+            renew_task = asyncio.create_task(self.renew_lease(batch))
+            try:
+                results = await self.deliver(batch)
+            finally:
+                renew_task.cancel()
+            await asyncio.to_thread(self.queue.complete, batch, results)
+
+    async def renew_lease(self, batch: DeliveryBatch) -> None:
+        while True:
+            await asyncio.sleep(DeliveryQueue.LEASE_SECONDS / 3)
+            if not await asyncio.to_thread(self.queue.renew, batch, self.worker_id):
+                self.logger.warning("Lease of batch %d lost, another worker may send it too", batch.batch_id)
+                return
+
+    async def run(self) -> None:
+        self.logger.info("Delivery worker %s started", self.worker_id)
+        await asyncio.gather(*(self.work() for _ in range(self.concurrency)))
+        if self.jsonrpc_client is not None:
+            await self.jsonrpc_client.close()
+        self.logger.info("Delivery worker %s stopped", self.worker_id)
+
+
+async def run_delivery_process(  # noqa: PLR0913 Too many arguments in function definition
+    logger: Logger,
+    queue_path: Path,
+    worker_id: str,
+    concurrency: int,
+    send_rate: float,
+    min_send_rate: float,
+    max_send_rate: float,
+    log_level: int = logging.INFO,
+    signal_cli_jsonrpc: str | None = None,
+    jsonrpc_signal_service: str | None = None,
+) -> None:
+    jsonrpc_args = []
+    if signal_cli_jsonrpc is not None:
+        jsonrpc_args = ["--signal_cli_jsonrpc", signal_cli_jsonrpc, "--jsonrpc_signal_service", jsonrpc_signal_service]
+    # Keep a worker process running, starting it again if it stops, until the task is cancelled
+    while True:
+        process = await asyncio.create_subprocess_exec(
+            sys.executable,
+            "-m",
+            "signalblast.delivery_worker",
+            "--queue_path",
+            str(queue_path),
+            "--worker_id",
+            worker_id,
+            "--concurrency",
+            str(concurrency),
+            "--send_rate",
+            str(send_rate),
+            "--min_send_rate",
+            str(min_send_rate),
+            "--max_send_rate",
+            str(max_send_rate),
+            "--log_level",
+            logging.getLevelName(log_level),
+            *jsonrpc_args,
+        )
+        try:
+            return_code = await process.wait()
+        except asyncio.CancelledError:
+            process.terminate()
+            await process.wait()
+            raise
+        logger.warning("Delivery worker %s stopped with code %d, starting it again", worker_id, return_code)
+        await asyncio.sleep(1)
+
+
+if __name__ == "__main__":
+    args_parser = argparse.ArgumentParser()
+    args_parser.add_argument("--queue_path", type=Path, required=True, help="the delivery queue database of the bot")
+    args_parser.add_argument("--worker_id", type=str, default=str(os.getpid()), help="the name in the claims")
+    args_parser.add_argument("--concurrency", type=int, default=4, help="the batches being sent at the same time")
+    args_parser.add_argument("--send_rate", type=float, default=5.0, help="the initial messages per second")
+    args_parser.add_argument("--min_send_rate", type=float, default=0.5, help="the lowest messages per second")
+    args_parser.add_argument("--max_send_rate", type=float, default=20.0, help="the highest messages per second")
+    args_parser.add_argument("--signal_cli_jsonrpc", type=str, help="the signal-cli daemon to send through")
+    args_parser.add_argument("--jsonrpc_signal_service", type=str, help="the signal-cli-rest-api of that daemon")
+    args_parser.add_argument("--log_level", type=str, default="INFO", help="the minimum level of the logged messages")
+    args = args_parser.parse_args()
+
+    # Logs to the console, several processes cannot rotate the same log file
+    create_or_set_logger("signalbot", logging.WARNING)
+    worker = DeliveryWorker(
+        queue=DeliveryQueue.load(args.queue_path),
+        worker_id=args.worker_id,
+        logger=create_or_set_logger(f"signalblast.delivery_worker.{args.worker_id}", args.log_level),
+        concurrency=args.concurrency,
+        send_rate=args.send_rate,
+        min_send_rate=args.min_send_rate,
+        max_send_rate=args.max_send_rate,
+        signal_cli_jsonrpc=args.signal_cli_jsonrpc,
+        jsonrpc_signal_service=args.jsonrpc_signal_service,
+    )
+    asyncio.run(worker.run())
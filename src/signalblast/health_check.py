@@ -1,31 +1,131 @@
 import asyncio
+import time
 
 from signalblast.broadcastbot import BroadcasBot
+from signalblast.commands import Broadcast
+from signalblast.metrics import OPENMETRICS_CONTENT_TYPE
+from signalblast.outbound import Lane
 
 
-async def health_check(bot: BroadcasBot, receiver: str, port: int) -> None:
-    async def handle_health_check_request(
-        _reader: asyncio.streams.StreamReader,
-        writer: asyncio.streams.StreamWriter,
+async def read_request_path(reader: asyncio.streams.StreamReader) -> str:
+    # Only the path is needed, but read the headers too so closing the connection does not reset it
+    request_line = await reader.readline()
+    while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+        pass
+
+    request = request_line.decode("latin-1").split()
+    return request[1] if len(request) > 1 else "/"
+
+
+class HealthCheck:
+    """Signal is pinged and signal-cli is checked in the background, the requests are answered from the last results.
+    A health check never waits for signal-cli, which can be busy for a long time when broadcasting.
+    Without a receiver nothing is probed, only the metrics and the broadcasts' progress are served."""
+
+    STALLED_BROADCAST_SECONDS = 5 * 60
+    PING_TIMEOUT_SECONDS = 30
+
+    def __init__(
+        self,
+        bot: BroadcasBot,
+        broadcast: Broadcast,
+        receiver: str | None,
+        ping_interval: float,
+        reachability_interval: float = 60,
     ) -> None:
-        bot.logger.info("Handle health check request")
+        self.bot = bot
+        self.broadcast = broadcast
+        self.receiver = receiver
+        self.ping_interval = ping_interval
+        self.reachability_interval = reachability_interval
+        # None until the first probe finishes
+        self.is_signal_cli_reachable: bool | None = None
+        self.is_last_ping_ok: bool | None = None
+        self.last_ping_time: float | None = None
 
+    async def ping(self) -> None:
+        # The health check is to send a ping message to receiver
         try:
-            # The health check is to send a ping message to receiver
-            await asyncio.wait_for(bot.send(receiver, "Ping"), timeout=30)
-            response = "HTTP/1.0 200 OK\r\n\r\nOK \r\n"
+            await asyncio.wait_for(
+                self.bot.send(self.receiver, "Ping", lane=Lane.ADMIN),
+                timeout=self.PING_TIMEOUT_SECONDS,
+            )
+            self.is_last_ping_ok = True
+            self.bot.logger.info("Health check message sent")
+        except Exception:
+            self.bot.logger.exception("Health check message not sent")
+            self.is_last_ping_ok = False
+        self.last_ping_time = time.monotonic()
+
+    async def probe_periodically(self) -> None:
+        # Also sets whether signal-cli is reached over http or https, so it has to go before the other checks
+        self.is_signal_cli_reachable = False
+        await self.bot.wait_for_signal_service()
+        while True:
+            self.is_signal_cli_reachable = await self.bot.is_signal_service_reachable()
+            if not self.is_signal_cli_reachable:
+                self.bot.logger.warning("Cannot reach the signal-cli-rest-api service")
+
+            if self.last_ping_time is None or time.monotonic() - self.last_ping_time >= self.ping_interval:
+                await self.ping()
+
+            await asyncio.sleep(self.reachability_interval)
 
-            bot.logger.info("Health check message sent")
+    def readiness(self) -> tuple[bool, str]:
+        now = time.monotonic()
+        in_progress = list(self.broadcast.in_progress.values())
+        for progress in in_progress:
+            if now - progress.last_update > self.STALLED_BROADCAST_SECONDS:
+                return False, f"Broadcast stalled at {progress.num_done} out of {progress.num_recipients}"
+
+        if len(in_progress) > 0:
+            # signal-cli is busy but working, a failed ping or reachability check is expected
+            num_done = sum(progress.num_done for progress in in_progress)
+            num_recipients = sum(progress.num_recipients for progress in in_progress)
+            return True, f"Broadcasting, {num_done} out of {num_recipients} done"
+
+        if self.is_signal_cli_reachable is False:
+            return False, "signal-cli-rest-api is not reachable"
+
+        if self.is_last_ping_ok is False:
+            return False, "Could not send the health check message"
+
+        return True, "OK"
+
+    async def handle_request(
+        self,
+        reader: asyncio.streams.StreamReader,
+        writer: asyncio.streams.StreamWriter,
+    ) -> None:
+        try:
+            path = await asyncio.wait_for(read_request_path(reader), timeout=5)
         except Exception:
-            bot.logger.exception("")
-            response = "HTTP/1.0 500 Internal Server Error\r\n\r\nInternal Server Error \r\n"
+            self.bot.logger.exception("")
+            path = "/"
+
+        if path == "/metrics":
+            response = f"HTTP/1.0 200 OK\r\nContent-Type: {OPENMETRICS_CONTENT_TYPE}\r\n\r\n{self.bot.metrics.expose()}"
+        elif path == "/live":
+            # Answering at all means the event loop is running
+            response = "HTTP/1.0 200 OK\r\n\r\nOK \r\n"
+        elif path in ("/", "/ready"):
+            is_ready, reason = self.readiness()
+            if is_ready:
+                response = f"HTTP/1.0 200 OK\r\n\r\n{reason} \r\n"
+            else:
+                self.bot.logger.warning("Health check failed: %s", reason)
+                response = f"HTTP/1.0 503 Service Unavailable\r\n\r\n{reason} \r\n"
+        else:
+            response = "HTTP/1.0 404 Not Found\r\n\r\nNot Found \r\n"
 
         writer.write(response.encode("utf8"))
         await writer.drain()
         writer.close()
 
-        bot.logger.info("Health check performed")
-
-    server = await asyncio.start_server(handle_health_check_request, "localhost", port)
-    async with server:
-        await server.serve_forever()
+    async def run(self, port: int) -> None:
+        server = await asyncio.start_server(self.handle_request, "localhost", port)
+        async with server:
+            if self.receiver is None:
+                await server.serve_forever()
+            else:
+                await asyncio.gather(server.serve_forever(), self.probe_periodically())
@@ -0,0 +1,312 @@
+from __future__ import annotations
+
+import asyncio
+import base64
+import binascii
+import itertools
+import json
+from typing import TYPE_CHECKING, Any, Literal
+
+from signalbot import SendMessageError
+from signalbot.api import ReactionError, RemoteDeleteError, SignalAPI
+
+from signalblast.attachments import get_content_type, iter_base64, read_content_type
+
+if TYPE_CHECKING:
+    from collections.abc import Iterable
+    from pathlib import Path
+
+
+def to_data_uri(base64_attachment: str) -> str:
+    # signal-cli only takes the attachments as files or data URIs, signal-cli-rest-api also takes plain base64
+    if base64_attachment.startswith("data:"):
+        return base64_attachment
+    try:
+        header = base64.b64decode(base64_attachment[:24])
+    except binascii.Error:
+        header = b""
+    return f"data:{get_content_type(header)};base64,{base64_attachment}"
+
+
+def recipient_params(receivers: Iterable[str]) -> dict[str, Any]:
+    # signal-cli-rest-api names the groups as group. and the base64 of their internal id
+    receivers = list(receivers)
+    if len(receivers) == 1 and receivers[0].startswith("group."):
+        return {"groupId": base64.b64decode(receivers[0].removeprefix("group.")).decode()}
+    return {"recipient": receivers}
+
+
+def get_failed_recipients(receivers: Iterable[str], results: Iterable[dict[str, Any]]) -> dict[str, str]:
+    # The receivers signal-cli could not send to and why, they are reported by uuid or number
+    receivers = set(receivers)
+    failed = {}
+    for recipient_result in results:
+        result_type = recipient_result.get("type", "SUCCESS")
+        if result_type == "SUCCESS":
+            continue
+        address = recipient_result.get("recipientAddress", {})
+        receiver = next((address[key] for key in ("uuid", "number") if address.get(key) in receivers), None)
+        if receiver is not None:
+            failed[receiver] = result_type
+    return failed
+
+
+class JsonRpcError(Exception):
+    def __init__(self, code: int | str, message: str, data: Any = None) -> None:  # noqa: ANN401 Depends on the error
+        super().__init__(f"{message} ({code})")
+        self.code = code
+        self.data = data
+
+
+class JsonRpcClient:
+    """Requests to a signal-cli daemon over JSON-RPC, one json object per line on a single connection.
+    The requests do not wait for the previous ones to be answered, the responses are matched to their
+    request by id. The address is either host:port or the path of a unix socket."""
+
+    READ_LIMIT = 16 * 1024 * 1024
+
+    def __init__(self, address: str, timeout: float = 60.0) -> None:
+        self.address = address
+        self.timeout = timeout
+        self._writer: asyncio.StreamWriter | None = None
+        self._read_task: asyncio.Task | None = None
+        self._pending: dict[int, asyncio.Future] = {}
+        self._ids = itertools.count(1)
+        self._connect_lock = asyncio.Lock()
+        # A request streaming its attachments is written over several awaits, the others wait for its last line
+        self._write_lock = asyncio.Lock()
+
+    async def connect(self) -> asyncio.StreamWriter:
+        async with self._connect_lock:
+            if self._writer is not None and not self._writer.is_closing():
+                return self._writer
+            host, _, port = self.address.rpartition(":")
+            if port.isdigit():
+                reader, writer = await asyncio.open_connection(host, int(port), limit=self.READ_LIMIT)
+            else:
+                reader, writer = await asyncio.open_unix_connection(self.address, limit=self.READ_LIMIT)
+            self._writer = writer
+            self._read_task = asyncio.create_task(self._read_responses(reader, writer))
+            return writer
+
+    async def _read_responses(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while line := await reader.readline():
+                response = json.loads(line)
+                # The messages the account receives come as notifications without id, they are read elsewhere
+                future = self._pending.pop(response.get("id"), None)
+                if future is None or future.done():
+                    continue
+                error = response.get("error")
+                if error is not None:
+                    future.set_exception(
+                        JsonRpcError(error.get("code", 0), error.get("message", ""), error.get("data")),
+                    )
+                else:
+                    future.set_result(response.get("result"))
+        finally:
+            self.disconnect(writer)
+
+    def disconnect(self, writer: asyncio.StreamWriter) -> None:
+        # The requests still waiting will never be answered, the next request connects again
+        writer.close()
+        if self._writer is writer:
+            self._writer = None
+        pending, self._pending = self._pending, {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError(f"Lost the connection to {self.address}"))
+
+    @staticmethod
+    async def write_attachments(writer: asyncio.StreamWriter, line: bytes, attachments: list[Path]) -> None:
+        # The attachments are added to the end of the params as data URIs, one chunk of base64 at a time
+        writer.write(line.removesuffix(b"}}\n") + b', "attachments": [')
+        for i, path in enumerate(attachments):
+            writer.write(f'{", " if i > 0 else ""}"data:{read_content_type(path)};base64,'.encode())
+            for chunk in iter_base64(path):
+                writer.write(chunk)
+                await writer.drain()
+            writer.write(b'"')
+        writer.write(b"]}}\n")
+
+    async def request(
+        self,
+        method: str,
+        params: dict[str, Any],
+        attachments: list[Path] | None = None,
+    ) -> Any:  # noqa: ANN401 Depends on the method
+        writer = await self.connect()
+        request_id = next(self._ids)
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = future
+        try:
+            message = {"jsonrpc": "2.0", "method": method, "id": request_id, "params": params}
+            line = json.dumps(message).encode() + b"\n"
+            async with self._write_lock:
+                is_line_written = False
+                try:
+                    if attachments:
+                        await self.write_attachments(writer, line, attachments)
+                    else:
+                        writer.write(line)
+                    is_line_written = True
+                    await writer.drain()
+                except BaseException:
+                    # Half a line would make signal-cli fail to parse the requests after it on the same connection
+                    if not is_line_written:
+                        self._pending.pop(request_id, None)
+                        self.disconnect(writer)
+                    raise
+            return await asyncio.wait_for(future, self.timeout)
+        finally:
+            self._pending.pop(request_id, None)
+
+    async def close(self) -> None:
+        if self._writer is not None:
+            self._writer.close()
+        if self._read_task is not None:
+            await asyncio.gather(self._read_task, return_exceptions=True)
+
+
+class JsonRpcResponse:
+    # Has the json() of the aiohttp responses, so signalbot reads the timestamps the same way
+    def __init__(self, result: dict[str, Any] | None) -> None:
+        self.result = result or {}
+
+    async def json(self) -> dict[str, Any]:
+        return self.result
+
+
+class JsonRpcSignalAPI(SignalAPI):
+    """signalbot's SignalAPI sending the messages, receipts and deletes to the signal-cli daemon over JSON-RPC,
+    with many requests in flight on one connection instead of an HTTP request each. Everything else, receiving
+    included, still goes through signal-cli-rest-api."""
+
+    def __init__(
+        self,
+        signal_service: str,
+        phone_number: str,
+        client: JsonRpcClient,
+        download_attachments: bool = True,  # noqa: FBT001, FBT002 Same arguments as SignalAPI
+    ) -> None:
+        super().__init__(signal_service, phone_number, download_attachments)
+        self.client = client
+
+    async def request(
+        self,
+        method: str,
+        params: dict[str, Any],
+        attachments: list[Path] | None = None,
+    ) -> dict[str, Any]:
+        try:
+            return await self.client.request(method, {"account": self.phone_number, **params}, attachments) or {}
+        except JsonRpcError as e:
+            # When nobody got the message signal-cli answers with an error, the results are still in its data
+            response = e.data.get("response") if isinstance(e.data, dict) else None
+            if not isinstance(response, dict) or len(response.get("results", [])) == 0:
+                raise
+            return response
+
+    @staticmethod
+    def raise_for_single_recipient(receivers: list[str], result: dict[str, Any]) -> None:
+        # Sending to several recipients succeeds as long as one gets it, the caller checks the results of each one.
+        # A single recipient, or group, has failed when nobody got the message
+        results = result.get("results", [])
+        if len(receivers) > 1 or len(results) == 0:
+            return
+        if all(recipient_result.get("type", "SUCCESS") != "SUCCESS" for recipient_result in results):
+            result_type = results[0].get("type")
+            recipient = results[0].get("recipientAddress", {})
+            error_msg = f"{result_type.replace('_', ' ').lower()} for {recipient.get('uuid')}"
+            raise JsonRpcError(result_type, error_msg)
+
+    async def send(  # noqa: PLR0913 Too many arguments in function definition
+        self,
+        receiver: str,
+        message: str,
+        *,
+        base64_attachments: list | None = None,
+        link_preview: dict[str, Any] | None = None,
+        quote_author: str | None = None,
+        quote_mentions: list | None = None,
+        quote_message: str | None = None,
+        quote_timestamp: int | None = None,
+        mentions: list[dict[str, Any]] | None = None,
+        text_mode: str | None = None,  # noqa: ARG002 signal-cli takes the text styles by position instead
+        edit_timestamp: int | None = None,
+        view_once: bool = False,
+    ) -> JsonRpcResponse:
+        params = {}
+        if quote_timestamp:
+            params["quoteTimestamp"] = quote_timestamp
+            params["quoteAuthor"] = quote_author
+            params["quoteMessage"] = quote_message
+            if quote_mentions:
+                params["quoteMention"] = [f"{m['start']}:{m['length']}:{m['author']}" for m in quote_mentions]
+        if mentions:
+            params["mention"] = [f"{m['start']}:{m['length']}:{m['author']}" for m in mentions]
+        return await self.send_to_many(
+            [receiver],
+            message,
+            base64_attachments=base64_attachments,
+            link_preview=link_preview,
+            edit_timestamp=edit_timestamp,
+            view_once=view_once,
+            extra_params=params,
+        )
+
+    async def send_to_many(  # noqa: PLR0913 Too many arguments in function definition
+        self,
+        receivers: list[str],
+        message: str,
+        *,
+        base64_attachments: list | None = None,
+        link_preview: dict[str, Any] | None = None,
+        edit_timestamp: int | None = None,
+        view_once: bool = False,
+        extra_params: dict[str, Any] | None = None,
+        attachment_paths: list[Path] | None = None,
+    ) -> JsonRpcResponse:
+        params = {**recipient_params(receivers), "message": message, **(extra_params or {})}
+        if base64_attachments:
+            params["attachments"] = [to_data_uri(attachment) for attachment in base64_attachments]
+        if link_preview:
+            params["previewUrl"] = link_preview["url"]
+            params["previewTitle"] = link_preview.get("title") or ""
+            params["previewDescription"] = link_preview.get("description") or ""
+            if link_preview.get("base64_thumbnail"):
+                params["previewImage"] = to_data_uri(link_preview["base64_thumbnail"])
+        if edit_timestamp:
+            params["editTimestamp"] = edit_timestamp
+        if view_once:
+            params["viewOnce"] = True
+
+        try:
+            result = await self.request("send", params, attachment_paths)
+            self.raise_for_single_recipient(receivers, result)
+            return JsonRpcResponse(result)
+        except (JsonRpcError, ConnectionError, TimeoutError, asyncio.TimeoutError) as e:
+            raise SendMessageError from e
+
+    async def receipt(
+        self,
+        recipient: str,
+        receipt_type: Literal["read", "viewed"],
+        timestamp: int,
+    ) -> JsonRpcResponse:
+        params = {"recipient": recipient, "targetTimestamp": [timestamp], "type": receipt_type}
+        try:
+            result = await self.request("sendReceipt", params)
+            self.raise_for_single_recipient([recipient], result)
+            return JsonRpcResponse(result)
+        except (JsonRpcError, ConnectionError, TimeoutError, asyncio.TimeoutError) as e:
+            raise ReactionError from e
+
+    async def remote_delete(self, receiver: str, timestamp: int) -> JsonRpcResponse:
+        params = {**recipient_params([receiver]), "targetTimestamp": timestamp}
+        try:
+            result = await self.request("remoteDelete", params)
+            self.raise_for_single_recipient([receiver], result)
+            return JsonRpcResponse(result)
+        except (JsonRpcError, ConnectionError, TimeoutError, asyncio.TimeoutError) as e:
+            raise RemoteDeleteError from e
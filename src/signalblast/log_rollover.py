@@ -2,20 +2,24 @@ import asyncio
 from logging.handlers import TimedRotatingFileHandler
 
 from signalblast.broadcastbot import BroadcasBot
+from signalblast.utils import get_log_handlers
 
 
 async def rotate_logs_periodically(bot: BroadcasBot) -> None:
     # Ensure the logs are rotated periodically even if no new log entries are made
-    if len(bot.logger.handlers) == 0:
+    handlers = [handler for handler in get_log_handlers(bot.logger) if isinstance(handler, TimedRotatingFileHandler)]
+    if len(handlers) == 0:
         return
 
-    handler = bot.logger.handlers[0]
-
-    if not isinstance(handler, TimedRotatingFileHandler):
-        return
+    handler = handlers[0]
 
     while True:
-        if handler.shouldRollover(None):
-            handler.doRollover()
+        # The listener thread could be writing a record at the same time
+        handler.acquire()
+        try:
+            if handler.shouldRollover(None):
+                handler.doRollover()
+        finally:
+            handler.release()
 
         await asyncio.sleep(60 * 60 * 12)  # Check every 12 hours
@@ -4,25 +4,36 @@ import argparse
 import asyncio
 import logging
 import os
+import signal
+from pathlib import Path
 
+from signalblast.accounts import parse_accounts
+from signalblast.admission import BroadcastAdmission
 from signalblast.broadcastbot import BroadcasBot
 from signalblast.commands import (
     AddAdmin,
     BanSubscriber,
     Broadcast,
+    CommandDispatcher,
     DisplayHelp,
     LastMsgUserUuid,
     LiftBanSubscriber,
     MessageFromAdmin,
     MessageToAdmin,
+    Receipts,
     RemoveAdmin,
     SetPing,
     Subscribe,
     UnsetPing,
     Unsubscribe,
 )
-from signalblast.health_check import health_check
+from signalblast.commands_strings import CommandRegex
+from signalblast.delivery_queue import DeliveryQueue
+from signalblast.delivery_worker import run_delivery_process
+from signalblast.health_check import HealthCheck
 from signalblast.log_rollover import rotate_logs_periodically
+from signalblast.metrics import monitor_event_loop_lag
+from signalblast.send_pacer import SendPacer, SharedSendPacer
 from signalblast.utils import create_or_set_logger, get_code_data_path
 
 LOGGING_LEVEL = logging.INFO
@@ -34,6 +45,27 @@ create_or_set_logger("signalbot", logging.WARNING, LOG_FILE_PATH)
 create_or_set_logger("apscheduler", logging.WARNING, LOG_FILE_PATH)
 
 
+def load_delivery_queue(
+    queue_path: Path,
+    delivery_processes: int,
+    outbound_slots: int,
+    reserved_slots: int,
+) -> DeliveryQueue | None:
+    if delivery_processes == 0:
+        return None
+    # The broadcasts take the slots the replies do not reserve, split between the processes
+    if reserved_slots < 1 or delivery_processes > outbound_slots - reserved_slots:
+        value_error_msg = (
+            f"Invalid outbound slots for {delivery_processes} delivery processes, "
+            f"expected 0 < {reserved_slots} and {delivery_processes} <= {outbound_slots} - {reserved_slots}"
+        )
+        raise ValueError(value_error_msg)
+    delivery_queue = DeliveryQueue.load(queue_path)
+    delivery_queue.clear_batches()
+    delivery_queue.clear_send_pacers()
+    return delivery_queue
+
+
 async def initialise_bot(  # noqa: PLR0913 Too many arguments in function definition
     signal_service: str,
     phone_number: str,
@@ -42,7 +74,26 @@ async def initialise_bot(  # noqa: PLR0913 Too many arguments in function defini
     welcome_message: str | None = None,
     health_check_port: int = 15556,
     health_check_receiver: str | None = None,
+    health_check_interval: float = 60 * 60 * 8,
     instructions_url: str | None = None,
+    send_rate: float = 5.0,
+    min_send_rate: float = 0.5,
+    max_send_rate: float = 20.0,
+    broadcast_workers: int = 4,
+    send_batch_size: int = 100,
+    modify_workers: int = 16,
+    users_backend: str = "csv",
+    extra_accounts: list[tuple[str, str]] | None = None,
+    delivery_processes: int = 0,
+    log_level: int = LOGGING_LEVEL,
+    recipient_log_interval: int = 100,
+    signal_cli_jsonrpc: str | None = None,
+    outbound_slots: int = 32,
+    reserved_slots: int = 4,
+    concurrent_broadcasts: int | None = None,
+    broadcasts_per_hour: float | None = None,
+    broadcast_burst: float = 3.0,
+    signal_attachments_dir: str | None = None,
 ) -> BroadcasBot:
     config = {
         "signal_service": signal_service,
@@ -52,7 +103,22 @@ async def initialise_bot(  # noqa: PLR0913 Too many arguments in function defini
 
     get_code_data_path().mkdir(parents=True, exist_ok=True)
 
-    logger = create_or_set_logger("signalblast", LOGGING_LEVEL, LOG_FILE_PATH)
+    logger = create_or_set_logger("signalblast", log_level, LOG_FILE_PATH)
+
+    queue_path = get_code_data_path() / "delivery_queue.db"
+    delivery_queue = load_delivery_queue(queue_path, delivery_processes, outbound_slots, reserved_slots)
+
+    def create_send_pacer(account_phone_number: str) -> SendPacer:
+        if delivery_queue is None:
+            return SendPacer(rate=send_rate, min_rate=min_send_rate, max_rate=max_send_rate)
+        # The replies of the bot and the broadcasts of the delivery processes share the rate of the account
+        return SharedSendPacer(
+            delivery_queue,
+            account_phone_number,
+            rate=send_rate,
+            min_rate=min_send_rate,
+            max_rate=max_send_rate,
+        )
 
     bot = BroadcasBot(config)
     await bot.load_data(
@@ -61,29 +127,91 @@ async def initialise_bot(  # noqa: PLR0913 Too many arguments in function defini
         expiration_time=expiration_time,
         welcome_message=welcome_message,
         instructions_url=instructions_url,
+        send_pacer=create_send_pacer(phone_number),
+        users_backend=users_backend,
+        signal_cli_jsonrpc=signal_cli_jsonrpc,
+        # With delivery processes the bot only sends the replies, in the reserved slots
+        outbound_slots=outbound_slots if delivery_queue is None else reserved_slots,
+        reserved_slots=reserved_slots if delivery_queue is None else 0,
+        signal_attachments_dir=signal_attachments_dir,
     )
+    if signal_cli_jsonrpc is not None:
+        logger.info("Sending through the signal-cli daemon at %s", signal_cli_jsonrpc)
+    for extra_phone_number, extra_signal_service in extra_accounts or []:
+        bot.add_account(extra_phone_number, extra_signal_service, create_send_pacer(extra_phone_number))
+    if len(bot.accounts) > 1:
+        logger.info("Broadcasting from %d accounts", len(bot.accounts))
 
-    bot.register(Subscribe(bot=bot))
-    bot.register(Unsubscribe(bot=bot))
-    bot.register(Broadcast(bot=bot))
-    bot.register(DisplayHelp(bot=bot))
-    bot.register(AddAdmin(bot=bot))
-    bot.register(RemoveAdmin(bot=bot))
-    bot.register(BanSubscriber(bot=bot))
-    bot.register(LiftBanSubscriber(bot=bot))
-    bot.register(SetPing(bot=bot), contacts=False, groups=True)
-    bot.register(UnsetPing(bot=bot), contacts=False, groups=True)
-    bot.register(MessageToAdmin(bot=bot))
-    bot.register(MessageFromAdmin(bot=bot))
-    bot.register(LastMsgUserUuid(bot=bot))
+    if delivery_queue is not None:
+        for i in range(delivery_processes):
+            delivery_task = run_delivery_process(
+                logger,
+                queue_path,
+                worker_id=str(i),
+                concurrency=min(broadcast_workers, (outbound_slots - reserved_slots) // delivery_processes),
+                send_rate=send_rate,
+                min_send_rate=min_send_rate,
+                max_send_rate=max_send_rate,
+                log_level=log_level,
+                signal_cli_jsonrpc=signal_cli_jsonrpc,
+                jsonrpc_signal_service=signal_service,
+            )
+            bot.delivery_tasks.append(asyncio.create_task(delivery_task))
+        logger.info("Sending the broadcasts from %d delivery processes", delivery_processes)
 
-    bot.scheduler.add_job(bot.delete_old_timestamps, "interval", days=1)
+    # The new broadcasts are only queued if they are limited
+    admission = None
+    if concurrent_broadcasts is not None or broadcasts_per_hour is not None:
+        admission = BroadcastAdmission(
+            max_running=concurrent_broadcasts,
+            broadcasts_per_hour=broadcasts_per_hour,
+            burst=broadcast_burst,
+        )
 
-    if health_check_receiver is not None:
-        bot.health_check_task = asyncio.create_task(health_check(bot, health_check_receiver, health_check_port))
+    broadcast = Broadcast(
+        bot=bot,
+        num_send_workers=broadcast_workers,
+        send_batch_size=send_batch_size,
+        num_modify_workers=modify_workers,
+        delivery_queue=delivery_queue,
+        recipient_log_interval=recipient_log_interval,
+        admission=admission,
+    )
+    # A single registered command, so every message is matched once and handled by exactly one command
+    dispatcher = CommandDispatcher(bot=bot, default_command=broadcast)
+    dispatcher.add(CommandRegex.subscribe, Subscribe(bot=bot))
+    dispatcher.add(CommandRegex.unsubscribe, Unsubscribe(bot=bot))
+    dispatcher.add(CommandRegex.broadcast, broadcast)
+    dispatcher.add(CommandRegex.help, DisplayHelp(bot=bot))
+    dispatcher.add(CommandRegex.receipts, Receipts(bot=bot))
+    dispatcher.add(CommandRegex.add_admin, AddAdmin(bot=bot))
+    dispatcher.add(CommandRegex.remove_admin, RemoveAdmin(bot=bot))
+    dispatcher.add(CommandRegex.ban_subscriber, BanSubscriber(bot=bot))
+    dispatcher.add(CommandRegex.lift_ban_subscriber, LiftBanSubscriber(bot=bot))
+    dispatcher.add(CommandRegex.set_ping, SetPing(bot=bot), contacts=False, groups=True)
+    dispatcher.add(CommandRegex.unset_ping, UnsetPing(bot=bot), contacts=False, groups=True)
+    dispatcher.add(CommandRegex.msg_to_admin, MessageToAdmin(bot=bot))
+    dispatcher.add(CommandRegex.msg_from_admin, MessageFromAdmin(bot=bot))
+    dispatcher.add(CommandRegex.last_msg_user_uuid, LastMsgUserUuid(bot=bot))
+    bot.register(dispatcher, contacts=True, groups=True)
+
+    bot.scheduler.add_job(bot.delete_old_timestamps, "interval", hours=1)
+    bot.scheduler.add_job(bot.receipts.flush, "interval", minutes=1)
+
+    # Only the bot's own number receives the commands, the receipts of the other accounts are read on their own
+    bot.receipt_tasks = [asyncio.create_task(bot.receive_receipts(account)) for account in bot.accounts[1:]]
+
+    # The endpoint also serves /metrics, so it always runs, signal-cli is only probed with a health check receiver
+    health_check = HealthCheck(bot, broadcast, health_check_receiver, ping_interval=health_check_interval)
+    bot.health_check_task = asyncio.create_task(health_check.run(health_check_port))
 
     bot.log_rollover_task = asyncio.create_task(rotate_logs_periodically(bot))
 
+    bot.event_loop_lag_task = asyncio.create_task(monitor_event_loop_lag(bot.metrics))
+
+    # Finish the broadcasts that were interrupted by a restart
+    bot.resume_broadcasts_task = asyncio.create_task(broadcast.resume_jobs())
+
     return bot
 
 
@@ -129,7 +257,7 @@ if __name__ == "__main__":
         "--health_check_port",
         type=int,
         default=os.environ.get("SIGNALBLAST_HEALTHCHECK_PORT", "15556"),
-        help="the port that will be listening for health checks requests",
+        help="the port that will be listening for health checks and /metrics requests",
     )
 
     args_parser.add_argument(
@@ -139,6 +267,13 @@ if __name__ == "__main__":
         help="the contact or group to send messages for health checks",
     )
 
+    args_parser.add_argument(
+        "--health_check_interval",
+        type=float,
+        default=os.environ.get("SIGNALBLAST_HEALTHCHECK_INTERVAL", str(60 * 60 * 8)),
+        help="the seconds between health check messages, health check requests answer with the last result",
+    )
+
     args_parser.add_argument(
         "--instructions_url",
         type=str,
@@ -146,6 +281,141 @@ if __name__ == "__main__":
         help="URL for the help message",
     )
 
+    args_parser.add_argument(
+        "--send_rate",
+        type=float,
+        default=os.environ.get("SIGNALBLAST_SEND_RATE", "5"),
+        help="the initial number of messages per second when broadcasting",
+    )
+
+    args_parser.add_argument(
+        "--min_send_rate",
+        type=float,
+        default=os.environ.get("SIGNALBLAST_MIN_SEND_RATE", "0.5"),
+        help="the lowest messages per second the broadcast will back off to when rate limited",
+    )
+
+    args_parser.add_argument(
+        "--max_send_rate",
+        type=float,
+        default=os.environ.get("SIGNALBLAST_MAX_SEND_RATE", "20"),
+        help="the highest messages per second the broadcast will speed up to",
+    )
+
+    args_parser.add_argument(
+        "--broadcast_workers",
+        type=int,
+        default=os.environ.get("SIGNALBLAST_BROADCAST_WORKERS", "4"),
+        help="the maximum number of messages being sent at the same time when broadcasting",
+    )
+
+    args_parser.add_argument(
+        "--modify_workers",
+        type=int,
+        default=os.environ.get("SIGNALBLAST_MODIFY_WORKERS", "16"),
+        help="the maximum number of messages being edited or deleted at the same time",
+    )
+
+    args_parser.add_argument(
+        "--send_batch_size",
+        # The old name, from when only the attachments were batched
+        "--attachment_batch_size",
+        dest="send_batch_size",
+        type=int,
+        default=os.environ.get(
+            "SIGNALBLAST_SEND_BATCH_SIZE",
+            os.environ.get("SIGNALBLAST_ATTACHMENT_BATCH_SIZE", "100"),
+        ),
+        help="the number of subscribers that get a broadcast or edit in a single signal-cli request, 1 to disable",
+    )
+
+    args_parser.add_argument(
+        "--users_backend",
+        type=str,
+        choices=["csv", "sqlite"],
+        default=os.environ.get("SIGNALBLAST_USERS_BACKEND", "csv"),
+        help="where to store the subscribers and banned users, sqlite imports the existing csv files",
+    )
+
+    args_parser.add_argument(
+        "--extra_accounts",
+        type=str,
+        default=os.environ.get("SIGNALBLAST_EXTRA_ACCOUNTS"),
+        help="comma separated phone numbers of other registered accounts to share the broadcasts with, "
+        "as number or number@address when their signal cli rest api is not the one in --signal_service",
+    )
+
+    args_parser.add_argument(
+        "--delivery_processes",
+        type=int,
+        default=os.environ.get("SIGNALBLAST_DELIVERY_PROCESSES", "0"),
+        help="the number of processes sending the broadcasts, 0 to send them from the process receiving the commands",
+    )
+
+    args_parser.add_argument(
+        "--log_level",
+        type=str,
+        choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+        default=os.environ.get("SIGNALBLAST_LOG_LEVEL", "INFO"),
+        help="the minimum level of the logged messages, DEBUG logs every message sent to every subscriber",
+    )
+
+    args_parser.add_argument(
+        "--recipient_log_interval",
+        type=int,
+        default=os.environ.get("SIGNALBLAST_RECIPIENT_LOG_INTERVAL", "100"),
+        help="log the result for one in this many subscribers when broadcasting, 0 to only log the summary",
+    )
+
+    args_parser.add_argument(
+        "--signal_cli_jsonrpc",
+        type=str,
+        default=os.environ.get("SIGNALBLAST_SIGNAL_CLI_JSONRPC"),
+        help="host:port or unix socket of a signal-cli daemon, to send the messages to it directly over JSON-RPC",
+    )
+
+    args_parser.add_argument(
+        "--outbound_slots",
+        type=int,
+        default=os.environ.get("SIGNALBLAST_OUTBOUND_SLOTS", "32"),
+        help="the maximum number of requests to signal-cli in flight",
+    )
+
+    args_parser.add_argument(
+        "--reserved_slots",
+        type=int,
+        default=os.environ.get("SIGNALBLAST_RESERVED_SLOTS", "4"),
+        help="the requests in flight that are kept for the replies to commands and admin messages, not broadcasts",
+    )
+
+    args_parser.add_argument(
+        "--concurrent_broadcasts",
+        type=int,
+        default=os.environ.get("SIGNALBLAST_CONCURRENT_BROADCASTS"),
+        help="the number of new broadcasts sent at the same time, the rest wait for their turn, no limit by default",
+    )
+
+    args_parser.add_argument(
+        "--broadcasts_per_hour",
+        type=float,
+        default=os.environ.get("SIGNALBLAST_BROADCASTS_PER_HOUR"),
+        help="the broadcasts per hour each subscriber can send before theirs are held back, no limit by default",
+    )
+
+    args_parser.add_argument(
+        "--broadcast_burst",
+        type=float,
+        default=os.environ.get("SIGNALBLAST_BROADCAST_BURST", "3"),
+        help="the broadcasts a subscriber can send in a row before --broadcasts_per_hour applies",
+    )
+
+    args_parser.add_argument(
+        "--signal_attachments_dir",
+        type=str,
+        default=os.environ.get("SIGNALBLAST_SIGNAL_ATTACHMENTS_DIR"),
+        help="signal-cli's attachments folder, if the bot can read it the broadcasts send the attachments from there",
+    )
+
     args = args_parser.parse_args()
 
     if args.phone_number is None:
@@ -163,7 +433,30 @@ if __name__ == "__main__":
             welcome_message=args.welcome_message,
             health_check_port=args.health_check_port,
             health_check_receiver=args.health_check_receiver,
+            health_check_interval=args.health_check_interval,
             instructions_url=args.instructions_url,
+            send_rate=args.send_rate,
+            min_send_rate=args.min_send_rate,
+            max_send_rate=args.max_send_rate,
+            broadcast_workers=args.broadcast_workers,
+            send_batch_size=args.send_batch_size,
+            modify_workers=args.modify_workers,
+            users_backend=args.users_backend,
+            extra_accounts=parse_accounts(args.extra_accounts, args.signal_service),
+            delivery_processes=args.delivery_processes,
+            log_level=logging.getLevelName(args.log_level),
+            recipient_log_interval=args.recipient_log_interval,
+            signal_cli_jsonrpc=args.signal_cli_jsonrpc,
+            outbound_slots=args.outbound_slots,
+            reserved_slots=args.reserved_slots,
+            concurrent_broadcasts=args.concurrent_broadcasts,
+            broadcasts_per_hour=args.broadcasts_per_hour,
+            broadcast_burst=args.broadcast_burst,
+            signal_attachments_dir=args.signal_attachments_dir,
         ),
     )
+    # Stop the loop instead of exiting right away, so the pending changes can be written
+    for stop_signal in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(stop_signal, loop.stop)
     bot.start()
+    loop.run_until_complete(bot.shutdown())
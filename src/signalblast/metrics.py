@@ -0,0 +1,177 @@
+from __future__ import annotations
+
+import asyncio
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from collections.abc import Callable
+
+OPENMETRICS_CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+DURATION_BUCKETS = (1.0, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1800.0, 3600.0, 7200.0)
+LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0)
+
+
+def _format_labels(label_names: tuple[str, ...], label_values: tuple[str, ...], extra: str = "") -> str:
+    labels = [f'{name}="{value}"' for name, value in zip(label_names, label_values, strict=True)]
+    if extra:
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, label_names: tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self.values: dict[tuple[str, ...], float] = defaultdict(lambda: 0.0)
+
+    def inc(self, *label_values: str, amount: float = 1.0) -> None:
+        self.values[label_values] += amount
+
+    def expose(self) -> list[str]:
+        lines = [f"# TYPE {self.name} counter", f"# HELP {self.name} {self.documentation}"]
+        for label_values, value in self.values.items():
+            lines.append(f"{self.name}_total{_format_labels(self.label_names, label_values)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        buckets: tuple[float, ...],
+        label_names: tuple[str, ...] = (),
+    ) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.buckets = buckets
+        self.label_names = label_names
+        # Per label values, the observations in each bucket plus the ones above the last bucket, and their sum
+        self.counts: dict[tuple[str, ...], list[int]] = {}
+        self.sums: dict[tuple[str, ...], float] = defaultdict(lambda: 0.0)
+
+    def observe(self, value: float, *label_values: str) -> None:
+        if label_values not in self.counts:
+            self.counts[label_values] = [0] * (len(self.buckets) + 1)
+        self.counts[label_values][bisect_left(self.buckets, value)] += 1
+        self.sums[label_values] += value
+
+    def expose(self) -> list[str]:
+        lines = [f"# TYPE {self.name} histogram", f"# HELP {self.name} {self.documentation}"]
+        for label_values, counts in self.counts.items():
+            cumulative_count = 0
+            for bucket, count in zip([*self.buckets, "+Inf"], counts, strict=True):
+                cumulative_count += count
+                labels = _format_labels(self.label_names, label_values, f'le="{bucket}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative_count}")
+            labels = _format_labels(self.label_names, label_values)
+            lines.append(f"{self.name}_count{labels} {cumulative_count}")
+            lines.append(f"{self.name}_sum{labels} {self.sums[label_values]}")
+        return lines
+
+
+class Gauge:
+    """The value is read when the metrics are exposed, the callback returns it for each of the label values."""
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        callback: Callable[[], dict[tuple[str, ...], float]],
+        label_names: tuple[str, ...] = (),
+    ) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.callback = callback
+        self.label_names = label_names
+
+    def expose(self) -> list[str]:
+        lines = [f"# TYPE {self.name} gauge", f"# HELP {self.name} {self.documentation}"]
+        for label_values, value in self.callback().items():
+            lines.append(f"{self.name}{_format_labels(self.label_names, label_values)} {value}")
+        return lines
+
+
+class Metrics:
+    """Metrics exposed in the OpenMetrics text format, so they can be scraped by Prometheus or similar."""
+
+    def __init__(self) -> None:
+        self.broadcast_duration = Histogram(
+            "signalblast_broadcast_duration_seconds",
+            "Time to send, edit or delete a message for all the subscribers.",
+            DURATION_BUCKETS,
+            ("action",),
+        )
+        self.send_latency = Histogram(
+            "signalblast_send_latency_seconds",
+            "Time signal-cli takes to answer a request to send, edit or delete a message.",
+            LATENCY_BUCKETS,
+            ("action",),
+        )
+        self.messages = Counter(
+            "signalblast_messages",
+            "Messages sent, edited or deleted for a subscriber.",
+            ("action", "result"),
+        )
+        self.receipts = Counter(
+            "signalblast_receipts",
+            "Delivery and read receipts of the broadcasts, counted once per subscriber.",
+            ("type",),
+        )
+        self.outbound_queue_wait = Histogram(
+            "signalblast_outbound_queue_wait_seconds",
+            "Time a request to signal-cli waits for a free slot, by lane.",
+            LATENCY_BUCKETS,
+            ("lane",),
+        )
+        self.event_loop_lag = Histogram(
+            "signalblast_event_loop_lag_seconds",
+            "How late the event loop wakes up a sleeping task.",
+            LAG_BUCKETS,
+        )
+        self.command_duration = Histogram(
+            "signalblast_command_duration_seconds",
+            "Time to handle a message, by the command it was routed to.",
+            LATENCY_BUCKETS,
+            ("command",),
+        )
+        self.gauges: list[Gauge] = []
+
+    def add_gauge(
+        self,
+        name: str,
+        documentation: str,
+        callback: Callable[[], dict[tuple[str, ...], float]],
+        label_names: tuple[str, ...] = (),
+    ) -> None:
+        self.gauges.append(Gauge(name, documentation, callback, label_names))
+
+    def expose(self) -> str:
+        lines = []
+        metrics = [
+            self.broadcast_duration,
+            self.send_latency,
+            self.messages,
+            self.receipts,
+            self.outbound_queue_wait,
+            self.event_loop_lag,
+            self.command_duration,
+        ]
+        for metric in [*metrics, *self.gauges]:
+            lines.extend(metric.expose())
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+
+async def monitor_event_loop_lag(metrics: Metrics, interval: float = 1.0) -> None:
+    # Anything blocking the event loop delays every message the bot handles
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        metrics.event_loop_lag.observe(max(0.0, time.perf_counter() - start - interval))
@@ -0,0 +1,95 @@
+from __future__ import annotations
+
+import asyncio
+import heapq
+import itertools
+import time
+from contextlib import asynccontextmanager
+from enum import IntEnum
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from collections.abc import AsyncIterator
+
+    from signalblast.metrics import Histogram
+
+
+class Lane(IntEnum):
+    # Lower values go first
+    INTERACTIVE = 0
+    ADMIN = 1
+    BULK = 2
+
+
+class OutboundScheduler:
+    """Limits the requests to signal-cli in flight and hands the free slots out by lane: the replies to the commands
+    first, then the admin messages and last the broadcasts. The broadcasts never take the last reserved_slots, so a
+    reply does not wait for thousands of broadcast requests, at most for one to finish."""
+
+    def __init__(self, max_in_flight: int = 32, reserved_slots: int = 4, queue_wait: Histogram | None = None) -> None:
+        if not 0 <= reserved_slots < max_in_flight:
+            value_error_msg = f"Invalid outbound slots, expected 0 <= {reserved_slots} < {max_in_flight}"
+            raise ValueError(value_error_msg)
+
+        self.max_in_flight = max_in_flight
+        self.reserved_slots = reserved_slots
+        self.queue_wait = queue_wait
+        self.in_flight = 0
+        self._waiters: list[tuple[Lane, int, asyncio.Future]] = []
+        self._order = itertools.count()
+
+    def limit(self, lane: Lane) -> int:
+        return self.max_in_flight - self.reserved_slots if lane == Lane.BULK else self.max_in_flight
+
+    def num_queued(self) -> dict[tuple[str, ...], float]:
+        num_queued = dict.fromkeys(((lane.name.lower(),) for lane in Lane), 0)
+        for lane, _, future in self._waiters:
+            if not future.done():
+                num_queued[(lane.name.lower(),)] += 1
+        return num_queued
+
+    def _drop_cancelled(self) -> None:
+        while len(self._waiters) > 0 and self._waiters[0][2].done():
+            heapq.heappop(self._waiters)
+
+    def _wake_waiters(self) -> None:
+        # The first waiter has the highest priority, if it cannot go the ones after it cannot either
+        self._drop_cancelled()
+        while len(self._waiters) > 0 and self.in_flight < self.limit(self._waiters[0][0]):
+            _, _, future = heapq.heappop(self._waiters)
+            self.in_flight += 1
+            future.set_result(None)
+            self._drop_cancelled()
+
+    def _release(self) -> None:
+        self.in_flight -= 1
+        self._wake_waiters()
+
+    async def _acquire(self, lane: Lane) -> None:
+        self._drop_cancelled()
+        # Never go ahead of a waiter with the same or higher priority
+        is_first = len(self._waiters) == 0 or self._waiters[0][0] > lane
+        if is_first and self.in_flight < self.limit(lane):
+            self.in_flight += 1
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (lane, next(self._order), future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            # The slot was handed over just before the cancellation, give it to the next one
+            if future.done() and not future.cancelled():
+                self._release()
+            raise
+
+    @asynccontextmanager
+    async def slot(self, lane: Lane) -> AsyncIterator[None]:
+        start = time.monotonic()
+        await self._acquire(lane)
+        if self.queue_wait is not None:
+            self.queue_wait.observe(time.monotonic() - start, lane.name.lower())
+        try:
+            yield
+        finally:
+            self._release()
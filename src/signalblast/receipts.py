@@ -0,0 +1,193 @@
+from __future__ import annotations
+
+import json
+import time
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import sqlite3
+    from collections.abc import Mapping
+    from threading import Lock
+
+    from signalblast.timestamp_store import TimestampStore
+
+
+DELIVERED = 1
+READ = 2
+
+
+@dataclass
+class BroadcastReceipts:
+    author: str
+    timestamp: int
+    num_sent: int
+    num_delivered: int = 0
+    num_read: int = 0
+    # The receipts already counted for each recipient, indexed by their id in the recipients table
+    flags: bytearray = field(default_factory=bytearray, repr=False)
+
+
+class ReceiptStore:
+    """Delivery and read receipts of the broadcasts, counted once per subscriber.
+    The receipts only carry the timestamps the bot sent the messages with, they are matched to their broadcast
+    through an in memory index of the timestamps sent within the last INDEX_MS. The counts are written to the
+    database on flush() and kept for EXPIRATION_MS."""
+
+    INDEX_MS = 24 * 60 * 60 * 1000
+    EXPIRATION_MS = 30 * 24 * 60 * 60 * 1000
+
+    def __init__(self, connection: sqlite3.Connection, lock: Lock, timestamp_store: TimestampStore) -> None:
+        self.connection = connection
+        self.lock = lock
+        self.timestamp_store = timestamp_store
+        self.broadcasts: dict[tuple[str, int], BroadcastReceipts] = {}
+        self._index: dict[int, BroadcastReceipts] = {}
+        self._changed: set[tuple[str, int]] = set()
+
+    def add_broadcast(
+        self,
+        author: str,
+        timestamp: int,
+        broadcast_timestamps: Mapping[str, int],
+        target_timestamp: int | None = None,
+    ) -> None:
+        # Edits get new timestamps, their receipts count for the message they edited
+        if target_timestamp is not None:
+            receipts = self.broadcasts.get((author, target_timestamp))
+            if receipts is None:
+                return
+        else:
+            # The author also gets their own message, but it is not counted, same as in the reply to them
+            num_sent = len(broadcast_timestamps) - (author in broadcast_timestamps)
+            receipts = BroadcastReceipts(author, timestamp, num_sent)
+            self.broadcasts[(author, timestamp)] = receipts
+            self._changed.add((author, timestamp))
+
+        # Sending to several subscribers in one request gives all of them the same timestamp
+        for uuid, sent_timestamp in broadcast_timestamps.items():
+            if uuid != author:
+                self._index[sent_timestamp] = receipts
+
+    def ingest(self, raw_message: str) -> int:
+        """Count the receipt in the message received from signal-cli, returns DELIVERED, READ or 0 if it was
+        not a new receipt for a broadcast."""
+        # Most messages are not receipts, no need to decode them twice
+        if '"receiptMessage"' not in raw_message:
+            return 0
+        envelope = json.loads(raw_message).get("envelope", {})
+        receipt = envelope.get("receiptMessage")
+        recipient_id = self.timestamp_store.recipient_ids.get(envelope.get("sourceUuid"))
+        if receipt is None or recipient_id is None:
+            return 0
+
+        # A read implies it was delivered, in case the delivery receipt got lost
+        flag = READ | DELIVERED if receipt.get("isRead") or receipt.get("isViewed") else DELIVERED
+        if not receipt.get("isDelivery") and flag == DELIVERED:
+            return 0
+
+        counted = 0
+        for sent_timestamp in receipt.get("timestamps", []):
+            receipts = self._index.get(sent_timestamp)
+            if receipts is None:
+                continue
+            if recipient_id >= len(receipts.flags):
+                receipts.flags.extend(bytes(recipient_id + 1 - len(receipts.flags)))
+            new_flags = flag & ~receipts.flags[recipient_id]
+            if new_flags == 0:
+                continue
+            receipts.flags[recipient_id] |= new_flags
+            receipts.num_delivered += bool(new_flags & DELIVERED)
+            receipts.num_read += bool(new_flags & READ)
+            self._changed.add((receipts.author, receipts.timestamp))
+            counted = READ if new_flags & READ else DELIVERED
+        return counted
+
+    def flush(self) -> None:
+        changed = [
+            (
+                receipts.author,
+                receipts.timestamp,
+                receipts.timestamp + self.EXPIRATION_MS,
+                receipts.num_sent,
+                receipts.num_delivered,
+                receipts.num_read,
+                bytes(receipts.flags),
+            )
+            for receipts in (self.broadcasts[key] for key in self._changed if key in self.broadcasts)
+        ]
+        self._changed = set()
+        if len(changed) == 0:
+            return
+
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO broadcast_receipts (author, timestamp, expires_at, num_sent, num_delivered, "
+                "num_read, flags) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                changed,
+            )
+
+    def latest(self, author: str | None = None, limit: int = 5) -> list[BroadcastReceipts]:
+        # The latest broadcasts of the author, or from everyone if None
+        self.flush()
+        query = "SELECT author, timestamp, num_sent, num_delivered, num_read FROM broadcast_receipts"
+        params: list = []
+        if author is not None:
+            query += " WHERE author = ?"
+            params.append(author)
+        query += " ORDER BY timestamp DESC LIMIT ?"
+        params.append(limit)
+        with self.lock:
+            rows = self.connection.execute(query, params).fetchall()
+        return [BroadcastReceipts(*row) for row in rows]
+
+    def delete_expired(self, now_ms: int | None = None) -> int:
+        if now_ms is None:
+            now_ms = int(time.time() * 1000)
+        self.flush()
+
+        # Receipts for older messages are rare, stop matching them
+        index_start = now_ms - self.INDEX_MS
+        self.broadcasts = {key: value for key, value in self.broadcasts.items() if value.timestamp >= index_start}
+        self._index = {key: value for key, value in self._index.items() if value.timestamp >= index_start}
+
+        with self.lock, self.connection:
+            cursor = self.connection.execute("DELETE FROM broadcast_receipts WHERE expires_at < ?", [now_ms])
+        return cursor.rowcount
+
+    @staticmethod
+    def load(
+        connection: sqlite3.Connection,
+        lock: Lock,
+        timestamp_store: TimestampStore,
+        now_ms: int | None = None,
+    ) -> ReceiptStore:
+        if now_ms is None:
+            now_ms = int(time.time() * 1000)
+        store = ReceiptStore(connection, lock, timestamp_store)
+        with lock, connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS broadcast_receipts (author TEXT, timestamp INTEGER, expires_at INTEGER, "
+                "num_sent INTEGER, num_delivered INTEGER, num_read INTEGER, flags BLOB, "
+                "PRIMARY KEY (author, timestamp))",
+            )
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS broadcast_receipts_timestamp ON broadcast_receipts (timestamp)",
+            )
+            rows = connection.execute(
+                "SELECT author, timestamp, num_sent, num_delivered, num_read, flags FROM broadcast_receipts "
+                "WHERE timestamp >= ?",
+                [now_ms - store.INDEX_MS],
+            ).fetchall()
+
+        # Index the timestamps of the recent broadcasts again, only the original messages, not their edits
+        for author, timestamp, num_sent, num_delivered, num_read, flags in rows:
+            timestamp_data = timestamp_store.read(author, timestamp)
+            if timestamp_data is None:
+                continue
+            receipts = BroadcastReceipts(author, timestamp, num_sent, num_delivered, num_read, bytearray(flags))
+            store.broadcasts[(author, timestamp)] = receipts
+            for uuid, sent_timestamp in timestamp_data.broadcast_timestamps.items():
+                if uuid != author:
+                    store._index[sent_timestamp] = receipts
+        return store
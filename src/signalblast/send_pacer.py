@@ -0,0 +1,160 @@
+from __future__ import annotations
+
+import asyncio
+import time
+from contextlib import contextmanager
+from typing import TYPE_CHECKING
+
+from aiohttp import ClientResponseError
+
+if TYPE_CHECKING:
+    from collections.abc import Iterator
+
+    from signalblast.delivery_queue import DeliveryQueue
+
+RATE_LIMIT_STATUSES = (413, 429)
+
+
+def is_rate_limit_error(exception: BaseException | None) -> bool:
+    # signalbot raises its own errors from inside the except block, so the HTTP error is in the chain
+    while exception is not None:
+        if isinstance(exception, ClientResponseError) and exception.status in RATE_LIMIT_STATUSES:
+            return True
+        if "rate limit" in str(exception).lower():
+            return True
+        exception = exception.__cause__ or exception.__context__
+    return False
+
+
+class SendPacer:
+    """Token bucket whose refill rate follows AIMD: it grows additively while sends succeed and
+    it is cut multiplicatively when signal-cli reports a rate limit, at most once per message at the new rate."""
+
+    def __init__(  # noqa: PLR0913 Too many arguments in function definition
+        self,
+        rate: float = 5.0,
+        min_rate: float = 0.5,
+        max_rate: float = 20.0,
+        *,
+        additive_increase: float = 0.5,
+        multiplicative_decrease: float = 0.5,
+        burst: float = 1.0,
+    ) -> None:
+        if not 0 < min_rate <= rate <= max_rate:
+            value_error_msg = f"Invalid send rates, expected 0 < {min_rate} <= {rate} <= {max_rate}"
+            raise ValueError(value_error_msg)
+
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.additive_increase = additive_increase
+        self.multiplicative_decrease = multiplicative_decrease
+        self.burst = burst
+
+        self._tokens = burst
+        self._last_refill = time.monotonic()
+        self._last_decrease: float | None = None
+        self._lock = asyncio.Lock()
+
+        self.num_sent = 0
+        self.num_rate_limited = 0
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+
+    async def acquire(self, num_messages: int = 1) -> None:
+        async with self._lock:
+            for _ in range(num_messages):
+                self._refill()
+                while self._tokens < 1:
+                    await asyncio.sleep((1 - self._tokens) / self.rate)
+                    self._refill()
+                self._tokens -= 1
+                self.num_sent += 1
+
+    def take(self, num_messages: int = 1) -> None:
+        # For the messages that cannot wait, the tokens go below zero and the next acquire waits longer instead
+        self._refill()
+        self._tokens -= num_messages
+        self.num_sent += num_messages
+
+    def on_success(self) -> None:
+        # Roughly add additive_increase messages per second for every second of successful sends
+        self.rate = min(self.max_rate, self.rate + self.additive_increase / self.rate)
+
+    def on_failure(self, exception: BaseException) -> None:
+        if not is_rate_limit_error(exception):
+            return
+
+        self.num_rate_limited += 1
+        # The sends in flight when Signal started rate limiting all fail together, that is a single slow down
+        now = time.monotonic()
+        if self._last_decrease is not None and now - self._last_decrease < 1 / self.rate:
+            return
+        self._last_decrease = now
+        self.rate = max(self.min_rate, self.rate * self.multiplicative_decrease)
+        # Drop any saved up tokens so the next send waits for the new, slower rate
+        self._refill()
+        self._tokens = min(self._tokens, 0)
+
+
+class SharedSendPacer(SendPacer):
+    """SendPacer of an account whose bucket and rate are kept in the delivery queue, so the bot and every delivery
+    process send from the same budget and slow down together. The state is read and written back in a transaction
+    around each change. time.monotonic is the same clock in every process of the machine."""
+
+    def __init__(
+        self,
+        queue: DeliveryQueue,
+        phone_number: str,
+        rate: float = 5.0,
+        min_rate: float = 0.5,
+        max_rate: float = 20.0,
+        **kwargs: float,
+    ) -> None:
+        super().__init__(rate, min_rate, max_rate, **kwargs)
+        self.queue = queue
+        self.phone_number = phone_number
+
+    @contextmanager
+    def _shared_state(self) -> Iterator[None]:
+        with self.queue.transaction() as connection:
+            row = connection.execute(
+                "SELECT rate, tokens, last_refill, last_decrease FROM send_pacers WHERE phone_number = ?",
+                [self.phone_number],
+            ).fetchone()
+            # The first process to use the account starts it at the initial rate
+            if row is not None:
+                self.rate, self._tokens, self._last_refill, self._last_decrease = row
+            yield
+            connection.execute(
+                "INSERT OR REPLACE INTO send_pacers (phone_number, rate, tokens, last_refill, last_decrease) "
+                "VALUES (?, ?, ?, ?, ?)",
+                [self.phone_number, self.rate, self._tokens, self._last_refill, self._last_decrease],
+            )
+
+    def _reserve(self, num_messages: int) -> float:
+        # The tokens are taken at once and the wait is until the bucket is back to zero, the same as one at a time
+        with self._shared_state():
+            super().take(num_messages)
+            return max(0.0, -self._tokens / self.rate)
+
+    async def acquire(self, num_messages: int = 1) -> None:
+        wait = await asyncio.to_thread(self._reserve, num_messages)
+        await asyncio.sleep(wait)
+
+    def take(self, num_messages: int = 1) -> None:
+        with self._shared_state():
+            super().take(num_messages)
+
+    def on_success(self) -> None:
+        with self._shared_state():
+            super().on_success()
+
+    def on_failure(self, exception: BaseException) -> None:
+        if not is_rate_limit_error(exception):
+            return
+        with self._shared_state():
+            super().on_failure(exception)
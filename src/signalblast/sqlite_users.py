@@ -0,0 +1,109 @@
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+
+from signalblast.users import Users
+
+if TYPE_CHECKING:
+    import sqlite3
+    from collections.abc import Iterator
+    from pathlib import Path
+    from threading import Lock
+
+
+class SqliteUsers:
+    """Same interface as Users but the users live in a table of the bot's sqlite database
+    instead of being loaded in memory."""
+
+    _page_size = 1000
+
+    def __init__(self, connection: sqlite3.Connection, table: str, lock: Lock) -> None:
+        self.connection = connection
+        self.table = table
+        self.lock = lock
+        self._num_users = 0
+
+    async def add(self, uuid: str, phone_number: str | None) -> None:
+        with self.lock, self.connection:
+            cursor = self.connection.execute(
+                f"INSERT OR IGNORE INTO {self.table} (uuid, phone_number) VALUES (?, ?)",  # noqa: S608
+                [uuid, phone_number],
+            )
+            if cursor.rowcount == 0:
+                self.connection.execute(
+                    f"UPDATE {self.table} SET phone_number = ? WHERE uuid = ?",  # noqa: S608
+                    [phone_number, uuid],
+                )
+        self._num_users += cursor.rowcount
+
+    async def remove(self, uuid: str) -> None:
+        with self.lock, self.connection:
+            cursor = self.connection.execute(f"DELETE FROM {self.table} WHERE uuid = ?", [uuid])  # noqa: S608
+        if cursor.rowcount == 0:
+            raise KeyError(uuid)
+        self._num_users -= cursor.rowcount
+
+    async def compact(self) -> None:
+        # Nothing to do, sqlite persists every change on its own
+        return
+
+    async def flush(self) -> None:
+        return
+
+    def get_phone_number(self, uuid: str) -> str | None:
+        with self.lock:
+            row = self.connection.execute(
+                f"SELECT phone_number FROM {self.table} WHERE uuid = ?",  # noqa: S608
+                [uuid],
+            ).fetchone()
+        return None if row is None else row[0]
+
+    def __iter__(self) -> Iterator[str]:
+        # Go page by page, so the table can change while a broadcast is going through it
+        last_uuid = ""
+        while True:
+            with self.lock:
+                page = self.connection.execute(
+                    f"SELECT uuid FROM {self.table} WHERE uuid > ? ORDER BY uuid LIMIT ?",  # noqa: S608
+                    [last_uuid, self._page_size],
+                ).fetchall()
+            for (uuid,) in page:
+                yield uuid
+            if len(page) < self._page_size:
+                return
+            last_uuid = page[-1][0]
+
+    def __contains__(self, uuid: str) -> bool:
+        with self.lock:
+            row = self.connection.execute(
+                f"SELECT EXISTS(SELECT 1 FROM {self.table} WHERE uuid = ?)",  # noqa: S608
+                [uuid],
+            ).fetchone()
+        return bool(row[0])
+
+    def __len__(self) -> int:
+        return self._num_users
+
+    async def import_from_file(self, save_path: Path) -> None:
+        users = await Users.load_from_file(save_path)
+        with self.lock, self.connection:
+            self.connection.executemany(
+                f"INSERT OR REPLACE INTO {self.table} (uuid, phone_number) VALUES (?, ?)",  # noqa: S608
+                users.data.items(),
+            )
+        # Keep the old file around as a backup, but don't import it again in the next start
+        if save_path.exists():
+            save_path.rename(save_path.with_name(save_path.name + ".imported"))
+
+    @staticmethod
+    async def load_from_file(connection: sqlite3.Connection, table: str, save_path: Path, lock: Lock) -> SqliteUsers:
+        users = SqliteUsers(connection, table, lock)
+        with lock, connection:
+            connection.execute(f"CREATE TABLE IF NOT EXISTS {table} (uuid TEXT PRIMARY KEY, phone_number TEXT)")
+
+        if save_path.exists() or save_path.with_name(save_path.name + ".journal").exists():
+            await users.import_from_file(save_path)
+
+        with lock:
+            users._num_users = connection.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]  # noqa: S608
+        return users
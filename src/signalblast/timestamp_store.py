@@ -0,0 +1,211 @@
+from __future__ import annotations
+
+import json
+import time
+from array import array
+from bisect import bisect_left
+from collections.abc import Iterator, Mapping
+from typing import TYPE_CHECKING
+
+from signalblast.utils import TimestampData, add_column_if_missing
+
+if TYPE_CHECKING:
+    import sqlite3
+    from threading import Lock
+
+
+class BroadcastTimestamps(Mapping[str, int]):
+    """Read only view of the timestamps a message was sent with to each subscriber.
+    The subscribers are stored as sorted ids from the recipients table and the timestamps as differences
+    with the broadcast timestamp, looking up a single subscriber does not decode the rest."""
+
+    def __init__(self, store: TimestampStore, timestamp: int, recipient_ids: array, timestamp_deltas: array) -> None:
+        self.store = store
+        self.timestamp = timestamp
+        self.recipient_ids = recipient_ids
+        self.timestamp_deltas = timestamp_deltas
+
+    def index(self, uuid: str) -> int | None:
+        recipient_id = self.store.recipient_ids.get(uuid)
+        if recipient_id is not None:
+            i = bisect_left(self.recipient_ids, recipient_id)
+            if i < len(self.recipient_ids) and self.recipient_ids[i] == recipient_id:
+                return i
+        return None
+
+    def __getitem__(self, uuid: str) -> int:
+        i = self.index(uuid)
+        if i is None:
+            raise KeyError(uuid)
+        return self.timestamp + self.timestamp_deltas[i]
+
+    def __iter__(self) -> Iterator[str]:
+        for recipient_id in self.recipient_ids:
+            yield self.store.recipient_uuids[recipient_id]
+
+    def __len__(self) -> int:
+        return len(self.recipient_ids)
+
+
+class BroadcastAccounts(Mapping[str, str]):
+    """Read only view of the phone number each subscriber got the message from, the numbers are stored
+    once per broadcast and each subscriber only keeps a one byte index, in the same order as the timestamps."""
+
+    def __init__(self, broadcast_timestamps: BroadcastTimestamps, accounts: list[str], account_indices: array) -> None:
+        self.broadcast_timestamps = broadcast_timestamps
+        self.accounts = accounts
+        self.account_indices = account_indices
+
+    def __getitem__(self, uuid: str) -> str:
+        i = self.broadcast_timestamps.index(uuid)
+        if i is None:
+            raise KeyError(uuid)
+        return self.accounts[self.account_indices[i]]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.broadcast_timestamps)
+
+    def __len__(self) -> int:
+        return len(self.broadcast_timestamps)
+
+
+class TimestampStore:
+    """Timestamps of the broadcasted messages, needed to edit or delete them for every subscriber.
+    Signal only allows editing messages within 24 hours, so each row has an indexed expiry time and
+    the expired rows are deleted with a single query.
+    Subscriber uuids are interned in the recipients table, each broadcast only keeps two int64 arrays and the
+    account that sent each message."""
+
+    EXPIRATION_MS = 24 * 60 * 60 * 1000
+    _legacy_key_prefix = "broadcast-uuid-"
+
+    def __init__(self, connection: sqlite3.Connection, lock: Lock) -> None:
+        self.connection = connection
+        self.lock = lock
+        self.recipient_ids: dict[str, int] = {}
+        self.recipient_uuids: dict[int, str] = {}
+        self._max_id = 0
+
+    def _intern(self, uuids: list[str]) -> None:
+        new_uuids = [(uuid,) for uuid in uuids if uuid not in self.recipient_ids]
+        if len(new_uuids) == 0:
+            return
+        self.connection.executemany("INSERT OR IGNORE INTO recipients (uuid) VALUES (?)", new_uuids)
+        new_rows = self.connection.execute("SELECT id, uuid FROM recipients WHERE id > ?", [self._max_id])
+        for recipient_id, uuid in new_rows:
+            self.recipient_ids[uuid] = recipient_id
+            self.recipient_uuids[recipient_id] = uuid
+            self._max_id = max(self._max_id, recipient_id)
+
+    def _insert(
+        self,
+        author: str,
+        timestamp: int,
+        broadcast_timestamps: Mapping[str, int],
+        broadcast_accounts: Mapping[str, str] | None = None,
+    ) -> None:
+        self._intern(list(broadcast_timestamps))
+        pairs = sorted((self.recipient_ids[uuid], sent, uuid) for uuid, sent in broadcast_timestamps.items())
+        recipient_ids = array("q", (recipient_id for recipient_id, _, _ in pairs))
+        timestamp_deltas = array("q", (sent - timestamp for _, sent, _ in pairs))
+
+        accounts, account_indices = None, None
+        if broadcast_accounts:
+            accounts = sorted(set(broadcast_accounts.values()))
+            account_index = {account: i for i, account in enumerate(accounts)}
+            account_indices = array("B", (account_index[broadcast_accounts[uuid]] for _, _, uuid in pairs)).tobytes()
+            accounts = json.dumps(accounts)
+
+        self.connection.execute(
+            "INSERT OR REPLACE INTO broadcast_timestamps "
+            "(author, timestamp, expires_at, recipient_ids, timestamp_deltas, accounts, account_indices) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [
+                author,
+                timestamp,
+                timestamp + self.EXPIRATION_MS,
+                recipient_ids.tobytes(),
+                timestamp_deltas.tobytes(),
+                accounts,
+                account_indices,
+            ],
+        )
+
+    def save(self, timestamp_data: TimestampData) -> None:
+        with self.lock, self.connection:
+            self._insert(
+                timestamp_data.author,
+                timestamp_data.timestamp,
+                timestamp_data.broadcast_timestamps,
+                timestamp_data.broadcast_accounts,
+            )
+
+    def read(self, author: str, timestamp: int) -> TimestampData | None:
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT recipient_ids, timestamp_deltas, accounts, account_indices FROM broadcast_timestamps "
+                "WHERE author = ? AND timestamp = ?",
+                [author, timestamp],
+            ).fetchone()
+        if row is None:
+            return None
+
+        recipient_ids, timestamp_deltas = array("q"), array("q")
+        recipient_ids.frombytes(row[0])
+        timestamp_deltas.frombytes(row[1])
+        broadcast_timestamps = BroadcastTimestamps(self, timestamp, recipient_ids, timestamp_deltas)
+
+        # Broadcasts from before there were several accounts were all sent by the bot's own number
+        broadcast_accounts = {}
+        if row[2] is not None:
+            account_indices = array("B")
+            account_indices.frombytes(row[3])
+            broadcast_accounts = BroadcastAccounts(broadcast_timestamps, json.loads(row[2]), account_indices)
+
+        return TimestampData(
+            author=author,
+            timestamp=timestamp,
+            broadcast_timestamps=broadcast_timestamps,
+            broadcast_accounts=broadcast_accounts,
+        )
+
+    def delete_expired(self, now_ms: int | None = None) -> int:
+        if now_ms is None:
+            now_ms = int(time.time() * 1000)
+        with self.lock, self.connection:
+            cursor = self.connection.execute("DELETE FROM broadcast_timestamps WHERE expires_at < ?", [now_ms])
+        return cursor.rowcount
+
+    def _import_legacy_timestamps(self) -> None:
+        # Older versions saved the timestamps as json values in signalbot's key value table
+        with self.lock, self.connection:
+            rows = self.connection.execute(
+                "SELECT key, value FROM signalbot WHERE key LIKE ?",
+                [self._legacy_key_prefix + "%"],
+            ).fetchall()
+            for key, value in rows:
+                legacy_data = json.loads(value)
+                self._insert(legacy_data["author"], legacy_data["timestamp"], legacy_data["broadcast_timestamps"])
+                self.connection.execute("DELETE FROM signalbot WHERE key = ?", [key])
+
+    @staticmethod
+    def load(connection: sqlite3.Connection, lock: Lock) -> TimestampStore:
+        store = TimestampStore(connection, lock)
+        with lock, connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS recipients (id INTEGER PRIMARY KEY, uuid TEXT UNIQUE)")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS broadcast_timestamps ("
+                "author TEXT, timestamp INTEGER, expires_at INTEGER, recipient_ids BLOB, timestamp_deltas BLOB, "
+                "PRIMARY KEY (author, timestamp))",
+            )
+            add_column_if_missing(connection, "broadcast_timestamps", "accounts", "TEXT")
+            add_column_if_missing(connection, "broadcast_timestamps", "account_indices", "BLOB")
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS broadcast_timestamps_expires_at ON broadcast_timestamps (expires_at)",
+            )
+            for recipient_id, uuid in connection.execute("SELECT id, uuid FROM recipients"):
+                store.recipient_ids[uuid] = recipient_id
+                store.recipient_uuids[recipient_id] = uuid
+                store._max_id = max(store._max_id, recipient_id)
+        store._import_legacy_timestamps()
+        return store
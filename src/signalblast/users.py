@@ -1,50 +1,145 @@
 from __future__ import annotations
 
+import asyncio
 import csv
+import os
 from typing import TYPE_CHECKING
 
+from signalblast.utils import Debouncer, fsync_directory
+
 if TYPE_CHECKING:
     from collections.abc import Iterator
     from pathlib import Path
 
 
 class Users:
+    """Users are kept in a csv snapshot plus an append only journal of the changes made after it.
+    Adding or removing a user only returns once its line is on disk in the journal, the changes made while a line
+    is being written go in the next write together. compact() folds the journal into the snapshot, SNAPSHOT_DELAY
+    seconds after the first change so a burst of changes ends up in a single snapshot. The files are written in a
+    worker thread, flush() writes the snapshot now."""
+
+    SNAPSHOT_DELAY = 60.0
+
     _uuid_str = "uuid"
     _phone_number_str = "phone_number"
+    _added_str = "+"
+    _removed_str = "-"
 
     def __init__(self, save_path: Path) -> None:
         self.save_path = save_path
+        self.journal_path = save_path.with_name(save_path.name + ".journal")
         self.data: dict[str, str | None] = {}
+        self.num_journal_entries = 0
+        self._journal_buffer: list[list[str | None]] = []
+        self._write_lock = asyncio.Lock()
+        self._snapshot_writer = Debouncer(self.compact, self.SNAPSHOT_DELAY)
 
     async def add(self, uuid: str, phone_number: str | None) -> None:
         self.data[uuid] = phone_number
-        await self.save_to_file()
+        await self._append_to_journal(self._added_str, uuid, phone_number)
 
     async def remove(self, uuid: str) -> None:
         del self.data[uuid]
-        await self.save_to_file()
+        await self._append_to_journal(self._removed_str, uuid, None)
 
-    async def save_to_file(self) -> None:
-        with self.save_path.open("w") as f:
+    async def _append_to_journal(self, change: str, uuid: str, phone_number: str | None) -> None:
+        # The subscriber is only told about the change once it would survive a crash
+        self._journal_buffer.append([change, uuid, phone_number])
+        self.num_journal_entries += 1
+        await self._write_journal()
+        self._snapshot_writer.schedule()
+
+    def _append_rows(self, rows: list[list[str | None]]) -> None:
+        with self.journal_path.open("a", newline="") as f:
+            csv.writer(f).writerows(rows)
+            f.flush()
+            os.fsync(f.fileno())
+
+    async def _write_journal(self) -> None:
+        async with self._write_lock:
+            # Empty if the write before this one already had the row
+            rows, self._journal_buffer = self._journal_buffer, []
+            if len(rows) == 0:
+                return
+            try:
+                await asyncio.to_thread(self._append_rows, rows)
+            except Exception:
+                # Keep them for the next write, the journal has to keep the order of the changes
+                self._journal_buffer[:0] = rows
+                raise
+
+    def _write_snapshot(self, data: dict[str, str | None]) -> None:
+        # Write to a temporary file first, a crash while writing must not leave a half written snapshot
+        tmp_path = self.save_path.with_name(self.save_path.name + ".tmp")
+        with tmp_path.open("w") as f:
             csv_writer = csv.DictWriter(f, fieldnames=[self._uuid_str, self._phone_number_str])
             csv_writer.writeheader()
-            for uuid, phone_number in self.data.items():
+            for uuid, phone_number in data.items():
                 csv_writer.writerow({self._uuid_str: uuid, self._phone_number_str: phone_number})
+            f.flush()
+            os.fsync(f.fileno())
+        tmp_path.replace(self.save_path)
+        # The journal is only deleted once the new snapshot is on disk, otherwise a power loss could lose both
+        fsync_directory(self.save_path.parent)
+        # Replaying the journal on top of the new snapshot is harmless, so crashing before this line is fine
+        self.journal_path.unlink(missing_ok=True)
+
+    async def save_to_file(self) -> None:
+        async with self._write_lock:
+            # The snapshot has all the changes, including the ones still waiting to be written to the journal
+            rows, self._journal_buffer = self._journal_buffer, []
+            num_journal_entries = self.num_journal_entries
+            try:
+                await asyncio.to_thread(self._write_snapshot, dict(self.data))
+            except Exception:
+                self._journal_buffer[:0] = rows
+                raise
+            # Changes made while writing are not in the snapshot, they go to the new journal
+            self.num_journal_entries -= num_journal_entries
+
+    async def compact(self) -> None:
+        if self.num_journal_entries == 0:
+            return
+        await self.save_to_file()
+
+    async def flush(self) -> None:
+        await self._snapshot_writer.flush()
+
+    def _replay_journal(self) -> None:
+        journal = self.journal_path.read_text()
+        lines = journal.splitlines()
+        if not journal.endswith("\n"):
+            # The last change was not fully written before the process stopped
+            lines = lines[:-1]
+
+        for change, uuid, phone_number in csv.reader(lines):
+            if change == self._added_str:
+                self.data[uuid] = phone_number
+            else:
+                self.data.pop(uuid, None)
+            self.num_journal_entries += 1
 
     @staticmethod
     async def _load_from_file(save_path: Path) -> Users:
         users = Users(save_path)
-        with save_path.open() as f:
-            csv_reader = csv.DictReader(f)
-            for line in csv_reader:
-                users.data[line[Users._uuid_str]] = line[Users._phone_number_str]
+        if save_path.exists():
+            with save_path.open() as f:
+                csv_reader = csv.DictReader(f)
+                for line in csv_reader:
+                    users.data[line[Users._uuid_str]] = line[Users._phone_number_str]
+
+        if users.journal_path.exists():
+            users._replay_journal()
+            await users.compact()
         return users
 
     def get_phone_number(self, uuid: str) -> str | None:
         return self.data.get(uuid)
 
     def __iter__(self) -> Iterator[str | None]:
-        yield from self.data
+        # Iterate over a copy, subscribers can come and go while a broadcast is going through the list
+        yield from list(self.data)
 
     def __contains__(self, uuid: str) -> bool:
         return uuid in self.data
@@ -54,7 +149,4 @@ class Users:
 
     @staticmethod
     async def load_from_file(save_path: Path) -> Users:
-        if not save_path.exists():
-            return Users(save_path)
-
         return await Users._load_from_file(save_path)
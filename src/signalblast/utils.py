@@ -1,28 +1,118 @@
-from logging import WARNING, Formatter, Logger, StreamHandler, getLogger
-from logging.handlers import TimedRotatingFileHandler
+import asyncio
+import atexit
+import os
+from collections.abc import Callable, Coroutine, Iterable, Iterator, Mapping
+from dataclasses import dataclass, field
+from itertools import islice
+from logging import WARNING, Formatter, Handler, Logger, StreamHandler, getLogger
+from logging.handlers import QueueHandler, QueueListener, TimedRotatingFileHandler
 from pathlib import Path
+from queue import SimpleQueue
+from sqlite3 import Connection
+from typing import Any
 
-from pydantic import BaseModel
+# The queue handler and the listener writing its records, for each log file or None for the console
+_log_queues: dict[Path | None, tuple[QueueHandler, QueueListener]] = {}
 
 
 def create_or_set_logger(name: str | None, logging_level: int = WARNING, log_file: Path | None = None) -> Logger:
-    # Log to console or log to file, keeping the log for two weeks, rotate every Monday.
-    handler = StreamHandler() if log_file is None else TimedRotatingFileHandler(log_file, when="W0", backupCount=1)
+    """The records are written by a listener thread, logging never waits for the disk in the event loop.
+    The loggers of the same file share its handler, so it is only rotated once."""
+    if log_file not in _log_queues:
+        # Log to console or log to file, keeping the log for two weeks, rotate every Monday.
+        handler = StreamHandler() if log_file is None else TimedRotatingFileHandler(log_file, when="W0", backupCount=1)
 
-    formatter = Formatter("%(asctime)s %(name)s [%(levelname)s] - %(funcName)s - %(message)s")
-    handler.setFormatter(formatter)
+        formatter = Formatter("%(asctime)s %(name)s [%(levelname)s] - %(funcName)s - %(message)s")
+        handler.setFormatter(formatter)
 
+        queue_handler = QueueHandler(SimpleQueue())
+        listener = QueueListener(queue_handler.queue, handler)
+        listener.start()
+        # Write the records still in the queue before exiting
+        atexit.register(listener.stop)
+        _log_queues[log_file] = (queue_handler, listener)
+
+    queue_handler, _ = _log_queues[log_file]
     logger = getLogger(name)
     logger.setLevel(logging_level)
-    logger.addHandler(handler)
+    if queue_handler not in logger.handlers:
+        logger.addHandler(queue_handler)
     return logger
 
 
+def get_log_handlers(logger: Logger) -> list[Handler]:
+    # The handlers writing the records of the logger, instead of the queue handlers that pass them on
+    handlers = []
+    for handler in logger.handlers:
+        listeners = [listener for queue_handler, listener in _log_queues.values() if queue_handler is handler]
+        if len(listeners) > 0:
+            handlers.extend(listeners[0].handlers)
+        else:
+            handlers.append(handler)
+    return handlers
+
+
+def batched(iterable: Iterable[str], batch_size: int) -> Iterator[list[str]]:
+    # Same as itertools.batched, which is not available in python 3.10
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, batch_size)):
+        yield batch
+
+
+class Debouncer:
+    """Runs the function once, delay seconds after the first schedule() call.
+    All the calls made in the meantime are coalesced into that single run."""
+
+    def __init__(self, function: Callable[[], Coroutine[Any, Any, None]], delay: float) -> None:
+        self.function = function
+        self.delay = delay
+        self._task: asyncio.Task | None = None
+
+    def schedule(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run_later())
+
+    async def _run_later(self) -> None:
+        await asyncio.sleep(self.delay)
+        self._task = None
+        try:
+            await self.function()
+        except Exception:
+            getLogger(__name__).exception("Delayed write failed, retrying later")
+            self.schedule()
+
+    async def flush(self) -> None:
+        # Run now instead of waiting for the delay
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.function()
+
+
+def fsync_directory(path: Path) -> None:
+    # A rename or delete is only on disk once the directory that has the file is
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def add_column_if_missing(connection: Connection, table: str, column: str, column_type: str) -> None:
+    # CREATE TABLE IF NOT EXISTS does not add the columns that are new since the table was created
+    columns = [row[1] for row in connection.execute(f"PRAGMA table_info({table})")]
+    if column not in columns:
+        connection.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+
+
 def get_code_data_path() -> Path:
     return Path(__file__).parent.absolute() / "data"
 
 
-class TimestampData(BaseModel):
+@dataclass
+class TimestampData:
     timestamp: int
     author: str
-    broadcast_timestamps: dict[str, int]  # subscriber uuid, timestamp
+    broadcast_timestamps: Mapping[str, int]  # subscriber uuid, timestamp
+    # subscriber uuid, phone number of the account that sent it, the bot's own number if missing
+    broadcast_accounts: Mapping[str, str] = field(default_factory=dict)